@@ -1,24 +1,32 @@
 import base64
-import json
+import os
+import shutil
+import tempfile
 import warnings
 
-import numpy as np
 import pandas as pd
 import streamlit as st
-import torch
 from PIL import Image
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BlipForConditionalGeneration, BlipProcessor
 
 from batch_processor import process_batch_images
-from utils import (check_nsfw_image, generate_caption, 
-                   generate_seo_metadata, load_models, moderate_content)
+from image_sources import decode_image
+from preprocessing import prepare_inputs
+from result_cache import content_hash, get_result_cache
+from result_writers import CSVSink, JSONSink, TeeSink
+from startup import Warmup
+from utils import (CASCADE_MODEL, NSFW_MODEL, caption_model_id, check_nsfw_image, generate_caption,
+                   generate_caption_cascade, model_input_specs, generate_seo_metadata, load_models,
+                   moderate_content, resolve_cascade_threshold)
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
 
 # annoying warnings
 warnings.filterwarnings('ignore')
 
 APP_VERSION = "v1.0.0"
+PREVIEW_ROWS = 1000
 icon = Image.open("assets/logo.ico")
 
 #basic page setup
@@ -187,10 +195,16 @@ with st.sidebar:
     # Pick your poison - which model to use
     model_choice = st.selectbox(
         "Generation Model",
-        ["BLIP Large (Recommended)", "BLIP Base"],
+        ["BLIP Large (Recommended)", "BLIP Base", "BLIP Cascade (Base, Large when unsure)"],
         help="Choose the model for generating captions"
     )
     
+    # the cascade only pays for BLIP Large on the images Base isn't confident about
+    cascade_threshold = None
+    if "Cascade" in model_choice:
+        cascade_threshold = st.slider("Cascade confidence threshold", 0.0, 1.0, resolve_cascade_threshold(), 0.05,
+            help="Images BLIP Base captions with less confidence than this are re-captioned with BLIP Large")
+    
     st.markdown("""
     <div class="sidebar-header">
         <svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 24 24"> <path d="M12,15.5A3.5,3.5 0 0,1 8.5,12A3.5,3.5 0 0,1 12,8.5A3.5,3.5 0 0,1 15.5,12A3.5,3.5 0 0,1 12,15.5M19.43,12.97C19.47,12.65 19.5,12.33 19.5,12C19.5,11.67 19.47,11.34 19.43,11L21.54,9.37C21.73,9.22 21.78,8.95 21.66,8.73L19.66,5.27C19.54,5.05 19.27,4.96 19.05,5.05L16.56,6.05C16.04,5.66 15.5,5.32 14.87,5.07L14.5,2.42C14.46,2.18 14.25,2 14,2H10C9.75,2 9.54,2.18 9.5,2.42L9.13,5.07C8.5,5.32 7.96,5.66 7.44,6.05L4.95,5.05C4.73,4.96 4.46,5.05 4.34,5.27L2.34,8.73C2.22,8.95 2.27,9.22 2.46,9.37L4.57,11C4.53,11.34 4.5,11.67 4.5,12C4.5,12.33 4.53,12.65 4.57,12.97L2.46,14.63C2.27,14.78 2.22,15.05 2.34,15.27L4.34,18.73C4.46,18.95 4.73,19.03 4.95,18.95L7.44,17.94C7.96,18.34 8.5,18.68 9.13,18.93L9.5,21.58C9.54,21.82 9.75,22 10,22H14C14.25,22 14.46,21.82 14.5,21.58L14.87,18.93C15.5,18.68 16.04,18.34 16.56,17.94L19.05,18.95C19.27,19.03 19.54,18.95 19.66,18.73L21.66,15.27C21.78,15.05 21.73,14.78 21.54,14.63L19.43,12.97Z"/> </svg>
@@ -240,24 +254,35 @@ with st.sidebar:
         help="Check generated captions for inappropriate content")
 
 # =============================================
-# looad the models, this might take a sec
+# looad the models, in the background so the page is usable right away
 # =============================================
 @st.cache_resource(show_spinner=False)
-def load_all_models():
-    return load_models()
+def start_warmup(_first_model):
+    # registering is instant, the warm-up thread does the slow part; once per server process
+    # (the leading underscore keeps the argument out of streamlit's cache key)
+    load_models()
+    return Warmup([_first_model, "nsfw_detector"]).start()
 
-# Only load models once, then cache them
 if not st.session_state.models_loaded:
     try:
-        with st.spinner("Loading models... This may take a few seconds for the first time."):
-            models_dict, processor_dict = load_all_models()
-            st.session_state.models_dict = models_dict
-            st.session_state.processor_dict = processor_dict
-            st.session_state.models_loaded = True
+        models_dict, processor_dict = load_models()
+        st.session_state.models_dict = models_dict
+        st.session_state.processor_dict = processor_dict
+        st.session_state.models_loaded = True
     except Exception as e:
         st.error(f"Error loading models: {str(e)}")
         st.stop()
 
+# whichever model the first visitor has selected is warmed up first
+warmup = start_warmup("BLIP Base" if "Base" in model_choice else "BLIP Large")
+with st.sidebar:
+    if warmup.ready.is_set():
+        st.caption(f"Models ready ({warmup.status()['seconds']:.0f}s warm-up)")
+    elif warmup.failed:
+        st.warning(f"Some models failed to load ({', '.join(warmup.errors)}); loading is retried after a minute.")
+    else:
+        st.caption("Models are warming up. You can upload now; the first caption waits for them.")
+
 # =============================================
 # tabs
 # =============================================
@@ -293,14 +318,40 @@ with tab1:
         col1, col2 = st.columns([1, 2])
         
         with col1:
-            image = Image.open(current_image).convert("RGB")
+            # decoded at reduced resolution, still at least as big as the largest model input
+            try:
+                image = decode_image(current_image.getvalue())
+            except ValueError as e:
+                # too big to decode safely
+                st.error(f"Could not open the image: {e}")
+                st.stop()
+            #f figure out which model they actually picked
+            actual_model = CASCADE_MODEL if "Cascade" in model_choice else "BLIP Large" if "Large" in model_choice else "BLIP Base"
+            # one resize pyramid feeds both the NSFW detector and the caption model
+            try:
+                model_inputs = prepare_inputs(image, model_input_specs(actual_model, st.session_state.processor_dict,
+                                                                       include_nsfw=enable_nsfw_check))
+            except Exception as e:
+                logger.warning(f"Shared preprocessing unavailable, models will preprocess themselves: {e}")
+                model_inputs = {}
             st.image(image, width=280, caption="Uploaded Image", use_container_width=False)
             
+            # results for this exact image come from the cache when we have them
+            result_cache = get_result_cache()
+            image_digest = content_hash(current_image.getvalue())
+            
             nsfw_detected = False
             if enable_nsfw_check:
                 with st.spinner("Checking image safety..."):
                     try:
-                        nsfw_score, nsfw_class = check_nsfw_image(image)
+                        nsfw_key = result_cache.key(image_digest, NSFW_MODEL) if result_cache else None
+                        cached = result_cache.get(nsfw_key) if result_cache else None
+                        if cached and cached['nsfw_score'] is not None:
+                            nsfw_score, nsfw_class = cached['nsfw_score'], cached['nsfw_label']
+                        else:
+                            nsfw_score, nsfw_class = check_nsfw_image(image, pixel_values=model_inputs.get('nsfw'))
+                            if result_cache and nsfw_class not in ("error", "Model not available"):
+                                result_cache.put(nsfw_key, nsfw_score=nsfw_score, nsfw_label=nsfw_class)
                         
                         if nsfw_score > 0.9:
                             st.error(f"NSFW content detected with {nsfw_score:.1%} confidence! Image processing blocked.")
@@ -319,21 +370,50 @@ with tab1:
         with col2:            
             with st.spinner("Generating caption..."):
                 try:
-                    #f figure out which model they actually picked
-                    actual_model = "BLIP Large" if "Large" in model_choice else "BLIP Base"
-                    
-                    caption = generate_caption(
-                        image, 
-                        actual_model, 
-                        st.session_state.models_dict, 
-                        st.session_state.processor_dict,
-                        max_length=max_length,
-                        num_beams=num_beams,
-                        temperature=temperature
-                    )
+                    caption_key = result_cache.key(image_digest, caption_model_id(actual_model, cascade_threshold),
+                                                   max_length=max_length, num_beams=num_beams,
+                                                   temperature=temperature) if result_cache else None
+                    cached = (result_cache.get(caption_key) if result_cache else None) or {}
+                    answered_by = None
+                    if cached.get('caption') is not None:
+                        caption = cached['caption']
+                        # set for cascade captions, so a hit still says which stage answered
+                        answered_by, confidence = cached.get('caption_model'), cached.get('caption_confidence') or 0.0
+                    elif actual_model == CASCADE_MODEL:
+                        caption, answered_by, confidence = generate_caption_cascade(
+                            image,
+                            st.session_state.models_dict,
+                            st.session_state.processor_dict,
+                            max_length=max_length,
+                            num_beams=num_beams,
+                            temperature=temperature,
+                            image_key=image_digest,
+                            pixel_values=model_inputs.get('caption'),
+                            threshold=cascade_threshold
+                        )
+                        if result_cache and not caption.startswith("Generation error"):
+                            result_cache.put(caption_key, caption=caption, caption_model=answered_by,
+                                             caption_confidence=confidence)
+                    else:
+                        caption = generate_caption(
+                            image, 
+                            actual_model, 
+                            st.session_state.models_dict, 
+                            st.session_state.processor_dict,
+                            max_length=max_length,
+                            num_beams=num_beams,
+                            temperature=temperature,
+                            # slider tweaks only rerun the decoder, the image encoding is reused
+                            image_key=image_digest,
+                            pixel_values=model_inputs.get('caption')
+                        )
+                        if result_cache and not caption.startswith("Generation error"):
+                            result_cache.put(caption_key, caption=caption)
                     
                     with st.expander("Caption", expanded=True):
                         st.markdown(f"**{caption}**")
+                        if answered_by:
+                            st.caption(f"Answered by {answered_by} (BLIP Base confidence {confidence:.0%})")
                     
                     # Check if the caption is appropriate
                     if enable_moderation:
@@ -345,7 +425,12 @@ with tab1:
                     
                     # generate seo  if enabled
                     if auto_seo:
-                        keywords, meta_desc, _ = generate_seo_metadata(caption)
+                        if cached.get('keywords') is not None and cached.get('meta_description') is not None:
+                            keywords, meta_desc = cached['keywords'], cached['meta_description']
+                        else:
+                            keywords, meta_desc, _ = generate_seo_metadata(caption)
+                            if result_cache and not caption.startswith("Generation error"):
+                                result_cache.put(caption_key, keywords=keywords, meta_description=meta_desc)
                         with st.expander("SEO Optimization", expanded=True):
                             st.write(f"**Keywords:** {', '.join(keywords)}")
                             st.write(f"**Meta Description:** {meta_desc}")
@@ -354,7 +439,7 @@ with tab1:
                     st.session_state.generated_captions.append({
                         'image': current_image.name,
                         'caption': caption,
-                        'model': actual_model,
+                        'model': answered_by or actual_model,
                         'keywords': keywords if auto_seo else []
                     })
                     
@@ -364,17 +449,20 @@ with tab1:
 with tab2:    
     st.info("""
     **Batch Processing Feature:** 
-    Upload a ZIP file containing your images to process them in bulk and download the results.
+    Upload a ZIP or TAR archive containing your images to process them in bulk and download the results.
     """)
     
     uploaded_zip = st.file_uploader(
-        "Upload a ZIP file containing your images",
-        type="zip",
+        "Upload a ZIP or TAR archive containing your images",
+        type=["zip", "tar", "gz", "tgz"],
         key="batch_uploader"
     )
     
+    enable_dedup = st.checkbox("Collapse near-duplicate images", value=False,
+        help="Caption re-encoded, resized or renamed copies of the same photo only once")
+    
     # show button disabled if no ZIP
-    actual_model = "BLIP Large" if "Large" in model_choice else "BLIP Base"
+    actual_model = CASCADE_MODEL if "Cascade" in model_choice else "BLIP Large" if "Large" in model_choice else "BLIP Base"
     
     process_clicked = st.button("Start Batch Processing", 
                                disabled=uploaded_zip is None,
@@ -383,34 +471,50 @@ with tab2:
     if uploaded_zip and process_clicked:
         with st.spinner("Processing images..."):
             try:
-                results_df = process_batch_images(
+                # rows are streamed to disk as they finish instead of piling up in a DataFrame
+                if st.session_state.get('results_dir'):
+                    shutil.rmtree(st.session_state.results_dir, ignore_errors=True)
+                results_dir = tempfile.mkdtemp(prefix="image2text-")
+                st.session_state.results_dir = results_dir
+                sink = TeeSink(
+                    CSVSink(os.path.join(results_dir, "batch_caption_results.csv")),
+                    JSONSink(os.path.join(results_dir, "batch_caption_results.json"))
+                )
+                csv_path, json_path = process_batch_images(
                     uploaded_zip, 
                     actual_model, 
                     st.session_state.models_dict, 
                     st.session_state.processor_dict,
                     enable_seo=auto_seo,
-                    enable_nsfw_check=enable_nsfw_check
+                    enable_nsfw_check=enable_nsfw_check,
+                    enable_moderation=enable_moderation,
+                    enable_dedup=enable_dedup,
+                    cascade_threshold=cascade_threshold,
+                    pipeline_mode=True,
+                    sink=sink
                 )
                 
-                st.success(f"{len(results_df)} images processed successfully!")
-                st.dataframe(results_df, use_container_width=True)
+                st.success(f"{sink.rows_written} images processed successfully!")
+                if sink.rows_written > PREVIEW_ROWS:
+                    st.caption(f"Showing the first {PREVIEW_ROWS} rows, download the files for everything.")
+                st.dataframe(pd.read_csv(csv_path, nrows=PREVIEW_ROWS), use_container_width=True)
                 
                 #   download the results
-                csv = results_df.to_csv(index=False)
-                st.download_button(
-                    label="Download Results (CSV)",
-                    data=csv,
-                    file_name="batch_caption_results.csv",
-                    mime="text/csv"
-                )
+                with open(csv_path, "rb") as f:
+                    st.download_button(
+                        label="Download Results (CSV)",
+                        data=f,
+                        file_name="batch_caption_results.csv",
+                        mime="text/csv"
+                    )
                 
-                json_data = results_df.to_dict('records')
-                st.download_button(
-                    label="Download Results (JSON)",
-                    data=json.dumps(json_data, indent=2),
-                    file_name="batch_caption_results.json",
-                    mime="application/json"
-                )
+                with open(json_path, "rb") as f:
+                    st.download_button(
+                        label="Download Results (JSON)",
+                        data=f,
+                        file_name="batch_caption_results.json",
+                        mime="application/json"
+                    )
                 
             except Exception as e:
                 st.error(f"Error during batch processing: {str(e)}")
@@ -0,0 +1,162 @@
+"""asyncio facade over the caption engine, for embedding in async services.
+
+    from async_api import caption_image, caption_stream
+
+    result = await caption_image(jpeg_bytes, model='base', timeout=5)
+    async for result in caption_stream(uploads):
+        ...
+
+Concurrent awaits from one event loop are coalesced into batched inference by the
+engine's MicroBatcher; the loop itself never runs model or decode work.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Optional, Union
+
+from PIL import Image
+
+from caption_engine import CaptionEngine, add_seo
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+DEFAULT_DECODE_WORKERS = 4
+DEFAULT_STREAM_CONCURRENCY = 16
+
+async def _aiter(images):
+    """Iterate a plain or async iterable alike"""
+    if hasattr(images, '__aiter__'):
+        async for image in images:
+            yield image
+    else:
+        for image in images:
+            yield image
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+class AsyncCaptioner:
+    """Awaitable captioning on top of a CaptionEngine.
+
+    Decoding, resizing and SEO run on a dedicated thread pool, inference on the engine's
+    inference thread. Cancelling an await (or hitting its timeout) withdraws the request
+    from the queue if its batch hasn't started yet.
+    """
+
+    def __init__(self, engine: Optional[CaptionEngine] = None, decode_workers: int = DEFAULT_DECODE_WORKERS,
+                 **engine_kwargs):
+        self.engine = engine or CaptionEngine(**engine_kwargs)
+        self._executor = ThreadPoolExecutor(max_workers=max(1, decode_workers), thread_name_prefix='caption-decode')
+
+    async def _offload(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _prepare(self, image, model):
+        if isinstance(image, Image.Image):
+            return self.engine.prepare_image(image, model)
+        return self.engine.prepare(bytes(image), model)
+
+    async def warm_up(self):
+        """Load the default models and run one image through them"""
+        await self._offload(self.engine.warm_up)
+
+    async def caption_image(self, image: Union[bytes, Image.Image], timeout: Optional[float] = None,
+                            seo: bool = True, **options) -> Dict:
+        """Caption image bytes or a PIL image, batched with whatever else is awaiting.
+
+        `options` are CaptionOptions fields (model, max_length, num_beams, ...). Raises
+        asyncio.TimeoutError after `timeout` seconds and ValueError for bad options.
+        """
+        options = self.engine.options(**options)
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        async def run():
+            prepared = await self._offload(self._prepare, image, options.model)
+            # cancelling the wrapper cancels the queued request too
+            result = await asyncio.wrap_future(self.engine.submit(prepared, options, deadline))
+            return await self._offload(add_seo, result) if seo else result
+
+        return await asyncio.wait_for(run(), timeout)
+
+    async def _caption_or_error(self, image, **kwargs) -> Dict:
+        try:
+            return await self.caption_image(image, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Caption failed: {e}")
+            status = 'timeout' if isinstance(e, (asyncio.TimeoutError, TimeoutError)) else 'error'
+            return {'caption': '', 'status': status, 'error': str(e)}
+
+    async def caption_stream(self, images, concurrency: int = DEFAULT_STREAM_CONCURRENCY,
+                             **kwargs) -> AsyncIterator[Dict]:
+        """Caption a plain or async iterable of images, yielding results in input order.
+
+        Each result is yielded as soon as it and those before it are done, even while the
+        input is idle. At most `concurrency` images are in flight, enough to fill batches
+        without reading the whole input ahead. A failed image yields a result with status
+        'error' (or 'timeout') instead of ending the stream.
+        """
+        pending = deque()
+        source = _aiter(images)
+        reading = None      # the task fetching the next input, while there is room for it
+        exhausted = False
+        try:
+            while True:
+                if reading is None and not exhausted and len(pending) < max(1, concurrency):
+                    reading = asyncio.ensure_future(_anext(source))
+                waiting = [task for task in (reading, pending[0] if pending else None) if task is not None]
+                if not waiting:
+                    return
+                # whichever comes first: the next input, or the result at the head
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+                if reading is not None and reading.done():
+                    try:
+                        image = reading.result()
+                    except StopAsyncIteration:
+                        exhausted = True
+                    else:
+                        pending.append(asyncio.ensure_future(self._caption_or_error(image, **kwargs)))
+                    reading = None
+                while pending and pending[0].done():
+                    yield pending.popleft().result()
+        finally:
+            # the consumer stopped early: withdraw whatever is still queued, and let it finish cancelling
+            tasks = list(pending) + ([reading] if reading is not None else [])
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.engine.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+_CAPTIONER = None
+_CAPTIONER_LOCK = threading.Lock()
+
+def get_async_captioner() -> AsyncCaptioner:
+    """Process-wide AsyncCaptioner shared by caption_image and caption_stream"""
+    global _CAPTIONER
+    with _CAPTIONER_LOCK:
+        if _CAPTIONER is None:
+            _CAPTIONER = AsyncCaptioner()
+        return _CAPTIONER
+
+async def caption_image(image: Union[bytes, Image.Image], **kwargs) -> Dict:
+    """See AsyncCaptioner.caption_image"""
+    return await get_async_captioner().caption_image(image, **kwargs)
+
+async def caption_stream(images, **kwargs) -> AsyncIterator[Dict]:
+    """See AsyncCaptioner.caption_stream"""
+    async for result in get_async_captioner().caption_stream(images, **kwargs):
+        yield result
@@ -0,0 +1,235 @@
+"""Headless batch captioning: shards a source across worker processes with resumable checkpoints.
+
+    python batch_cli.py images.zip --output results.csv --workers 16 --threads-per-worker 4
+
+Each worker appends finished rows to its own journal under the checkpoint directory;
+rerunning the same command skips everything already journaled successfully, retries the
+images that failed, and merges all journals into the output file at the end.
+
+Every worker walks the whole source and keeps the names of its shard. That is cheap for
+ZIP archives, directories and plain tar files, whose members are skipped unread, but a
+.tar.gz can only be read front to back: each worker decompresses the entire archive.
+Convert big compressed tars to ZIP (or extract them) before running many workers.
+
+With --preload the parent loads the models once and forks the workers, which then share
+the weights copy-on-write instead of each loading a private copy; --weights mmap maps
+them from the safetensors files so they are shared with every other process too.
+memory_report.py --children <pid> shows how much each worker actually shares.
+"""
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import sys
+import time
+import zlib
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+def shard_of(name: str, num_shards: int) -> int:
+    """Stable shard assignment of an image name (same across runs and processes)"""
+    return zlib.crc32(name.encode('utf-8')) % num_shards
+
+def read_journals(checkpoint_dir: str):
+    """Yield journaled rows, skipping a line cut short by a crash"""
+    for path in sorted(glob.glob(os.path.join(checkpoint_dir, 'shard-*.jsonl'))):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Ignoring truncated checkpoint line in {path}")
+
+def _worker_cores(worker: int, threads: int):
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else []
+    if len(available) < threads:
+        return None
+    start = (worker * threads) % len(available)
+    return (available + available)[start:start + threads]
+
+def _run_worker(worker: int, args: dict, done: set):
+    """Worker process entry point: load the models once, then caption our shard"""
+    cores = _worker_cores(worker, args['threads_per_worker']) if args['pin_cores'] else None
+    if cores:
+        os.sched_setaffinity(0, cores)
+
+    # heavy imports happen here so the thread count is set before torch spins up its pools
+    if args['backend'] == 'onnx':
+        # ONNX Runtime reads it in load_models (utils.onnx_threads); captioning needs no torch
+        os.environ['OMP_NUM_THREADS'] = str(args['threads_per_worker'])
+    else:
+        import torch
+        torch.set_num_threads(args['threads_per_worker'])
+    from batch_processor import process_batch_images
+    from result_writers import NullSink
+    from utils import load_models
+
+    logger.info(f"Worker {worker}: {args['threads_per_worker']} threads, cores {cores or 'unpinned'}, {args['precision']}")
+    # with --preload the models are already registered (and loaded) in the forked registry
+    models_dict, processor_dict = load_models(precision=args['precision'], backend=args['backend'],
+                                              weights=args['weights'])
+
+    journal_path = os.path.join(args['checkpoint_dir'], f'shard-{worker:03d}.jsonl')
+    with open(journal_path, 'a', encoding='utf-8') as journal:
+        def on_rows(names, rows):
+            for name, row in zip(names, rows):
+                journal.write(json.dumps({'Path': name, **row}) + '\n')
+            # a micro-batch is only done once it is on disk
+            journal.flush()
+            os.fsync(journal.fileno())
+
+        def select(name):
+            return shard_of(name, args['workers']) == worker and name not in done
+
+        process_batch_images(
+            args['source'], args['model'], models_dict, processor_dict,
+            select=select,
+            on_rows=on_rows,
+            # rows only go to the journal, the worker keeps nothing in memory
+            sink=NullSink(),
+            batch_size=args['batch_size'],
+            enable_nsfw_check=args['nsfw'],
+            enable_seo=args['seo'],
+            enable_moderation=args['moderation'],
+            enable_dedup=args['dedup'],
+            pipeline_mode=args['pipeline'],
+            num_workers=args['decode_workers'],
+            cascade_threshold=args['cascade_threshold'],
+        )
+
+def merge_journals(checkpoint_dir: str, output: str, columns) -> int:
+    """Stream the journaled rows into the output file (.csv, .jsonl, .json or .parquet), one per path.
+
+    An image retried on resume has several rows: a successful one beats errors, otherwise
+    the last one wins. The first pass only remembers which row that is, the second writes it.
+    """
+    from batch_processor import is_error_row
+    from result_writers import open_sink
+
+    best = {}
+    for n, row in enumerate(read_journals(checkpoint_dir)):
+        rank = (not is_error_row(row), n)
+        if rank > best.get(row['Path'], (False, -1)):
+            best[row['Path']] = rank
+
+    with open_sink(output, columns=columns) as sink:
+        batch = []
+        for n, row in enumerate(read_journals(checkpoint_dir)):
+            if best[row['Path']][1] != n:
+                continue
+            batch.append(row)
+            if len(batch) >= 1000:
+                sink.write_rows(batch)
+                batch = []
+        sink.write_rows(batch)
+    return sink.rows_written
+
+def parse_args(argv=None):
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    parser = argparse.ArgumentParser(description="Caption a ZIP/TAR archive, folder or glob with N worker processes")
+    parser.add_argument('source', help="ZIP or TAR archive, directory, or glob pattern")
+    parser.add_argument('--output', required=True, help="Results file (.csv, .jsonl, .json or .parquet)")
+    parser.add_argument('--model', default='BLIP Base', choices=['BLIP Base', 'BLIP Large', 'BLIP Cascade'],
+                        help="'BLIP Cascade' runs Base and re-captions low-confidence images with Large")
+    parser.add_argument('--cascade-threshold', type=float, default=None,
+                        help="Base confidence below which the cascade escalates (default: IMAGE2TEXT_CASCADE_THRESHOLD or 0.5)")
+    parser.add_argument('--backend', default=None, choices=['torch', 'onnx'],
+                        help="Caption model runtime (default: IMAGE2TEXT_BACKEND or torch)")
+    parser.add_argument('--precision', default=None, choices=['fp32', 'bf16', 'int8'],
+                        help="Caption model precision (default: IMAGE2TEXT_PRECISION or fp32)")
+    parser.add_argument('--weights', default=None, choices=['copy', 'mmap'],
+                        help="Read weights into each process, or memory-map them shared (default: IMAGE2TEXT_WEIGHTS or copy)")
+    parser.add_argument('--preload', action='store_true',
+                        help="Load the models once in the parent and fork the workers, sharing the weights")
+    parser.add_argument('--threads-per-worker', type=int, default=4, help="torch threads per worker process")
+    parser.add_argument('--workers', type=int, default=None, help="Worker processes (default: cores / threads per worker)")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--decode-workers', type=int, default=1, help="Decode threads per worker (pipeline mode)")
+    parser.add_argument('--checkpoint-dir', default=None, help="Journal directory (default: <output>.checkpoint)")
+    parser.add_argument('--no-pin-cores', dest='pin_cores', action='store_false', help="Don't set worker core affinity")
+    parser.add_argument('--no-nsfw', dest='nsfw', action='store_false')
+    parser.add_argument('--no-seo', dest='seo', action='store_false')
+    parser.add_argument('--moderation', action='store_true')
+    parser.add_argument('--dedup', action='store_true', help="Collapse near-duplicates (within each shard)")
+    parser.add_argument('--pipeline', action='store_true', help="Overlap decoding and inference inside each worker")
+    args = parser.parse_args(argv)
+
+    args.threads_per_worker = max(1, args.threads_per_worker)
+    args.workers = max(1, args.workers or cpus // args.threads_per_worker)
+    args.checkpoint_dir = args.checkpoint_dir or args.output + '.checkpoint'
+    args.precision = args.precision or os.environ.get('IMAGE2TEXT_PRECISION', 'fp32')
+    args.backend = args.backend or os.environ.get('IMAGE2TEXT_BACKEND', 'torch')
+    if args.preload and args.backend == 'onnx':
+        # ONNX Runtime sessions aren't safe to fork
+        parser.error("--preload needs the torch backend")
+    return args
+
+def _preload(args):
+    """Load the models the workers will use into this process, before forking them"""
+    # one thread, so no OpenMP pool exists when we fork; every worker sets its own count
+    import torch
+    torch.set_num_threads(1)
+    from shared_weights import preload_models
+    from utils import CASCADE_STAGES, load_models
+
+    load_models(precision=args.precision, backend=args.backend, weights=args.weights)
+    names = list(CASCADE_STAGES) if args.model == 'BLIP Cascade' else [args.model]
+    if args.nsfw:
+        names.append('nsfw_detector')
+    preload_models(names)
+
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.checkpoint_dir, exist_ok=True)
+
+    # resume: whatever is already journaled is skipped
+    from batch_processor import is_error_row
+    # images whose only rows are errors (decode or generation failures) are tried again
+    done = set()
+    retry = set()
+    for row in read_journals(args.checkpoint_dir):
+        (retry if is_error_row(row) else done).add(row['Path'])
+    retry -= done
+    if done or retry:
+        logger.info(f"Resuming: {len(done)} images already done, retrying {len(retry)} that failed")
+
+    logger.info(f"Starting {args.workers} workers x {args.threads_per_worker} threads on {args.source}")
+    started = time.perf_counter()
+
+    if args.preload:
+        # fork: workers inherit the parent's models instead of loading their own
+        _preload(args)
+        ctx = mp.get_context('fork')
+    else:
+        # spawn: every worker starts clean and loads its own models exactly once
+        ctx = mp.get_context('spawn')
+    settings = vars(args)
+    workers = []
+    for worker in range(args.workers):
+        shard_done = {name for name in done if shard_of(name, args.workers) == worker}
+        process = ctx.Process(target=_run_worker, args=(worker, settings, shard_done), name=f'caption-worker-{worker}')
+        process.start()
+        workers.append(process)
+
+    failed = 0
+    for process in workers:
+        process.join()
+        if process.exitcode != 0:
+            failed += 1
+            logger.error(f"{process.name} exited with code {process.exitcode}")
+
+    from batch_processor import result_columns
+    columns = ['Path'] + result_columns(enable_moderation=args.moderation, enable_dedup=args.dedup,
+                                        cascade=args.model == 'BLIP Cascade')
+    total = merge_journals(args.checkpoint_dir, args.output, columns)
+    logger.info(f"Wrote {total} rows to {args.output} in {time.perf_counter() - started:.1f}s")
+    if failed:
+        logger.error(f"{failed} workers failed; rerun the same command to resume")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,98 +1,591 @@
-import zipfile
+import logging
 import os
-import tempfile
-import pandas as pd
-from PIL import Image
-from utils import generate_caption, generate_seo_metadata, check_nsfw_image
+import queue
+import threading
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dedup import HASH_FUNCTIONS, DEFAULT_MAX_DISTANCE, NearDuplicateIndex
+from image_sources import iter_image_bytes, decode_image
+from metrics import export_metrics_file, get_metrics, span
+from preprocessing import BatchPreprocessor, resize_pyramid
+from result_cache import content_hash, get_result_cache
+from result_writers import MemorySink
+from seo import KeywordExtractor
+from utils import (generate_captions_batch, generate_captions_cascade, generate_seo_batch, check_nsfw_batch,
+                   moderate_batch, encode_captions, caption_model_id, model_input_specs, NSFW_MODEL,
+                   CASCADE_MODEL, input_tensor_type)
 
 # Setup logging
 from logging_config import get_logger
 logger = get_logger(__name__)
 
-def process_batch_images(zip_file, model_choice, models_dict, processor_dict, **kwargs):
+DEFAULT_BATCH_SIZE = 8
+NSFW_BLOCK_THRESHOLD = 0.9
+GENERATION_DEFAULTS = {'max_length': 50, 'num_beams': 3, 'temperature': 0.7}
 
-    logger.info(f"Starting batch processing using model: {model_choice}")
+IMAGES_TOTAL = "image2text_images_total"
+get_metrics().describe(IMAGES_TOTAL, 'counter', "Batch images written, by row status")
+
+# one image on its way through the stages; image/pixels are None when not decoded,
+# cached holds the result cache entries found for it, phash/seq/duplicate_of drive dedup,
+# name is the full path inside the source, pixels/nsfw_pixels the caption model's and the
+# NSFW detector's resized uint8 pixels, normalized batch-wise at inference time
+_Item = namedtuple('_Item', ['file', 'image', 'pixels', 'error', 'digest', 'cached',
+                             'phash', 'seq', 'duplicate_of', 'name', 'nsfw_pixels'],
+                   defaults=(None, None, None, None, None))
+_DONE = object()
+
+def _error_row(file, error):
+    return {
+        'File': file,
+        'Caption': '',
+        'Keywords': '',
+        'Meta Description': '',
+        'NSFW Score': 'N/A',
+        'Status': f'Error: {str(error)}'
+    }
+
+def _generation_params(kwargs):
+    return {name: kwargs.get(name, default) for name, default in GENERATION_DEFAULTS.items()}
+
+def _caption_key(cache, digest, model_choice, kwargs):
+    return cache.key(digest, caption_model_id(model_choice, kwargs.get('cascade_threshold')),
+                     **_generation_params(kwargs))
+
+def _is_error_caption(caption):
+    return caption.startswith("Generation error") or caption == "Model not supported"
+
+def is_error_row(row) -> bool:
+    """Whether a result row records a failure (decode, NSFW screening or caption generation)"""
+    return str(row.get('Status', '')).startswith('Error') or _is_error_caption(str(row.get('Caption', '')))
+
+def _cache_lookup(digest, model_choice, kwargs):
+    """Cached NSFW and caption entries for an image, and whether that is all we need"""
+    cache = kwargs.get('cache')
+    if cache is None:
+        return {}, False
+
+    cached = {'caption': cache.get(_caption_key(cache, digest, model_choice, kwargs))}
+    if kwargs.get('enable_nsfw_check', True):
+        cached['nsfw'] = cache.get(cache.key(digest, NSFW_MODEL))
+        nsfw_score = (cached['nsfw'] or {}).get('nsfw_score')
+        if nsfw_score is None:
+            return cached, False
+        if nsfw_score > NSFW_BLOCK_THRESHOLD:
+            return cached, True
 
-    results = []
+    return cached, (cached['caption'] or {}).get('caption') is not None
+
+def _screen_and_caption(batch, model_choice, models_dict, processor_dict, **kwargs):
+    """Inference stage: NSFW-screen a micro-batch and caption the survivors"""
+    rows = {}
+    captions = {}
+    answered_by = {}
+    confidence = {}
+    nsfw_scores = {}
     nsfw_blocked = 0
-    
-    #extract the zip to a temp folder.
-    logger.info("Extracting ZIP file...")
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        logger.info(f"ZIP extracted to temporary directory: {temp_dir}")
-        
-        # go through all the files we just extracted
-        for root, dirs, files in os.walk(temp_dir):
-            for file in files:
-                if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                    image_path = os.path.join(root, file)
-                    logger.info(f"Processing image: {file}")
-
-                    try:
-                        image = Image.open(image_path).convert('RGB')
-                        logger.debug(f"Image loaded: {image_path}")
-                        
-                        #check safety
-                        if kwargs.get('enable_nsfw_check', True):
-                            nsfw_score, nsfw_class = check_nsfw_image(image)
-                            logger.debug(f"NSFW score for {file}: {nsfw_score:.2f} ({nsfw_class})")
-
-                            # block anything too spicy
-                            if nsfw_score > 0.9:
-                                logger.warning(f"Image {file} blocked due to NSFW content.")
-
-                                results.append({
-                                    'File': file,
-                                    'Caption': '[BLOCKED] NSFW content detected',
-                                    'Keywords': '',
-                                    'Meta Description': '',
-                                    'NSFW Score': f'{nsfw_score:.1%}',
-                                    'Status': 'Blocked - NSFW'
-                                })
-                                nsfw_blocked += 1
-                                continue
-                        
-                        #   Generate the caption
-                        caption = generate_caption(
-                            image, model_choice, models_dict, processor_dict
-                        )
-                        logger.info(f"Caption generated for {file}: {caption}")
-                        
-                        # SEO if enabled
-                        if kwargs.get('enable_seo', True):
-                            keywords, meta_desc, _ = generate_seo_metadata(caption)
-                            logger.debug(f"SEO metadata for {file}: {keywords}, {meta_desc}")
-                        else:
-                            keywords, meta_desc = [], ""
-                        
-                        #results list
-                        results.append({
-                            'File': file,
-                            'Caption': caption,
-                            'Keywords': ', '.join(keywords),
-                            'Meta Description': meta_desc,
-                            'NSFW Score': f'{nsfw_score:.1%}' if kwargs.get('enable_nsfw_check', True) else 'N/A',
-                            'Status': 'Success'
-                        })
-                        logger.info(f"Image {file} processed successfully.")
-                    
-                    except Exception as e:
-                        logger.error(f"Error processing image {file}: {e}")
-
-                        results.append({
-                            'File': file,
-                            'Caption': '',
-                            'Keywords': '',
-                            'Meta Description': '',
-                            'NSFW Score': 'N/A',
-                            'Status': f'Error: {str(e)}'
-                        })
-    
+    batch_size = kwargs.get('batch_size', DEFAULT_BATCH_SIZE)
+    cache = kwargs.get('cache')
+
+    # images that failed to decode just get an error row, near-duplicates reuse their representative
+    for i, item in enumerate(batch):
+        if item.error is not None:
+            rows[i] = _error_row(item.file, item.error)
+    valid = [i for i, item in enumerate(batch) if item.error is None and item.duplicate_of is None]
+    survivors = valid
+
+    #check safety for the whole micro-batch at once, skipping what the cache already knows
+    if valid and kwargs.get('enable_nsfw_check', True):
+        nsfw_labels = {}
+        for i in valid:
+            entry = batch[i].cached.get('nsfw')
+            if entry and entry['nsfw_score'] is not None:
+                nsfw_scores[i], nsfw_labels[i] = entry['nsfw_score'], entry['nsfw_label']
+
+        to_screen = [i for i in valid if i not in nsfw_scores]
+        if to_screen:
+            # the detector's pixels were resized alongside the caption model's in the decode stage
+            scores, labels = check_nsfw_batch(
+                [batch[i].image for i in to_screen], batch_size=batch_size,
+                pixel_values=kwargs['job_inputs'].batch([batch[i].nsfw_pixels for i in to_screen], 'nsfw')
+            )
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("NSFW scores: %s", dict(zip((batch[i].file for i in to_screen), scores.round(2))))
+            for i, score, label in zip(to_screen, scores.tolist(), labels.tolist()):
+                nsfw_scores[i], nsfw_labels[i] = score, label
+                if cache is not None and label not in ("error", "Model not available"):
+                    cache.put(cache.key(batch[i].digest, NSFW_MODEL), nsfw_score=score, nsfw_label=label)
+
+        # block anything too spicy
+        scores = np.array([nsfw_scores[i] for i in valid], dtype=np.float32)
+        blocked = scores > NSFW_BLOCK_THRESHOLD
+        for j in np.flatnonzero(blocked).tolist():
+            i = valid[j]
+            file = batch[i].file
+            logger.warning(f"Image {file} blocked due to NSFW content ({nsfw_labels[i]}).")
+            rows[i] = {
+                'File': file,
+                'Caption': '[BLOCKED] NSFW content detected',
+                'Keywords': '',
+                'Meta Description': '',
+                'NSFW Score': f'{scores[j]:.1%}',
+                'Status': 'Blocked - NSFW'
+            }
+        nsfw_blocked = int(blocked.sum())
+        # only the survivors go on to captioning
+        survivors = [valid[j] for j in np.flatnonzero(~blocked).tolist()]
+
+    # cached captions need no model call
+    for i in survivors:
+        entry = batch[i].cached.get('caption')
+        if entry and entry['caption'] is not None:
+            captions[i] = entry['caption']
+            # which cascade stage answered, for entries written since that was stored
+            if entry.get('caption_model'):
+                answered_by[i] = entry['caption_model']
+            if entry.get('caption_confidence') is not None:
+                confidence[i] = entry['caption_confidence']
+    to_caption = [i for i in survivors if i not in captions]
+
+    #   Generate the captions, one generate call for the whole micro-batch
+    if to_caption:
+        # reuse the pixels prepared by the decode stage when we have them
+        images = [batch[i].image for i in to_caption]
+        pixel_values = kwargs['job_inputs'].batch([batch[i].pixels for i in to_caption], 'caption')
+        if model_choice == CASCADE_MODEL:
+            generated, models, scores = generate_captions_cascade(
+                images, models_dict, processor_dict, batch_size=batch_size, pixel_values=pixel_values,
+                threshold=kwargs.get('cascade_threshold'), **_generation_params(kwargs)
+            )
+            answered_by.update(zip(to_caption, models))
+            confidence.update(zip(to_caption, scores.tolist()))
+        else:
+            generated = generate_captions_batch(
+                images, model_choice, models_dict, processor_dict,
+                batch_size=batch_size, pixel_values=pixel_values, **_generation_params(kwargs)
+            )
+        for i, caption in zip(to_caption, generated):
+            captions[i] = caption
+            if cache is not None and not _is_error_caption(caption):
+                cache.put(_caption_key(cache, batch[i].digest, model_choice, kwargs), caption=caption,
+                          caption_model=answered_by.get(i), caption_confidence=confidence.get(i))
+
+    return {'rows': rows, 'captions': captions, 'nsfw_scores': nsfw_scores, 'blocked': nsfw_blocked,
+            'answered_by': answered_by, 'confidence': confidence}
+
+def _rescore_keywords(rows, extractor):
+    """Second SEO pass over rows still in memory: keywords against the whole job's corpus"""
+    scored = [row for row in rows if row.get('Status') == 'Success' and row.get('Caption')
+              and not _is_error_caption(row['Caption'])]
+    if not scored:
+        return
+    with span('seo', len(scored)):
+        keywords = extractor.keywords([row['Caption'] for row in scored])
+    for row, row_keywords in zip(scored, keywords):
+        row['Keywords'] = ', '.join(row_keywords)
+
+def _fanout_entry(row, layouts):
+    """What a representative's near-duplicates copy: its file and its result values.
+
+    One is kept per group for the whole job, so no row dict: the column names are a tuple
+    shared by every row with the same layout, the values a tuple of their own.
+    """
+    columns = tuple(name for name in row if name not in ('File', 'Duplicate Of'))
+    columns = layouts.setdefault(columns, columns)
+    return row['File'], columns, tuple(row[name] for name in columns)
+
+def _finish_rows(batch, inferred, model_choice, **kwargs):
+    """Post-processing stage: SEO and moderation for the captioned images, rows in input order"""
+    rows = dict(inferred['rows'])
+
+    # SEO for the whole micro-batch at once, keywords weighted against everything the job has captioned so far
+    seo = {}
+    if kwargs.get('enable_seo', True) and inferred['captions']:
+        indices = list(inferred['captions'])
+        results = generate_seo_batch([inferred['captions'][i] for i in indices], extractor=kwargs.get('seo_extractor'))
+        seo = dict(zip(indices, results))
+
+    # moderation only adds a column when asked for, scored for the whole micro-batch at once
+    toxicity = {}
+    if kwargs.get('enable_moderation', False) and inferred['captions']:
+        indices = list(inferred['captions'])
+        scores = moderate_batch([inferred['captions'][i] for i in indices])
+        toxicity = dict(zip(indices, scores.astype(np.float64).round(2).tolist()))
+
+    for i, caption in inferred['captions'].items():
+        file = batch[i].file
+        try:
+            logger.debug("Caption generated for %s: %s", file, caption)
+
+            keywords, meta_desc = seo.get(i, ([], ""))
+            logger.debug("SEO metadata for %s: %s, %s", file, keywords, meta_desc)
+
+            rows[i] = {
+                'File': file,
+                'Caption': caption,
+                'Keywords': ', '.join(keywords),
+                'Meta Description': meta_desc,
+                'NSFW Score': f'{inferred["nsfw_scores"][i]:.1%}' if i in inferred['nsfw_scores'] else 'N/A',
+                'Status': 'Success'
+            }
+
+            if i in toxicity:
+                rows[i]['Toxicity Score'] = toxicity[i]
+            if kwargs.get('cascade_counts') is not None:
+                # only cache entries from before the stage was stored don't know it
+                answered_by = inferred['answered_by'].get(i, 'cached')
+                rows[i]['Caption Model'] = answered_by
+                rows[i]['Caption Confidence'] = round(inferred['confidence'][i], 3) if i in inferred['confidence'] else ''
+                kwargs['cascade_counts'][answered_by] += 1
+            logger.debug("Image %s processed successfully.", file)
+
+        except Exception as e:
+            logger.error(f"Error processing image {file}: {e}")
+            rows[i] = _error_row(file, e)
+
+    # embed the new captions into the similarity index, if the job has one
+    caption_index = kwargs.get('caption_index')
+    if caption_index is not None:
+        indexed = [i for i in inferred['captions'] if rows[i]['Status'] == 'Success'
+                   and not _is_error_caption(rows[i]['Caption'])]
+        if indexed:
+            try:
+                embeddings = encode_captions([rows[i]['Caption'] for i in indexed], kwargs['caption_models'])
+                caption_index.add([batch[i].name for i in indexed], [rows[i]['Caption'] for i in indexed], embeddings)
+            except Exception as e:
+                logger.error(f"Could not index captions: {e}")
+
+    # fan the representatives' results out to their near-duplicates
+    dedup_rows = kwargs.get('dedup_rows')
+    if dedup_rows is not None:
+        for i, item in enumerate(batch):
+            if item.duplicate_of is None:
+                if i in rows:
+                    rows[i]['Duplicate Of'] = ''
+                    if item.phash is not None:
+                        dedup_rows[item.seq] = _fanout_entry(rows[i], kwargs['dedup_layouts'])
+        for i, item in enumerate(batch):
+            if item.duplicate_of is not None:
+                file, columns, values = dedup_rows[item.duplicate_of]
+                rows[i] = {'File': item.file, **dict(zip(columns, values)), 'Duplicate Of': file}
+
+    return [rows[i] for i in range(len(batch))]
+
+def _assign_group(item, seq, kwargs):
+    """Number an item in stream order and link it to its near-duplicate representative, if any"""
+    item = item._replace(seq=seq)
+    index = kwargs.get('dedup_index')
+    if index is None or item.phash is None:
+        return item
+    representative = index.assign(item.phash, seq)
+    if representative is None:
+        return item
+    logger.debug("Image %s is a near-duplicate, reusing the result of image #%s", item.file, representative)
+    # the pixels are no longer needed, let them go
+    return item._replace(image=None, pixels=None, nsfw_pixels=None, duplicate_of=representative)
+
+class _JobInputs:
+    """Model input state of one job: the input specs, looked up on the first decode, and a
+    reusable BatchPreprocessor per input. One instance is made per job and travels in kwargs;
+    the stages get shallow copies of kwargs, so nothing per job may be added to kwargs later."""
+
+    def __init__(self, model_choice, processor_dict, include_nsfw: bool, batch_size: int):
+        self.model_choice = model_choice
+        self.processor_dict = processor_dict
+        self.include_nsfw = include_nsfw
+        self.batch_size = batch_size
+        self.batchers = {}      # input name -> BatchPreprocessor, only used by the inference thread
+        self._specs = None
+        self._lock = threading.Lock()
+
+    def specs(self):
+        """Input sizes/normalization of the caption model and NSFW detector, looked up once"""
+        with self._lock:
+            if self._specs is None:
+                self._specs = model_input_specs(self.model_choice, self.processor_dict,
+                                                include_nsfw=self.include_nsfw)
+            return self._specs
+
+    def batch(self, batch_pixels, name):
+        """Normalized (N, 3, H, W) model input from the items' pixels, in the job's reusable buffer;
+        None when an item has none (the model then preprocesses the images itself)"""
+        if not batch_pixels or any(p is None for p in batch_pixels):
+            return None
+        if name not in self.batchers:
+            self.batchers[name] = BatchPreprocessor(self.specs()[name], self.batch_size,
+                                                    return_tensors=input_tensor_type(name))
+        return self.batchers[name].fill(batch_pixels)
+
+def _decode_and_preprocess(data, kwargs):
+    """Decode once and build every model's input tensor from the same resize pyramid"""
+    image = decode_image(data)
+    inputs = resize_pyramid(image, kwargs['job_inputs'].specs())
+    hash_fn = kwargs.get('dedup_hash_fn')
+    return image, inputs, hash_fn(image) if hash_fn else None
+
+def _put(q, item, stop):
+    """Blocking put that gives up once the pipeline is shutting down"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _iter_decoded(source, model_choice, num_workers, queue_size, kwargs):
+    """Decode/preprocess stage: a thread pool behind a bounded queue, yielding items in input order"""
+    decoded = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='decode') as pool:
+        def produce():
+            try:
+                for name, data in iter_image_bytes(source, kwargs.get('select')):
+                    digest = content_hash(data)
+                    cached, resolved = _cache_lookup(digest, model_choice, kwargs)
+                    # fully cached images are never decoded
+                    future = None if resolved else pool.submit(_decode_and_preprocess, data, kwargs)
+                    # blocks while the queue is full, which is what keeps memory flat
+                    if not _put(decoded, (name, digest, cached, future), stop):
+                        if future is not None:
+                            future.cancel()
+                        return
+            except Exception as e:
+                _put(decoded, (None, None, None, e), stop)
+            finally:
+                _put(decoded, _DONE, stop)
+
+        producer = threading.Thread(target=produce, name='decode-feeder', daemon=True)
+        producer.start()
+        try:
+            while True:
+                item = decoded.get()
+                if item is _DONE:
+                    break
+                name, digest, cached, future = item
+                if name is None:
+                    raise future
+
+                file = os.path.basename(name)
+                if future is None:
+                    logger.debug("Cache hit: %s", name)
+                    yield _Item(file, None, None, None, digest, cached, name=name)
+                    continue
+                try:
+                    image, inputs, phash = future.result()
+                    logger.debug("Image loaded: %s", name)
+                    yield _Item(file, image, inputs['caption'], None, digest, cached, phash, name=name,
+                                nsfw_pixels=inputs.get('nsfw'))
+                except Exception as e:
+                    logger.error(f"Error processing image {file}: {e}")
+                    yield _Item(file, None, None, e, digest, cached, name=name)
+        finally:
+            stop.set()
+            producer.join()
+
+def _iter_sequential(source, model_choice, kwargs):
+    for name, data in iter_image_bytes(source, kwargs.get('select')):
+        file = os.path.basename(name)
+        logger.debug("Processing image: %s", name)
+        digest = content_hash(data)
+        cached, resolved = _cache_lookup(digest, model_choice, kwargs)
+        if resolved:
+            logger.debug("Cache hit: %s", name)
+            yield _Item(file, None, None, None, digest, cached, name=name)
+            continue
+        try:
+            image, inputs, phash = _decode_and_preprocess(data, kwargs)
+            logger.debug("Image loaded: %s", name)
+            yield _Item(file, image, inputs['caption'], None, digest, cached, phash, name=name,
+                        nsfw_pixels=inputs.get('nsfw'))
+        except Exception as e:
+            logger.error(f"Error processing image {file}: {e}")
+            yield _Item(file, None, None, e, digest, cached, name=name)
+
+def result_columns(**kwargs) -> list:
+    """Output columns of process_batch_images for a given set of options"""
+    columns = ['File', 'Caption', 'Keywords', 'Meta Description', 'NSFW Score', 'Status']
+    if kwargs.get('enable_moderation', False):
+        columns.append('Toxicity Score')
+    if kwargs.get('enable_dedup', False):
+        columns.append('Duplicate Of')
+    if kwargs.get('cascade', False):
+        columns.extend(['Caption Model', 'Caption Confidence'])
+    return columns
+
+def _emit(batch, rows, kwargs):
+    """Write finished rows to the sink and hand them to the `on_rows(names, rows)` callback, if any"""
+    kwargs['sink'].write_rows(rows)
+    # 'Error: <message>' counts as plain 'Error', one series per kind of outcome
+    for status, count in Counter(row['Status'].split(':', 1)[0] for row in rows).items():
+        get_metrics().inc(IMAGES_TOTAL, count, status=status)
+    on_rows = kwargs.get('on_rows')
+    if on_rows is not None:
+        on_rows([item.name for item in batch], rows)
+
+def _run_sequential(items, model_choice, models_dict, processor_dict, **kwargs):
+    nsfw_blocked = 0
+    batch = []
+
+    def flush():
+        nonlocal nsfw_blocked
+        inferred = _screen_and_caption(batch, model_choice, models_dict, processor_dict, **kwargs)
+        _emit(batch, _finish_rows(batch, inferred, model_choice, **kwargs), kwargs)
+        nsfw_blocked += inferred['blocked']
+
+    for seq, item in enumerate(items):
+        batch.append(_assign_group(item, seq, kwargs))
+        # flush a full micro-batch through the models
+        if len(batch) >= kwargs['batch_size']:
+            flush()
+            batch = []
+
+    # whatever is left over
+    if batch:
+        flush()
+    return nsfw_blocked
+
+def _run_pipelined(items, model_choice, models_dict, processor_dict, **kwargs):
+    nsfw_blocked = 0
+    finished = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    post_errors = []
+
+    def post_process():
+        while True:
+            item = finished.get()
+            if item is _DONE:
+                return
+            try:
+                _emit(item[0], _finish_rows(*item, model_choice, **kwargs), kwargs)
+            except Exception as e:
+                post_errors.append(e)
+                stop.set()
+                return
+
+    post = threading.Thread(target=post_process, name='postprocess', daemon=True)
+    post.start()
+    try:
+        batch = []
+        for seq, item in enumerate(items):
+            batch.append(_assign_group(item, seq, kwargs))
+            if len(batch) >= kwargs['batch_size']:
+                inferred = _screen_and_caption(batch, model_choice, models_dict, processor_dict, **kwargs)
+                nsfw_blocked += inferred['blocked']
+                if not _put(finished, (batch, inferred), stop):
+                    break
+                batch = []
+
+        if batch and not stop.is_set():
+            inferred = _screen_and_caption(batch, model_choice, models_dict, processor_dict, **kwargs)
+            nsfw_blocked += inferred['blocked']
+            _put(finished, (batch, inferred), stop)
+    finally:
+        # the sentinel must get through even on errors, or the post thread never exits
+        if not stop.is_set():
+            finished.put(_DONE)
+        post.join()
+
+    if post_errors:
+        raise post_errors[0]
+    return nsfw_blocked
+
+def process_batch_images(source, model_choice, models_dict, processor_dict, **kwargs):
+    """Caption every image in `source` (ZIP or tar archive, directory or glob).
+
+    With `pipeline_mode=True`, decoding and preprocessing run on a thread pool
+    (`num_workers`) feeding a bounded queue (`queue_size`) in front of inference,
+    and SEO/moderation run on their own post-processing thread.
+
+    Results are looked up in the persistent result cache first (`use_cache=False`
+    turns that off, `cache=` passes a specific ResultCache).
+
+    `select(name)` skips images before they are read, and `on_rows(names, rows)` is
+    called with each finished micro-batch, in input order.
+
+    Rows go to `sink` (a result_writers.ResultSink, e.g. `open_sink('out.jsonl')`) as
+    they finish; the sink is closed at the end and its result() returned. Without one,
+    rows are kept in memory and a DataFrame is returned.
+
+    With `enable_dedup=True`, near-duplicate images (perceptual hash `dedup_hash`,
+    'dhash' or 'phash', within `dedup_threshold` bits) are captioned once and the
+    representative's result is copied to every member of the group.
+
+    SEO keywords are TF-IDF scored against every caption the job has seen so far, so
+    the first micro-batches are scored against a small corpus and keywords depend on
+    input order and batch size. Rows kept in memory (no `sink`) are rescored against
+    the whole job's corpus at the end (`seo_two_pass=False` skips that); streamed rows
+    can't be, they are already written.
+
+    With `caption_index=` (a caption_index.CaptionIndex), every successful caption is
+    embedded and appended to the index for similarity search.
+
+    With `model_choice=CASCADE_MODEL`, BLIP Base captions everything and BLIP Large
+    re-captions the images Base is less confident about than `cascade_threshold`;
+    rows then say which model answered and how confident Base was.
+    """
+
+    logger.info(f"Starting batch processing using model: {model_choice}")
+    kwargs['batch_size'] = max(1, int(kwargs.get('batch_size', DEFAULT_BATCH_SIZE)))
+    if kwargs.get('cache') is None:
+        kwargs['cache'] = get_result_cache() if kwargs.get('use_cache', True) else None
+    if kwargs.get('enable_dedup', False):
+        kwargs['dedup_hash_fn'] = HASH_FUNCTIONS[kwargs.get('dedup_hash', 'dhash')]
+        kwargs['dedup_index'] = NearDuplicateIndex(kwargs.get('dedup_threshold', DEFAULT_MAX_DISTANCE))
+        kwargs['dedup_rows'] = {}
+        kwargs['dedup_layouts'] = {}
+    if kwargs.get('enable_seo', True):
+        # document frequencies accumulate over the whole job
+        kwargs['seo_extractor'] = KeywordExtractor()
+    if kwargs.get('caption_index') is not None:
+        kwargs['caption_models'] = models_dict
+    kwargs['job_inputs'] = _JobInputs(model_choice, processor_dict, kwargs.get('enable_nsfw_check', True),
+                                      kwargs['batch_size'])
+    kwargs['cascade'] = model_choice == CASCADE_MODEL
+    if kwargs['cascade']:
+        kwargs['cascade_counts'] = Counter()
+    if kwargs.get('sink') is None:
+        kwargs['sink'] = MemorySink()
+    if kwargs['sink'].columns is None:
+        kwargs['sink'].columns = result_columns(**kwargs)
+
+    two_pass = kwargs.get('enable_seo', True) and isinstance(kwargs['sink'], MemorySink) \
+        and kwargs.get('seo_two_pass', True)
+
+    # images are decoded straight from the archive members, nothing is extracted to disk
+    try:
+        if kwargs.get('pipeline_mode', False):
+            num_workers = max(1, int(kwargs.get('num_workers') or min(4, os.cpu_count() or 1)))
+            queue_size = max(1, int(kwargs.get('queue_size') or 2 * kwargs['batch_size']))
+            logger.info(f"Pipeline mode: {num_workers} decode workers, queue size {queue_size}")
+            items = _iter_decoded(source, model_choice, num_workers, queue_size, kwargs)
+            try:
+                nsfw_blocked = _run_pipelined(items, model_choice, models_dict, processor_dict, **kwargs)
+            finally:
+                # shuts the decode pool down even when inference failed part way
+                items.close()
+        else:
+            items = _iter_sequential(source, model_choice, kwargs)
+            nsfw_blocked = _run_sequential(items, model_choice, models_dict, processor_dict, **kwargs)
+        if two_pass:
+            _rescore_keywords(kwargs['sink'].rows, kwargs['seo_extractor'])
+    finally:
+        # whatever made it out is finalized, even if the job died part way
+        kwargs['sink'].close()
+
     #let us know if we blocked any naughty images
     if nsfw_blocked > 0:
         logger.warning(f"Blocked {nsfw_blocked} NSFW images during processing")
-    
-    logger.info("Batch processing completed.")
-    return pd.DataFrame(results)
\ No newline at end of file
+    if kwargs.get('dedup_index') is not None:
+        index = kwargs['dedup_index']
+        logger.info(f"Collapsed {index.duplicates} near-duplicates into {index.groups} groups")
+    if kwargs['cache'] is not None:
+        logger.info(f"Result cache: {kwargs['cache'].stats()}")
+    if kwargs['cascade']:
+        logger.info(f"Cascade: captions answered by {dict(kwargs['cascade_counts'])}")
+
+    logger.info(f"Batch processing completed: {kwargs['sink'].rows_written} rows.")
+    export_metrics_file()
+    return kwargs['sink'].result()
@@ -0,0 +1,367 @@
+"""Offline benchmarks for every pipeline stage, on tiny random models and synthetic images.
+
+    python benchmark.py --images 64 --size 1024x768 --output bench.json
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --output bench.json --baseline baseline.json --threshold 0.15
+
+Nothing is downloaded: BLIP Base/Large and the NSFW ViT are built from small configs
+with fixed seeds and registered in place of the real checkpoints, so the numbers track
+the pipeline code (decode, preprocessing, batching, generation loop, SEO, moderation)
+rather than the weights. Per-stage latency percentiles, images/s, end-to-end throughput
+of process_batch_images, cold start and peak RSS go to JSON; with --baseline the run
+exits 1 if any of them got worse by more than --threshold.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, List
+
+# never reach for the hub, everything here is built locally
+os.environ.setdefault('HF_HUB_OFFLINE', '1')
+os.environ.setdefault('TRANSFORMERS_OFFLINE', '1')
+
+import numpy as np
+from PIL import Image
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# real words, so the random captions give SEO and moderation something to chew on
+CAPTION_WORDS = (
+    'a an the of on in with and at by near two three man woman dog cat car street beach city sky water tree '
+    'mountain table people group sitting standing walking red blue green white black large small old young '
+    'photo view sunset building road field house boat train bird horse child food plate window room light'
+).split()
+SPECIAL_TOKENS = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', '[DEC]']
+
+# bigger is better for these, smaller for every other compared metric
+HIGHER_IS_BETTER = ('images_per_s',)
+COMPARED_METRICS = ('p50_ms', 'p90_ms', 'images_per_s', 'cold_start_s', 'import_s', 'peak_rss_mb')
+
+def _tokenizer(directory: str, vocab_size: int):
+    from transformers import BertTokenizer
+
+    words = SPECIAL_TOKENS + CAPTION_WORDS
+    words += [f'thing{i}' for i in range(max(0, vocab_size - len(words)))]
+    path = os.path.join(directory, 'vocab.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(words) + '\n')
+    return BertTokenizer(path)
+
+def _tiny_blip(tokenizer, seed: int, hidden: int, layers: int, image_size: int):
+    import torch
+    from transformers import BlipConfig, BlipForConditionalGeneration, BlipImageProcessor, BlipProcessor
+
+    vocab = tokenizer.vocab
+    config = BlipConfig(
+        vision_config=dict(hidden_size=hidden, intermediate_size=4 * hidden, num_hidden_layers=layers,
+                           num_attention_heads=4, image_size=image_size, patch_size=16),
+        text_config=dict(vocab_size=len(vocab), hidden_size=hidden, intermediate_size=4 * hidden,
+                         num_hidden_layers=layers, num_attention_heads=4, encoder_hidden_size=hidden,
+                         max_position_embeddings=128, bos_token_id=vocab['[DEC]'],
+                         sep_token_id=vocab['[SEP]'], pad_token_id=vocab['[PAD]']),
+    )
+    torch.manual_seed(seed)
+    model = BlipForConditionalGeneration(config).eval()
+    model.precision = 'fp32'
+    processor = BlipProcessor(BlipImageProcessor(size={'height': image_size, 'width': image_size}), tokenizer)
+    return model, processor
+
+def _tiny_nsfw(seed: int, hidden: int):
+    import torch
+    from transformers import ViTConfig, ViTForImageClassification, ViTImageProcessor, pipeline
+
+    config = ViTConfig(hidden_size=hidden, intermediate_size=4 * hidden, num_hidden_layers=2, num_attention_heads=4,
+                       image_size=224, patch_size=16, num_labels=2,
+                       id2label={0: 'normal', 1: 'nsfw'}, label2id={'normal': 0, 'nsfw': 1})
+    torch.manual_seed(seed)
+    model = ViTForImageClassification(config).eval()
+    return pipeline('image-classification', model=model,
+                    image_processor=ViTImageProcessor(size={'height': 224, 'width': 224})), None
+
+def register_tiny_models(directory: str, seed: int = 0, image_size: int = 384):
+    """Register tiny random stand-ins under the real model names, before anything calls load_models"""
+    from model_registry import get_registry
+
+    tokenizer = _tokenizer(directory, vocab_size=1024)
+    registry = get_registry()
+    registry.register("BLIP Base", lambda: _tiny_blip(tokenizer, seed, hidden=64, layers=2, image_size=image_size))
+    registry.register("BLIP Large", lambda: _tiny_blip(tokenizer, seed + 1, hidden=128, layers=4, image_size=image_size))
+    registry.register("nsfw_detector", lambda: _tiny_nsfw(seed + 2, hidden=64))
+
+def synthetic_jpeg(rng: np.random.Generator, width: int, height: int, quality: int = 90) -> bytes:
+    """A photo-like JPEG: smooth colour gradients plus noise, so it compresses like a real picture"""
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    slope = rng.uniform(-1, 1, (2, 3)) * 255 / max(width, height)
+    pixels = rng.uniform(0, 255, 3) + x[..., None] * slope[0] + y[..., None] * slope[1]
+    pixels += rng.normal(0, 12, (height, width, 3))
+    buffer = io.BytesIO()
+    Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def synthetic_zip(path: str, images: List[bytes]) -> str:
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:
+        for i, data in enumerate(images):
+            zf.writestr(f'images/img_{i:05d}.jpg', data)
+    return path
+
+class StageTimer:
+    """Wall-clock samples per stage, with how many images each call covered"""
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.images = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str, images: int = 1):
+        started = time.perf_counter()
+        yield
+        self.samples[name].append(time.perf_counter() - started)
+        self.images[name] += images
+
+    def summary(self) -> Dict[str, Dict]:
+        report = {}
+        for name, samples in self.samples.items():
+            ms = np.array(samples) * 1000
+            report[name] = {
+                'calls': len(ms),
+                'images_per_call': round(self.images[name] / len(ms), 2),
+                'mean_ms': round(float(ms.mean()), 3),
+                'p50_ms': round(float(np.percentile(ms, 50)), 3),
+                'p90_ms': round(float(np.percentile(ms, 90)), 3),
+                'p99_ms': round(float(np.percentile(ms, 99)), 3),
+                'images_per_s': round(float(self.images[name] / max(ms.sum() / 1000, 1e-9)), 2),
+            }
+        return report
+
+def _run_stages(jpegs: List[bytes], timer: StageTimer, models_dict, processor_dict, args):
+    """Each stage on its own, micro-batch by micro-batch, the way batch_processor chains them"""
+    from image_sources import decode_image
+    from preprocessing import BatchPreprocessor, resize_pyramid
+    from utils import (check_nsfw_batch, generate_caption, generate_captions_batch, generate_seo_batch,
+                       model_input_specs, moderate_batch)
+
+    model = "BLIP Base"
+    specs = model_input_specs(model, processor_dict)
+    batchers = {name: BatchPreprocessor(spec, args.batch_size) for name, spec in specs.items()}
+    generation = {'max_length': args.max_length, 'num_beams': args.num_beams, 'temperature': 0.7}
+
+    for start in range(0, len(jpegs), args.batch_size):
+        chunk = jpegs[start:start + args.batch_size]
+        images = []
+        for data in chunk:
+            with timer.stage('decode'):
+                images.append(decode_image(data))
+        with timer.stage('preprocess', len(chunk)):
+            levels = [resize_pyramid(image, specs) for image in images]
+            nsfw_pixels = batchers['nsfw'].fill([level['nsfw'] for level in levels])
+            caption_pixels = batchers['caption'].fill([level['caption'] for level in levels])
+        with timer.stage('nsfw', len(chunk)):
+            check_nsfw_batch(images, batch_size=args.batch_size, pixel_values=nsfw_pixels)
+        with timer.stage('generate', len(chunk)):
+            captions = generate_captions_batch(images, model, models_dict, processor_dict, batch_size=args.batch_size,
+                                               pixel_values=caption_pixels, **generation)
+        with timer.stage('seo', len(chunk)):
+            generate_seo_batch(captions)
+        with timer.stage('moderation', len(chunk)):
+            moderate_batch(captions)
+
+    # the single-image path the Streamlit app takes, no embedding cache
+    for data in jpegs[:args.batch_size]:
+        image = decode_image(data)
+        with timer.stage('generate_single'):
+            generate_caption(image, model, models_dict, processor_dict, **generation)
+
+def _end_to_end(zip_path: str, n: int, models_dict, processor_dict, args) -> Dict[str, Dict]:
+    from batch_processor import is_error_row, process_batch_images
+    from result_writers import NullSink
+
+    report = {}
+    for mode, pipeline_mode in (('sequential', False), ('pipelined', True)):
+        errors = []
+        started = time.perf_counter()
+        process_batch_images(zip_path, "BLIP Base", models_dict, processor_dict, use_cache=False,
+                             batch_size=args.batch_size, pipeline_mode=pipeline_mode, sink=NullSink(),
+                             on_rows=lambda names, rows: errors.extend(row for row in rows if is_error_row(row)),
+                             max_length=args.max_length, num_beams=args.num_beams)
+        elapsed = time.perf_counter() - started
+        if errors:
+            # a run that fails fast would look like a speed-up
+            logger.error(f"End-to-end {mode}: {len(errors)} of {n} images failed, e.g. {errors[0]['Status']}")
+        report[mode] = {'seconds': round(elapsed, 3), 'images_per_s': round(n / elapsed, 2), 'errors': len(errors)}
+    return report
+
+def _cold_start_child(args):
+    """Runs in a fresh interpreter: import, load the models, caption one image, timing each stage"""
+    started = time.perf_counter()
+    # the app's own modules import without torch, which is timed separately
+    from utils import generate_caption, load_models
+    imported = time.perf_counter()
+    import torch
+    torch.set_num_threads(args.threads)
+    torch_imported = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        register_tiny_models(directory, args.seed)
+        models_dict, processor_dict = load_models()
+        image = Image.open(io.BytesIO(synthetic_jpeg(np.random.default_rng(args.seed), 640, 480))).convert('RGB')
+        setup_done = time.perf_counter()
+        models_dict["BLIP Base"]
+        loaded = time.perf_counter()
+        generate_caption(image, "BLIP Base", models_dict, processor_dict, max_length=args.max_length,
+                         num_beams=args.num_beams)
+    done = time.perf_counter()
+    print(json.dumps({'import_s': round(imported - started, 3), 'torch_import_s': round(torch_imported - imported, 3),
+                      'load_s': round(loaded - setup_done, 3), 'first_caption_s': round(done - loaded, 3)}))
+
+def _cold_start(args) -> Dict:
+    started = time.perf_counter()
+    out = subprocess.run([sys.executable, os.path.abspath(__file__), '--cold-start-child',
+                          '--threads', str(args.threads), '--seed', str(args.seed),
+                          '--max-length', str(args.max_length), '--num-beams', str(args.num_beams)],
+                         capture_output=True, text=True, check=True)
+    report = json.loads(out.stdout.strip().splitlines()[-1])
+    report['cold_start_s'] = round(time.perf_counter() - started, 3)
+    # ru_maxrss is in KB on Linux
+    report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1)
+    return report
+
+def _environment(args) -> Dict:
+    import torch
+    import transformers
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'torch': torch.__version__,
+        'transformers': transformers.__version__,
+        'config': {name: getattr(args, name) for name in
+                   ('images', 'size', 'batch_size', 'repeat', 'seed', 'threads', 'max_length', 'num_beams')},
+    }
+
+def run_benchmarks(args) -> Dict:
+    import torch
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    width, height = (int(v) for v in args.size.lower().split('x'))
+
+    with tempfile.TemporaryDirectory(prefix='image2text-bench-') as directory:
+        register_tiny_models(directory, args.seed)
+        from utils import load_models
+        models_dict, processor_dict = load_models()
+
+        rng = np.random.default_rng(args.seed)
+        jpegs = [synthetic_jpeg(rng, width, height) for _ in range(args.images)]
+        logger.info(f"{args.images} synthetic {width}x{height} JPEGs, {sum(map(len, jpegs)) / 1024 ** 2:.1f} MB")
+
+        # loads the models and fills the allocator before anything is timed
+        for _ in range(args.warmup):
+            _run_stages(jpegs[:args.batch_size], StageTimer(), models_dict, processor_dict, args)
+        timer = StageTimer()
+        for _ in range(args.repeat):
+            _run_stages(jpegs, timer, models_dict, processor_dict, args)
+        results = {'environment': _environment(args), 'stages': timer.summary()}
+
+        if args.end_to_end:
+            zip_path = synthetic_zip(os.path.join(directory, 'images.zip'), jpegs)
+            results['end_to_end'] = _end_to_end(zip_path, len(jpegs), models_dict, processor_dict, args)
+
+    results['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    if args.cold_start:
+        results['cold_start'] = _cold_start(args)
+    return results
+
+def _flatten(results: Dict, prefix: str = '') -> Dict[str, float]:
+    flat = {}
+    for key, value in results.items():
+        if key == 'environment':
+            continue
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and key in COMPARED_METRICS:
+            flat[name] = float(value)
+    return flat
+
+def compare(results: Dict, baseline: Dict, threshold: float = 0.10) -> List[str]:
+    """Metrics that got worse than the baseline by more than `threshold` (a fraction)"""
+    current, reference = _flatten(results), _flatten(baseline)
+    regressions = []
+    for name, value in sorted(current.items()):
+        old = reference.get(name)
+        if not old:
+            continue
+        change = (value - old) / old
+        worse = -change if name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER else change
+        if worse > threshold:
+            regressions.append(f"{name}: {old:g} -> {value:g} ({change:+.1%})")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline per-stage benchmarks on tiny random models")
+    parser.add_argument('--images', type=int, default=32, help="Synthetic images per pass")
+    parser.add_argument('--size', default='1024x768', help="Synthetic image size, WIDTHxHEIGHT")
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3, help="Timed passes over the images")
+    parser.add_argument('--warmup', type=int, default=1, help="Untimed passes first")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--threads', type=int, default=2, help="torch intra-op threads (fixed for comparable runs)")
+    parser.add_argument('--max-length', type=int, default=30)
+    parser.add_argument('--num-beams', type=int, default=3)
+    parser.add_argument('--no-end-to-end', dest='end_to_end', action='store_false')
+    parser.add_argument('--no-cold-start', dest='cold_start', action='store_false')
+    parser.add_argument('--output', default=None, help="Write the results here (JSON)")
+    parser.add_argument('--save-baseline', default=None, help="Write the results here as the new baseline")
+    parser.add_argument('--baseline', default=None, help="Compare against this earlier result")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Allowed slowdown before failing, e.g. 0.10")
+    parser.add_argument('--cold-start-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.cold_start_child:
+        _cold_start_child(args)
+        return 0
+
+    results = run_benchmarks(args)
+    print(f"{'stage':<16}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'img/s':>10}")
+    for name, stage in results['stages'].items():
+        print(f"{name:<16}{stage['p50_ms']:>10.2f}{stage['p90_ms']:>10.2f}{stage['p99_ms']:>10.2f}"
+              f"{stage['images_per_s']:>10.1f}")
+    for mode, row in results.get('end_to_end', {}).items():
+        print(f"end-to-end {mode}: {row['images_per_s']:.1f} img/s")
+    if 'cold_start' in results:
+        cold = results['cold_start']
+        print(f"cold start: {cold['cold_start_s']:.2f}s (import {cold['import_s']:.2f}s, torch {cold['torch_import_s']:.2f}s, "
+              f"load {cold['load_s']:.2f}s, first caption {cold['first_caption_s']:.2f}s)")
+    print(f"peak RSS: {results['peak_rss_mb']:.0f} MB")
+
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+            logger.info(f"Results written to {path}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('environment', {}).get('config') != results['environment']['config']:
+            logger.warning("Baseline was recorded with a different configuration, the comparison may not be fair")
+        regressions = compare(results, baseline, args.threshold)
+        for line in regressions:
+            logger.error(f"Regression: {line}")
+        if regressions:
+            return 1
+        logger.info(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,172 @@
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Optional
+
+from PIL import Image
+
+from image_sources import decode_image
+from micro_batcher import MicroBatcher
+from preprocessing import BatchPreprocessor, resize_pyramid
+from startup import stage
+from utils import (CASCADE_MODEL, check_nsfw_batch, generate_captions_batch, generate_captions_cascade,
+                   generate_seo_metadata, input_tensor_type, load_models, model_input_specs, processor_model)
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+DEFAULT_MODEL = "BLIP Large"
+NSFW_BLOCK_THRESHOLD = 0.9
+MODEL_ALIASES = {'base': "BLIP Base", 'large': "BLIP Large", 'cascade': CASCADE_MODEL}
+
+# what a caption request can set; requests batch together only when all of these match
+CaptionOptions = namedtuple('CaptionOptions', ['model', 'max_length', 'num_beams', 'temperature',
+                                               'nsfw_check', 'cascade_threshold'],
+                            defaults=(DEFAULT_MODEL, 50, 3, 0.7, True, None))
+
+# a decoded request: the image plus every model's resized uint8 pixels
+_Prepared = namedtuple('_Prepared', ['image', 'inputs'])
+
+def resolve_model(name: Optional[str]) -> str:
+    """Full model name from a name or short alias ('base', 'large', 'cascade')"""
+    if not name:
+        return DEFAULT_MODEL
+    model = MODEL_ALIASES.get(name.lower(), name)
+    if model not in ("BLIP Base", "BLIP Large", CASCADE_MODEL):
+        raise ValueError(f"Unknown model '{name}'")
+    return model
+
+class CaptionEngine:
+    """Captions single images for concurrent callers by batching them behind the scenes.
+
+    Callers decode and resize on their own thread (`prepare`), then `submit` to one
+    inference thread that NSFW-screens and captions whatever has queued up in a single
+    batched generate call (see MicroBatcher). SEO runs back on the caller's thread.
+    """
+
+    def __init__(self, default_model: str = DEFAULT_MODEL, max_batch_size: int = 8, max_wait_ms: float = 10.0,
+                 precision: str = None, backend: str = None, weights: str = None):
+        self.models_dict, self.processor_dict = load_models(precision=precision, backend=backend, weights=weights)
+        self.default_model = resolve_model(default_model)
+        self.ready = threading.Event()
+        self._specs = {}
+        self._specs_lock = threading.Lock()
+        self._batchers = {}     # (model, input) -> BatchPreprocessor, only touched by the inference thread
+        self.batcher = MicroBatcher(self._run_batch, max_batch_size, max_wait_ms, name='caption-batcher')
+
+    def options(self, model: str = None, **overrides) -> CaptionOptions:
+        """Request options with defaults filled in and the model name resolved"""
+        return CaptionOptions(model=resolve_model(model or self.default_model), **overrides)
+
+    def warm_up(self):
+        """Load the default caption model and the NSFW detector, run one image through, then mark ready.
+
+        Raises (and leaves the engine not ready) when the caption model can't load or the
+        test image doesn't get a caption; a missing NSFW detector is only logged.
+        """
+        started = time.perf_counter()
+        options = self.options()
+        with stage(f"load {processor_model(options.model)}"):
+            # KeyError if it can't be loaded
+            self.models_dict[processor_model(options.model)]
+        with stage("load nsfw_detector"):
+            # logged by the registry, and screening reports it on every batch
+            self.models_dict.get("nsfw_detector")
+        with stage("first batch"):
+            image = Image.new('RGB', (384, 384), (127, 127, 127))
+            result = self.submit(self.prepare_image(image, options.model), options).result()
+        if result.get('status') == 'error':
+            raise RuntimeError(f"Warm-up caption failed: {result.get('caption')}")
+        self.ready.set()
+        logger.info(f"Caption engine ready in {time.perf_counter() - started:.1f}s")
+
+    def _input_specs(self, model: str):
+        with self._specs_lock:
+            if model not in self._specs:
+                self._specs[model] = model_input_specs(model, self.processor_dict)
+            return self._specs[model]
+
+    def prepare_image(self, image: Image.Image, model: str) -> _Prepared:
+        """Resize an already decoded image for the caption model and NSFW detector"""
+        return _Prepared(image, resize_pyramid(image, self._input_specs(model)))
+
+    def prepare(self, data: bytes, model: str) -> _Prepared:
+        """Decode image bytes and resize them for the caption model and NSFW detector (caller's thread)"""
+        return self.prepare_image(decode_image(data), model)
+
+    def submit(self, prepared: _Prepared, options: CaptionOptions, deadline: Optional[float] = None) -> Future:
+        """Queue a prepared image; the future resolves to a result dict (see _run_batch)"""
+        return self.batcher.submit(prepared, key=options, deadline=deadline)
+
+    def caption(self, data: bytes, timeout: Optional[float] = None, seo: bool = True, **options) -> Dict:
+        """Blocking convenience: caption image bytes within `timeout` seconds"""
+        deadline = time.monotonic() + timeout if timeout else None
+        options = self.options(**options)
+        future = self.submit(self.prepare(data, options.model), options, deadline)
+        try:
+            result = future.result(timeout=max(0.0, deadline - time.monotonic()) if deadline else None)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+        return add_seo(result) if seo else result
+
+    def close(self):
+        self.batcher.close()
+
+    def _run_batch(self, options: CaptionOptions, items):
+        """Inference thread: NSFW-screen and caption a micro-batch of requests with the same options"""
+        n = len(items)
+        results = [{'model': options.model, 'caption': '', 'nsfw_score': None, 'nsfw_label': None,
+                    'status': 'ok'} for _ in range(n)]
+        specs = self._input_specs(options.model)
+        survivors = list(range(n))
+
+        if options.nsfw_check:
+            # without an image processor on the detector the pipeline preprocesses the images itself
+            pixel_values = self._batch(options.model, 'nsfw', specs['nsfw'], [item.inputs['nsfw'] for item in items]) \
+                if 'nsfw' in specs else None
+            scores, labels = check_nsfw_batch([item.image for item in items], batch_size=n, pixel_values=pixel_values)
+            survivors = []
+            for i, (score, label) in enumerate(zip(scores.tolist(), labels.tolist())):
+                results[i].update(nsfw_score=round(score, 4), nsfw_label=label)
+                if score > NSFW_BLOCK_THRESHOLD:
+                    results[i].update(caption='[BLOCKED] NSFW content detected', status='blocked')
+                else:
+                    survivors.append(i)
+
+        if survivors:
+            images = [items[i].image for i in survivors]
+            pixel_values = self._batch(options.model, 'caption', specs['caption'],
+                                       [items[i].inputs['caption'] for i in survivors])
+            generation = {'max_length': options.max_length, 'num_beams': options.num_beams,
+                          'temperature': options.temperature}
+            if options.model == CASCADE_MODEL:
+                captions, answered_by, confidence = generate_captions_cascade(
+                    images, self.models_dict, self.processor_dict, batch_size=len(survivors),
+                    pixel_values=pixel_values, threshold=options.cascade_threshold, **generation)
+                for i, model, score in zip(survivors, answered_by, confidence.tolist()):
+                    results[i].update(model=model, confidence=round(score, 4))
+            else:
+                captions = generate_captions_batch(images, options.model, self.models_dict, self.processor_dict,
+                                                   batch_size=len(survivors), pixel_values=pixel_values, **generation)
+            for i, caption in zip(survivors, captions):
+                failed = caption.startswith("Generation error") or caption == "Model not supported"
+                results[i].update(caption=caption, status='error' if failed else 'ok')
+        return results
+
+    def _batch(self, model, name, spec, arrays):
+        """Normalized batch in this model input's reusable buffer"""
+        batcher = self._batchers.get((model, name))
+        if batcher is None:
+            batcher = self._batchers[(model, name)] = BatchPreprocessor(
+                spec, self.batcher.max_batch_size, return_tensors=input_tensor_type(name))
+        return batcher.fill(arrays)
+
+def add_seo(result: Dict) -> Dict:
+    """Keywords and meta description for a successful caption result"""
+    if result.get('status') == 'ok' and result.get('caption'):
+        keywords, meta_desc, _ = generate_seo_metadata(result['caption'])
+        result = dict(result, keywords=keywords, meta_description=meta_desc)
+    return result
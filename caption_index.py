@@ -0,0 +1,281 @@
+"""Caption embedding index: similar-asset search and semantic duplicates over a memory-mapped matrix.
+
+    python caption_index.py build results.jsonl --index-dir captions.index
+    python caption_index.py query "a red sports car on a track" --index-dir captions.index -k 10
+    python caption_index.py dupes --index-dir captions.index --threshold 0.95
+
+Vectors are unit-normalized float32 rows appended to `vectors.f32`, keys and captions
+are one JSON line per row in `meta.jsonl`. Queries map the matrix instead of loading it,
+so the page cache holds it once however many processes search it.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from typing import Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+EMBEDDING_DIM = 384         # all-MiniLM-L6-v2
+DEFAULT_BLOCK_ROWS = 65536  # 96 MB of float32 vectors per block at 384 dims
+VECTORS_FILE = 'vectors.f32'
+META_FILE = 'meta.jsonl'
+ANN_FILE = 'hnsw.faiss'
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def _merge_top_k(best_scores, best_ids, scores, ids, k):
+    """Fold a block of candidate scores into the running top-k of each query"""
+    scores = np.concatenate([best_scores, scores], axis=1)
+    ids = np.concatenate([best_ids, ids], axis=1)
+    if scores.shape[1] > k:
+        part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, part, axis=1)
+        ids = np.take_along_axis(ids, part, axis=1)
+    return scores, ids
+
+class CaptionIndex:
+    """Append-only store of caption embeddings with exact (blocked) or ANN search"""
+
+    def __init__(self, directory: str, dim: int = EMBEDDING_DIM):
+        self.directory = directory
+        self.dim = dim
+        self._vectors_path = os.path.join(directory, VECTORS_FILE)
+        self._meta_path = os.path.join(directory, META_FILE)
+        self._lock = threading.Lock()
+        self._keys = None
+        self._ann = None
+        os.makedirs(directory, exist_ok=True)
+
+        self.count = self._recover()
+
+    def _recover(self) -> int:
+        """Rows present in both files; whatever a crash left half-written past that is cut off"""
+        row_bytes = self.dim * 4
+        size = os.path.getsize(self._vectors_path) if os.path.exists(self._vectors_path) else 0
+        count, meta_size = 0, 0
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'rb') as f:
+                for line in f:
+                    if count == size // row_bytes or not line.endswith(b'\n'):
+                        break
+                    count += 1
+                    meta_size += len(line)
+
+        if size != count * row_bytes:
+            logger.warning(f"Truncating {self._vectors_path} to {count} complete rows")
+            with open(self._vectors_path, 'r+b') as f:
+                f.truncate(count * row_bytes)
+        if os.path.exists(self._meta_path) and os.path.getsize(self._meta_path) != meta_size:
+            logger.warning(f"Truncating {self._meta_path} to {count} complete rows")
+            with open(self._meta_path, 'r+b') as f:
+                f.truncate(meta_size)
+        return count
+
+    def __len__(self):
+        return self.count
+
+    def add(self, keys: Sequence[str], captions: Sequence[str], embeddings: np.ndarray):
+        """Append embeddings (one row per caption) with their keys"""
+        embeddings = _normalize(embeddings)
+        if embeddings.shape != (len(keys), self.dim):
+            raise ValueError(f"Expected {len(keys)} x {self.dim} embeddings, got {embeddings.shape}")
+        with self._lock:
+            # a crash between the two writes is repaired by _recover on the next open
+            with open(self._meta_path, 'a', encoding='utf-8') as meta:
+                meta.writelines(json.dumps({'key': key, 'caption': caption}) + '\n'
+                                for key, caption in zip(keys, captions))
+            with open(self._vectors_path, 'ab') as f:
+                f.write(embeddings.tobytes())
+            self.count += len(keys)
+            if self._keys is not None:
+                self._keys.extend(keys)
+            self._ann = None
+
+    def vectors(self) -> np.ndarray:
+        """The whole matrix, memory-mapped read-only"""
+        if self.count == 0:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+
+    def keys(self) -> List[str]:
+        if self._keys is None:
+            keys = []
+            if os.path.exists(self._meta_path):
+                with open(self._meta_path, encoding='utf-8') as f:
+                    keys = [json.loads(line)['key'] for line in f]
+            self._keys = keys[:self.count]
+        return self._keys
+
+    def captions(self, ids: Sequence[int]) -> List[str]:
+        wanted = set(int(i) for i in ids)
+        found = {}
+        with open(self._meta_path, encoding='utf-8') as f:
+            for i, line in enumerate(f):
+                if i in wanted:
+                    found[i] = json.loads(line)['caption']
+        return [found.get(int(i), '') for i in ids]
+
+    def search(self, queries: np.ndarray, k: int = 10, block_rows: int = DEFAULT_BLOCK_ROWS,
+               use_ann: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k cosine similarities and row ids for each query vector, best first"""
+        queries = _normalize(np.atleast_2d(queries))
+        k = min(k, self.count)
+        if k == 0:
+            return np.zeros((len(queries), 0), np.float32), np.zeros((len(queries), 0), np.int64)
+        if use_ann:
+            scores, ids = self._ann_index().search(queries, k)
+            return scores, ids.astype(np.int64)
+
+        matrix = self.vectors()
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.count, block_rows):
+            block = np.asarray(matrix[start:start + block_rows])
+            scores = queries @ block.T
+            ids = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+            best_scores, best_ids = _merge_top_k(best_scores, best_ids, scores, ids, k)
+
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+    def near_duplicates(self, threshold: float = 0.95, block_rows: int = 8192,
+                        use_ann: bool = False, ann_k: int = 16) -> Iterator[Tuple[int, int, float]]:
+        """Yield (i, j, similarity) for every pair i < j at or above `threshold`.
+
+        The exact path is a blocked self-join, quadratic in the index size; with
+        `use_ann` each row only looks at its `ann_k` nearest neighbours.
+        """
+        matrix = self.vectors()
+        if use_ann:
+            ann = self._ann_index()
+            for start in range(0, self.count, block_rows):
+                block = np.asarray(matrix[start:start + block_rows])
+                scores, ids = ann.search(block, min(ann_k, self.count))
+                rows = np.arange(start, start + len(block))[:, None]
+                hit = (scores >= threshold) & (ids > rows)
+                for i, j, score in zip(np.broadcast_to(rows, ids.shape)[hit], ids[hit], scores[hit]):
+                    yield int(i), int(j), float(score)
+            return
+
+        for a in range(0, self.count, block_rows):
+            block_a = np.asarray(matrix[a:a + block_rows])
+            for b in range(a, self.count, block_rows):
+                block_b = block_a if b == a else np.asarray(matrix[b:b + block_rows])
+                scores = block_a @ block_b.T
+                if b == a:
+                    # only the upper triangle, and never a row against itself; -inf (not 0)
+                    # so the rest can't pass a threshold <= 0
+                    scores[np.tril_indices(len(block_a))] = -np.inf
+                ii, jj = np.nonzero(scores >= threshold)
+                for i, j in zip(ii.tolist(), jj.tolist()):
+                    yield a + i, b + j, float(scores[i, j])
+
+    def _ann_index(self):
+        """HNSW index over the vectors (needs faiss), built once and saved next to them"""
+        if self._ann is not None:
+            return self._ann
+        try:
+            import faiss
+        except ImportError as e:
+            raise ImportError("ANN search needs faiss: pip install faiss-cpu") from e
+
+        path = os.path.join(self.directory, ANN_FILE)
+        if os.path.exists(path):
+            index = faiss.read_index(path)
+            if index.ntotal == self.count:
+                self._ann = index
+                return index
+        logger.info(f"Building HNSW index over {self.count} captions...")
+        index = faiss.IndexHNSWFlat(self.dim, 32, faiss.METRIC_INNER_PRODUCT)
+        matrix = self.vectors()
+        for start in range(0, self.count, DEFAULT_BLOCK_ROWS):
+            index.add(np.ascontiguousarray(matrix[start:start + DEFAULT_BLOCK_ROWS]))
+        faiss.write_index(index, path)
+        self._ann = index
+        return index
+
+def _iter_result_rows(path: str) -> Iterator[dict]:
+    """Rows of a results file written by process_batch_images or batch_cli"""
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+    elif path.endswith('.csv'):
+        import pandas as pd
+        for chunk in pd.read_csv(path, chunksize=10000, dtype=str, keep_default_na=False):
+            yield from chunk.to_dict('records')
+    elif path.endswith('.json'):
+        with open(path, encoding='utf-8') as f:
+            yield from json.load(f)
+    else:
+        raise ValueError(f"Unsupported results file: {path}")
+
+def build_from_results(index: CaptionIndex, results_path: str, encoder, batch_size: int = 256) -> int:
+    """Embed the successful captions of a results file into the index, skipping keys it already has"""
+    known = set(index.keys())
+    keys, captions, added = [], [], 0
+
+    def flush():
+        nonlocal keys, captions, added
+        if keys:
+            index.add(keys, captions, encoder.encode(captions, batch_size=batch_size, convert_to_numpy=True))
+            added += len(keys)
+            keys, captions = [], []
+
+    for row in _iter_result_rows(results_path):
+        key = row.get('Path') or row.get('File')
+        if row.get('Status') != 'Success' or not row.get('Caption') or key in known:
+            continue
+        known.add(key)
+        keys.append(key)
+        captions.append(row['Caption'])
+        if len(keys) >= batch_size * 16:
+            flush()
+    flush()
+    return added
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Caption embedding index")
+    parser.add_argument('command', choices=['build', 'query', 'dupes'])
+    parser.add_argument('text', nargs='?', help="Results file (build) or query text (query)")
+    parser.add_argument('--index-dir', required=True)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.95)
+    parser.add_argument('--ann', action='store_true', help="Use an HNSW index (faiss) instead of exact search")
+    args = parser.parse_args(argv)
+
+    index = CaptionIndex(args.index_dir)
+    if args.command == 'dupes':
+        keys = index.keys()
+        for i, j, score in index.near_duplicates(args.threshold, use_ann=args.ann):
+            print(f"{score:.3f}\t{keys[i]}\t{keys[j]}")
+        return 0
+
+    if not args.text:
+        parser.error(f"{args.command} needs a {'results file' if args.command == 'build' else 'query'}")
+    from utils import load_models
+    models_dict, _ = load_models()
+    encoder = models_dict['sentence_similarity']
+
+    if args.command == 'build':
+        added = build_from_results(index, args.text, encoder)
+        logger.info(f"Added {added} captions, the index now holds {len(index)}")
+        return 0
+
+    scores, ids = index.search(encoder.encode([args.text], convert_to_numpy=True), k=args.k, use_ann=args.ann)
+    keys = index.keys()
+    for score, i, caption in zip(scores[0], ids[0], index.captions(ids[0])):
+        print(f"{score:.3f}\t{keys[i]}\t{caption}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
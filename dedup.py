@@ -0,0 +1,109 @@
+import threading
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+HASH_BITS = 64
+DEFAULT_MAX_DISTANCE = 6   # bits out of 64
+
+def dhash(image: Image.Image, hash_size: int = 8) -> int:
+    """Difference hash: sign of horizontal gradients on a tiny grayscale thumbnail"""
+    # reducing_gap lets PIL shrink big photos cheaply before the final resample
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR, reducing_gap=3.0)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    x = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * x + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+_DCT32 = _dct_matrix(32)
+
+def phash(image: Image.Image, hash_size: int = 8) -> int:
+    """Perceptual hash: low DCT frequencies of a 32x32 thumbnail compared to their median"""
+    small = image.convert('L').resize((32, 32), Image.BILINEAR, reducing_gap=3.0)
+    pixels = np.asarray(small, dtype=np.float32)
+    low = (_DCT32 @ pixels @ _DCT32.T)[:hash_size, :hash_size]
+    bits = low > np.median(low.ravel()[1:])   # the DC term would skew the median
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+HASH_FUNCTIONS = {'dhash': dhash, 'phash': phash}
+
+def hamming(a: int, b: int) -> int:
+    return (a ^ b).bit_count()
+
+class BKTree:
+    """Burkhard-Keller tree over 64-bit hashes for Hamming-radius lookups"""
+
+    def __init__(self):
+        self._root = None   # [hash, value, {distance: child}]
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, h: int, value):
+        if self._root is None:
+            self._root = [h, value, {}]
+            self._size = 1
+            return
+        node = self._root
+        while True:
+            d = hamming(h, node[0])
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, value, {}]
+                self._size += 1
+                return
+            node = child
+
+    def find(self, h: int, max_distance: int) -> Optional[Tuple[int, object]]:
+        """Closest (distance, value) within max_distance, or None"""
+        if self._root is None:
+            return None
+        best = None
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= max_distance and (best is None or d < best[0]):
+                best = (d, node[1])
+                if d == 0:
+                    break
+            # triangle inequality: only children within [d - r, d + r] can match
+            for child_d, child in node[2].items():
+                if d - max_distance <= child_d <= d + max_distance:
+                    stack.append(child)
+        return best
+
+class NearDuplicateIndex:
+    """Assigns each image to a group of near-duplicates, the first one seen being the representative"""
+
+    def __init__(self, max_distance: int = DEFAULT_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self._tree = BKTree()
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def assign(self, h: int, key) -> Optional[object]:
+        """Register an image hash; returns the representative's key if it is a near-duplicate"""
+        with self._lock:
+            match = self._tree.find(h, self.max_distance)
+            if match is not None:
+                self.duplicates += 1
+                return match[1]
+            self._tree.add(h, key)
+            return None
+
+    @property
+    def groups(self) -> int:
+        return len(self._tree)
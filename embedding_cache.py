@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# RAM for cached vision-encoder outputs, and an optional directory to spill them to
+EMBED_CACHE_MB_ENV = "IMAGE2TEXT_EMBED_CACHE_MB"
+EMBED_CACHE_DIR_ENV = "IMAGE2TEXT_EMBED_CACHE_DIR"
+EMBED_CACHE_DISK_MB_ENV = "IMAGE2TEXT_EMBED_CACHE_DISK_MB"
+DEFAULT_EMBED_CACHE_MB = 128      # ~50 BLIP Large images (577 x 1024 float32)
+DEFAULT_EMBED_CACHE_DISK_MB = 2048
+MAX_ENTRIES = 1024                # mapped entries cost no heap, but each holds a mapping open
+
+class EmbeddingCache:
+    """Vision-encoder outputs keyed by image and model: an in-memory LRU, optionally backed
+    by one .npy file per entry that is memory-mapped back in on a hit"""
+
+    def __init__(self, max_bytes: int = DEFAULT_EMBED_CACHE_MB * 1024 ** 2,
+                 directory: Optional[str] = None, max_disk_bytes: int = DEFAULT_EMBED_CACHE_DISK_MB * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()   # least recently used first
+        self._size = 0
+        self._lock = threading.Lock()
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(image_digest: str, model_id: str) -> str:
+        return f"{image_digest}|{model_id}"
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            embeds = self._entries.get(key)
+            if embeds is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return embeds
+        if self.directory:
+            path = self._path(key)
+            try:
+                # mapped, not read: the page cache holds it once for every process
+                embeds = np.load(path, mmap_mode='r')
+                os.utime(path)
+                self._remember(key, embeds, count_bytes=False)
+                with self._lock:
+                    self.hits += 1
+                return embeds
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"Unreadable embedding cache entry {path}: {e}")
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, embeds: np.ndarray):
+        embeds = np.ascontiguousarray(embeds, dtype=np.float32)
+        self._remember(key, embeds)
+        if self.directory:
+            path = self._path(key)
+            try:
+                # write then rename, so a reader never maps a half-written file
+                tmp = f"{path}.{os.getpid()}.tmp"
+                with open(tmp, 'wb') as f:
+                    np.save(f, embeds)
+                os.replace(tmp, path)
+                self._evict_disk()
+            except Exception as e:
+                logger.warning(f"Could not write embedding cache entry: {e}")
+
+    def _remember(self, key, embeds, count_bytes=True):
+        # mapped arrays live in the page cache, not on our heap
+        nbytes = embeds.nbytes if count_bytes else 0
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = embeds
+            self._size += nbytes
+            while len(self._entries) > 1 and (self._size > self.max_bytes or len(self._entries) > MAX_ENTRIES):
+                _, old = self._entries.popitem(last=False)
+                if not isinstance(old, np.memmap):
+                    self._size -= old.nbytes
+
+    def _evict_disk(self):
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._size, 'hits': self.hits, 'misses': self.misses}
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """Process-wide cache configured from the environment, or None when disabled (0 MB)"""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            max_mb = float(os.environ.get(EMBED_CACHE_MB_ENV, DEFAULT_EMBED_CACHE_MB))
+            if max_mb <= 0:
+                return None
+            directory = os.environ.get(EMBED_CACHE_DIR_ENV) or None
+            disk_mb = float(os.environ.get(EMBED_CACHE_DISK_MB_ENV, DEFAULT_EMBED_CACHE_DISK_MB))
+            _CACHE = EmbeddingCache(int(max_mb * 1024 ** 2), directory, int(disk_mb * 1024 ** 2))
+            logger.info(f"Vision embedding cache: {max_mb:.0f} MB in memory" + (f", spilling to {directory}" if directory else ""))
+        return _CACHE
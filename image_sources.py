@@ -0,0 +1,145 @@
+import glob
+import io
+import math
+import os
+import tarfile
+import zipfile
+from typing import Callable, Iterator, Optional, Tuple, Union
+
+from PIL import Image, ImageOps
+
+from metrics import timed
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# the largest model input (BLIP, 384px); NSFW needs 224px. JPEGs are decoded straight to
+# the smallest DCT scale that still covers it
+DECODE_MIN_SIZE = 384
+# images decoded bigger than this are reduced, so a huge PNG can't hog memory downstream
+MAX_DECODED_PIXELS = 2048 * 2048
+# only JPEGs can be decoded smaller than they are; anything else bigger than this (after
+# draft mode) is refused before decoding, ~200 MB of RGB
+MAX_SOURCE_PIXELS = 8192 * 8192
+
+# refuse archive members bigger than this, so one bad entry can't blow up memory
+MAX_MEMBER_BYTES = 256 * 1024 * 1024
+
+def is_image_name(name: str) -> bool:
+    base = os.path.basename(name)
+    # skip macOS resource forks and other hidden junk
+    if base.startswith('.') or '__MACOSX/' in name:
+        return False
+    return base.lower().endswith(IMAGE_EXTENSIONS)
+
+@timed('decode')
+def decode_image(data: bytes, min_size: Optional[int] = DECODE_MIN_SIZE,
+                 max_pixels: Optional[int] = MAX_DECODED_PIXELS,
+                 max_source_pixels: Optional[int] = MAX_SOURCE_PIXELS) -> Image.Image:
+    """Decode raw image bytes to an upright RGB PIL image.
+
+    JPEGs are decoded in draft mode: libjpeg scales the DCT by 1/2, 1/4 or 1/8 so the
+    result is the smallest one still at least `min_size` on both sides. Anything still
+    over `max_pixels` is reduced after decoding. Images that would decode to more than
+    `max_source_pixels` raise ValueError without being decoded. EXIF orientation is
+    applied. Pass `min_size=None, max_pixels=None` for the full-resolution image.
+    """
+    image = Image.open(io.BytesIO(data))
+    if min_size and image.format == 'JPEG':
+        # both sides, since rotation by EXIF orientation can swap them
+        image.draft('RGB', (min_size, min_size))
+    # only the header has been read so far, and size already reflects the draft scale
+    if max_source_pixels and image.width * image.height > max_source_pixels:
+        raise ValueError(f"{image.width}x{image.height} image is over the {max_source_pixels} pixel decode limit")
+    image = ImageOps.exif_transpose(image)
+
+    if max_pixels and image.width * image.height > max_pixels:
+        factor = math.ceil(math.sqrt(image.width * image.height / max_pixels))
+        # never below min_size, the models would have to upscale again
+        if min_size:
+            factor = max(1, min(factor, min(image.width, image.height) // min_size))
+        if factor > 1:
+            image = image.reduce(factor)
+    return image.convert('RGB')
+
+def _iter_zip(fileobj, select) -> Iterator[Tuple[str, bytes]]:
+    with zipfile.ZipFile(fileobj, 'r') as zip_ref:
+        for info in zip_ref.infolist():
+            if info.is_dir() or not is_image_name(info.filename):
+                continue
+            if select is not None and not select(info.filename):
+                continue
+            if info.file_size > MAX_MEMBER_BYTES:
+                logger.warning(f"Skipping {info.filename}: {info.file_size} bytes is over the member size limit")
+                continue
+            # one member in memory at a time, nothing is written to disk
+            with zip_ref.open(info) as member:
+                yield info.filename, member.read()
+
+def _iter_tar(fileobj, select) -> Iterator[Tuple[str, bytes]]:
+    # stream mode reads members sequentially and handles gz/bz2/xz transparently
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar_ref:
+        for info in tar_ref:
+            if not info.isfile() or not is_image_name(info.name):
+                continue
+            if select is not None and not select(info.name):
+                continue
+            if info.size > MAX_MEMBER_BYTES:
+                logger.warning(f"Skipping {info.name}: {info.size} bytes is over the member size limit")
+                continue
+            member = tar_ref.extractfile(info)
+            if member is not None:
+                yield info.name, member.read()
+
+def _iter_paths(paths, select) -> Iterator[Tuple[str, bytes]]:
+    for path in paths:
+        if select is not None and not select(path):
+            continue
+        if os.path.isfile(path) and is_image_name(path):
+            with open(path, 'rb') as f:
+                yield path, f.read()
+
+def _iter_directory(root: str, select) -> Iterator[Tuple[str, bytes]]:
+    for dirpath, dirnames, files in os.walk(root):
+        dirnames.sort()
+        yield from _iter_paths((os.path.join(dirpath, file) for file in sorted(files)), select)
+
+def _iter_archive(fileobj, select) -> Iterator[Tuple[str, bytes]]:
+    if zipfile.is_zipfile(fileobj):
+        fileobj.seek(0)
+        yield from _iter_zip(fileobj, select)
+        return
+    fileobj.seek(0)
+    if tarfile.is_tarfile(fileobj):
+        fileobj.seek(0)
+        yield from _iter_tar(fileobj, select)
+        return
+    raise ValueError("Unsupported archive: expected a ZIP or tar/tar.gz file")
+
+def iter_image_bytes(source: Union[str, os.PathLike, io.IOBase],
+                     select: Optional[Callable[[str], bool]] = None) -> Iterator[Tuple[str, bytes]]:
+    """Yield (name, raw bytes) for every image in a source, one at a time.
+
+    `source` can be a ZIP or tar/tar.gz archive (path or file-like object, e.g. a
+    Streamlit upload), a directory, or a glob pattern. `select` filters on the
+    name before any bytes are read.
+    """
+    if hasattr(source, 'read'):
+        yield from _iter_archive(source, select)
+        return
+
+    source = os.fspath(source)
+    if os.path.isdir(source):
+        yield from _iter_directory(source, select)
+    elif os.path.isfile(source) and not is_image_name(source):
+        with open(source, 'rb') as f:
+            yield from _iter_archive(f, select)
+    elif glob.has_magic(source):
+        yield from _iter_paths(sorted(glob.glob(source, recursive=True)), select)
+    elif os.path.isfile(source):
+        yield from _iter_paths([source], select)
+    else:
+        raise FileNotFoundError(f"No images found at: {source}")
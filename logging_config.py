@@ -1,23 +1,59 @@
+import json
 import logging
+import os
 import sys
+import time
+
+# IMAGE2TEXT_LOG_LEVEL (INFO, DEBUG, WARNING, ...) and IMAGE2TEXT_LOG_FORMAT ('text' or 'json')
+LOG_LEVEL_ENV = "IMAGE2TEXT_LOG_LEVEL"
+LOG_FORMAT_ENV = "IMAGE2TEXT_LOG_FORMAT"
+
+# attributes every LogRecord has; anything else came in through `extra=` and goes into the JSON
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message plus any `extra=` fields.
+
+    The message is only built here, once a handler has accepted the record, so
+    %-style arguments cost nothing at filtered-out levels.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
 
 def get_logger(name: str) -> logging.Logger:
 
     logger = logging.getLogger(name)
     if not logger.handlers:
-        logger.setLevel(logging.INFO)
+        level = getattr(logging, os.environ.get(LOG_LEVEL_ENV, 'INFO').upper(), logging.INFO)
+        logger.setLevel(level)
 
         #send logs to the terminale
         handler = logging.StreamHandler(sys.stdout)
-        handler.setLevel(logging.INFO)
+        handler.setLevel(level)
 
-        formatter = logging.Formatter(
-            fmt='[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
-            datefmt='%Y-%m-%d %H:%M:%S'
-        )
+        if os.environ.get(LOG_FORMAT_ENV, 'text').lower() == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                fmt='[%(asctime)s] [%(name)s] [%(levelname)s] %(message)s',
+                datefmt='%Y-%m-%d %H:%M:%S'
+            )
 
         handler.setFormatter(formatter)
         logger.addHandler(handler)
         logger.propagate = False
 
-    return logger
\ No newline at end of file
+    return logger
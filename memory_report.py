@@ -0,0 +1,106 @@
+"""Shared versus private memory of caption worker processes (Linux, from /proc/<pid>/smaps_rollup).
+
+    python memory_report.py --children 12345      # the workers forked or spawned by 12345
+    python memory_report.py 23456 23457 --json
+
+RSS counts shared pages once per process, so summing it over workers overstates what
+they take; PSS splits every shared page between the processes mapping it, and its sum
+is what the workers actually cost the host. Weights shared through mmap or fork show up
+as Shared; whatever a worker had to copy shows up as Private.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List, Optional
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+_FIELDS = {'Rss': 'rss', 'Pss': 'pss', 'Shared_Clean': 'shared', 'Shared_Dirty': 'shared',
+           'Private_Clean': 'private', 'Private_Dirty': 'private', 'Swap': 'swap'}
+
+def memory_usage(pid: int = None) -> Optional[Dict[str, float]]:
+    """rss, pss, shared, private and swap MB of a process; None where /proc doesn't have them"""
+    pid = pid or os.getpid()
+    usage = dict.fromkeys(('rss', 'pss', 'shared', 'private', 'swap'), 0.0)
+    try:
+        with open(f'/proc/{pid}/smaps_rollup', encoding='ascii') as f:
+            for line in f:
+                parts = line.split()
+                # e.g. "Shared_Clean:     123456 kB"
+                if len(parts) == 3 and parts[0].rstrip(':') in _FIELDS:
+                    usage[_FIELDS[parts[0].rstrip(':')]] += int(parts[1]) / 1024
+    except (OSError, ValueError):
+        return None
+    return usage
+
+def child_pids(pid: int) -> List[int]:
+    """Direct children of a process"""
+    children = []
+    try:
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children', encoding='ascii') as f:
+                children += [int(child) for child in f.read().split()]
+    except OSError:
+        # no children files (older kernels): scan every process's parent instead
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', encoding='ascii') as f:
+                    # the command name can contain spaces, the fields after it can't
+                    if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        children.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    return sorted(set(children))
+
+def report(pids: List[int]) -> Dict:
+    """Per-process usage plus totals, skipping processes that have gone away"""
+    processes = {}
+    for pid in pids:
+        usage = memory_usage(pid)
+        if usage is None:
+            logger.warning(f"No memory information for process {pid}")
+            continue
+        processes[pid] = usage
+    totals = {key: sum(usage[key] for usage in processes.values())
+              for key in ('rss', 'pss', 'shared', 'private', 'swap')}
+    return {'processes': processes, 'totals': totals}
+
+def format_report(result: Dict) -> str:
+    lines = [f"{'pid':>8} {'RSS MB':>10} {'PSS MB':>10} {'shared MB':>10} {'private MB':>10} {'swap MB':>10}"]
+    for pid, usage in result['processes'].items():
+        lines.append(f"{pid:>8} {usage['rss']:>10.1f} {usage['pss']:>10.1f} {usage['shared']:>10.1f} "
+                     f"{usage['private']:>10.1f} {usage['swap']:>10.1f}")
+    totals = result['totals']
+    lines.append(f"{'total':>8} {totals['rss']:>10.1f} {totals['pss']:>10.1f} {totals['shared']:>10.1f} "
+                 f"{totals['private']:>10.1f} {totals['swap']:>10.1f}")
+    lines.append(f"Host memory taken by these processes (sum of PSS): {totals['pss']:.1f} MB")
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Shared vs private memory of worker processes")
+    parser.add_argument('pids', nargs='*', type=int, help="Processes to report on")
+    parser.add_argument('--children', type=int, default=None, metavar='PID',
+                        help="Also report on every direct child of PID (e.g. the batch_cli or service parent)")
+    parser.add_argument('--json', action='store_true', help="Print JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    pids = list(args.pids)
+    if args.children is not None:
+        pids += child_pids(args.children)
+    if not pids:
+        parser.error("give process ids or --children PID")
+
+    result = report(pids)
+    if not result['processes']:
+        logger.error("None of the processes could be read (is /proc/<pid>/smaps_rollup available?)")
+        return 1
+    print(json.dumps(result, indent=2) if args.json else format_report(result))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
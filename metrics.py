@@ -0,0 +1,193 @@
+"""Counters, latency histograms and timing spans, exported in the Prometheus text format.
+
+    from metrics import span
+    with span('generate', items=len(batch)):
+        ...
+
+Every span feeds `image2text_stage_seconds{stage=...}` (a histogram) and
+`image2text_stage_items_total{stage=...}`. The service serves render_prometheus() at
+/metrics; batch jobs write it to IMAGE2TEXT_METRICS_FILE (e.g. for node_exporter's
+textfile collector) when they finish. IMAGE2TEXT_METRICS=0 turns recording off.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Tuple
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+METRICS_ENV = "IMAGE2TEXT_METRICS"
+METRICS_FILE_ENV = "IMAGE2TEXT_METRICS_FILE"
+
+# seconds, from a resize to a BLIP Large beam search on a slow CPU
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+STAGE_SECONDS = "image2text_stage_seconds"
+STAGE_ITEMS = "image2text_stage_items_total"
+STAGE_ERRORS = "image2text_stage_errors_total"
+
+_HELP = {
+    STAGE_SECONDS: ("histogram", "Wall-clock seconds per call of each pipeline stage"),
+    STAGE_ITEMS: ("counter", "Images (or captions) handled by each pipeline stage"),
+    STAGE_ERRORS: ("counter", "Calls of each pipeline stage that raised"),
+}
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(key, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class _Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """Process-local counters and histograms; cheap enough to update on every image"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict[tuple, float]] = {}
+        self._histograms: Dict[str, Dict[tuple, _Histogram]] = {}
+        self._help: Dict[str, Tuple[str, str]] = dict(_HELP)
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, buckets=LATENCY_BUCKETS, **labels):
+        if not self.enabled:
+            return
+        key = _label_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = _Histogram(tuple(buckets))
+            histogram.observe(value)
+
+    @contextmanager
+    def span(self, stage: str, items: int = 1):
+        """Time a block as one call of `stage` covering `items` images"""
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(STAGE_ERRORS, stage=stage)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.observe(STAGE_SECONDS, elapsed, stage=stage)
+            self.inc(STAGE_ITEMS, items, stage=stage)
+            logger.debug("span %s: %.2f ms for %d", stage, 1000 * elapsed, items)
+
+    def snapshot(self) -> Dict:
+        """Plain-dict copy: counters, and count/sum/mean of every histogram series"""
+        with self._lock:
+            counters = {name: {_format_labels(k): v for k, v in series.items()}
+                        for name, series in self._counters.items()}
+            histograms = {name: {_format_labels(k): {'count': h.count, 'sum': h.sum,
+                                                     'mean': h.sum / h.count if h.count else 0.0}
+                                 for k, h in series.items()}
+                          for name, series in self._histograms.items()}
+        return {'counters': counters, 'histograms': histograms}
+
+    def render_prometheus(self) -> str:
+        """Everything recorded so far in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                kind, help_text = self._help.get(name, ('counter', name))
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f"{name}{_format_labels(key)} {_format_value(value)}")
+            for name in sorted(self._histograms):
+                _, help_text = self._help.get(name, ('histogram', name))
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for key, h in sorted(self._histograms[name].items()):
+                    cumulative = 0
+                    for bound, count in zip(list(h.bounds) + ['+Inf'], h.counts):
+                        cumulative += count
+                        le = bound if bound == '+Inf' else _format_value(bound)
+                        lines.append(f"{name}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {h.sum!r}")
+                    lines.append(f"{name}_count{_format_labels(key)} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        """Write the exposition to a file atomically, so a scraper never reads half of it"""
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp, path)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+_METRICS = MetricsRegistry(enabled=os.environ.get(METRICS_ENV, '1').lower() not in ('0', 'false', 'off'))
+
+def get_metrics() -> MetricsRegistry:
+    return _METRICS
+
+def span(stage: str, items: int = 1):
+    """Time a block as one call of a pipeline stage, see MetricsRegistry.span"""
+    return _METRICS.span(stage, items)
+
+def timed(stage: str):
+    """Decorator form of span, one item per call"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _METRICS.span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def export_metrics_file(path: str = None):
+    """Write the metrics to `path` or IMAGE2TEXT_METRICS_FILE, if either is set; '{pid}' is
+    replaced by the process id so sharded workers don't overwrite each other"""
+    path = path or os.environ.get(METRICS_FILE_ENV)
+    if not path or not _METRICS.enabled:
+        return
+    path = path.replace('{pid}', str(os.getpid()))
+    try:
+        _METRICS.write_prometheus(path)
+        logger.info(f"Metrics written to {path}")
+    except OSError as e:
+        logger.warning(f"Could not write metrics to {path}: {e}")
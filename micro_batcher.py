@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Any, Callable, Hashable, List, Optional, Sequence, Tuple
+
+from metrics import BATCH_SIZE_BUCKETS, get_metrics
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+BATCH_SIZE = "image2text_micro_batch_size"
+QUEUE_WAIT_SECONDS = "image2text_micro_batch_wait_seconds"
+get_metrics().describe(BATCH_SIZE, 'histogram', "Submissions run together in one micro-batch")
+get_metrics().describe(QUEUE_WAIT_SECONDS, 'histogram', "Seconds the oldest submission of a micro-batch waited")
+
+# one submission waiting for a batch; deadline is a time.monotonic() value or None
+_Pending = namedtuple('_Pending', ['item', 'key', 'future', 'deadline', 'enqueued'])
+
+class MicroBatcher:
+    """Coalesces concurrent submissions into micro-batches run by one worker thread.
+
+    `process_batch(key, items)` gets up to `max_batch_size` items submitted with the same
+    key and returns one result per item. A batch is started as soon as it is full,
+    `max_wait_ms` after its oldest item arrived, or once the oldest item has less than
+    `max_wait_ms` left before its deadline, whichever comes first; items with other keys
+    wait for a later batch. Each submission gets a concurrent.futures.Future; cancelled
+    submissions, and those whose deadline passed before their batch was taken off the
+    queue, are dropped before it runs.
+    """
+
+    def __init__(self, process_batch: Callable[[Hashable, List[Any]], Sequence[Any]],
+                 max_batch_size: int = 8, max_wait_ms: float = 10.0, name: str = 'micro-batcher'):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, max_wait_ms) / 1000.0
+        self.batches = 0
+        self.items = 0
+        self.expired = 0
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    def submit(self, item, key: Hashable = None, deadline: Optional[float] = None) -> Future:
+        """Queue an item; the future resolves to its result, or raises TimeoutError past `deadline`"""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("MicroBatcher is closed")
+            self._pending.append(_Pending(item, key, future, deadline, time.monotonic()))
+            self._cond.notify()
+        return future
+
+    def queued(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def stats(self):
+        with self._cond:
+            return {'batches': self.batches, 'items': self.items, 'expired': self.expired,
+                    'queued': len(self._pending),
+                    'mean_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0}
+
+    def close(self, wait: bool = True):
+        """Stop taking submissions; what is already queued still runs"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if wait:
+            self._worker.join()
+
+    def _same_key(self, key) -> int:
+        return sum(1 for p in self._pending if p.key == key)
+
+    def _next_batch(self) -> Tuple[List[_Pending], float]:
+        """Block until a batch is due, then take it off the queue; returns the batch and when it
+        was taken (an empty batch once closed and drained)"""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return [], time.monotonic()
+            first = self._pending[0]
+            flush_at = first.enqueued + self.max_wait
+            # wait for company, but leave the oldest item at least max_wait before its
+            # deadline to run in; a short deadline flushes (almost) at once
+            if first.deadline is not None:
+                flush_at = min(flush_at, first.deadline - self.max_wait)
+            while not self._closed and self._same_key(first.key) < self.max_batch_size:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, rest = [], deque()
+            while self._pending:
+                p = self._pending.popleft()
+                if p.key == first.key and len(batch) < self.max_batch_size:
+                    batch.append(p)
+                else:
+                    rest.append(p)
+            self._pending = rest
+            return batch, time.monotonic()
+
+    def _run(self):
+        while True:
+            batch, taken = self._next_batch()
+            if not batch:
+                return
+            live = []
+            for p in batch:
+                if not p.future.set_running_or_notify_cancel():
+                    continue
+                # only what expired while queued; a batch already taken runs to the end
+                if p.deadline is not None and taken >= p.deadline:
+                    p.future.set_exception(FutureTimeoutError("Deadline expired before the batch ran"))
+                    with self._cond:
+                        self.expired += 1
+                    continue
+                live.append(p)
+            if not live:
+                continue
+
+            try:
+                results = self.process_batch(live[0].key, [p.item for p in live])
+                if len(results) != len(live):
+                    raise RuntimeError(f"process_batch returned {len(results)} results for {len(live)} items")
+            except Exception as e:
+                logger.error(f"Micro-batch of {len(live)} failed: {e}")
+                for p in live:
+                    p.future.set_exception(e)
+            else:
+                for p, result in zip(live, results):
+                    p.future.set_result(result)
+            with self._cond:
+                self.batches += 1
+                self.items += len(live)
+            waited = taken - batch[0].enqueued
+            get_metrics().observe(BATCH_SIZE, len(live), BATCH_SIZE_BUCKETS, batcher=self._worker.name)
+            get_metrics().observe(QUEUE_WAIT_SECONDS, waited, batcher=self._worker.name)
+            logger.debug("Ran a micro-batch of %d (waited %.1f ms)", len(live), 1000 * waited)
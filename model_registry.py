@@ -0,0 +1,209 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Callable, Dict, Optional, Tuple, Any
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# RAM budget for resident models, in MB (unset = no limit)
+MEMORY_BUDGET_ENV = "IMAGE2TEXT_MODEL_BUDGET_MB"
+# a model that failed to load is reported as failed for this long, then loaded again on the next lookup
+RETRY_COOLDOWN_S = 60.0
+
+def model_nbytes(model) -> int:
+    """Resident size of a model's weights and buffers, in bytes"""
+    # non-torch backends report their own size
+    if isinstance(getattr(model, "nbytes", None), int):
+        return model.nbytes
+    # HF pipelines wrap the actual nn.Module
+    module = getattr(model, "model", model)
+    if not hasattr(module, "parameters"):
+        return 0
+
+    seen = set()
+    total = 0
+    tensors = list(module.parameters())
+    if hasattr(module, "buffers"):
+        tensors += list(module.buffers())
+    for t in tensors:
+        # tied weights share one storage, only count it once
+        key = t.data_ptr()
+        if key in seen:
+            continue
+        seen.add(key)
+        total += t.numel() * t.element_size()
+    # dynamically quantized Linear layers keep their int8 weights outside parameters()
+    for m in module.modules():
+        if hasattr(m, "_packed_params") and callable(getattr(m, "weight", None)):
+            w = m.weight()
+            total += w.numel() * w.element_size()
+    return total
+
+class ModelRegistry:
+    """Loads models on first use and keeps the resident set under a RAM budget (LRU eviction).
+
+    A failed load is remembered for `retry_cooldown` seconds, so a broken model doesn't
+    get reloaded on every lookup; after that the next lookup tries again.
+    """
+
+    def __init__(self, memory_budget_mb: Optional[float] = None, retry_cooldown: float = RETRY_COOLDOWN_S):
+        if memory_budget_mb is None and os.environ.get(MEMORY_BUDGET_ENV):
+            memory_budget_mb = float(os.environ[MEMORY_BUDGET_ENV])
+        self.memory_budget = int(memory_budget_mb * 1024 ** 2) if memory_budget_mb else None
+
+        self._loaders: Dict[str, Callable[[], Tuple[Any, Any]]] = {}
+        self._models: "OrderedDict[str, Any]" = OrderedDict()   # least recently used first
+        self._processors: Dict[str, Any] = {}
+        self._sizes: Dict[str, int] = {}    # remembered even after eviction
+        self.retry_cooldown = retry_cooldown
+        self._failed: Dict[str, Tuple[str, float]] = {}    # name -> (error, monotonic time to retry at)
+        self._lock = threading.RLock()              # bookkeeping only, never held while a loader runs
+        self._loading: Dict[str, threading.Lock] = {}  # one per model, so a load only blocks its own lookups
+
+        # dict-like views, so callers can keep using models_dict[name] / processor_dict[name]
+        self.models = _RegistryView(self, "model")
+        self.processors = _RegistryView(self, "processor")
+
+    def register(self, name: str, loader: Callable[[], Tuple[Any, Any]]):
+        """Register a loader returning (model, processor); processor may be None"""
+        with self._lock:
+            self._loaders[name] = loader
+
+    def is_registered(self, name: str) -> bool:
+        return name in self._loaders
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def names(self):
+        return list(self._loaders)
+
+    def _lookup(self, name: str):
+        """(model, processor) if resident, else None; raises KeyError for unknown models and for
+        failed ones until their retry cooldown has passed"""
+        if name in self._models:
+            self._models.move_to_end(name)
+            return self._models[name], self._processors.get(name)
+        if name not in self._loaders:
+            raise KeyError(name)
+        if name in self._failed:
+            error, retry_at = self._failed[name]
+            wait = retry_at - time.monotonic()
+            if wait > 0:
+                raise KeyError(f"{name} failed to load: {error} (retrying in {wait:.0f}s)")
+        return None
+
+    def get(self, name: str):
+        """Return (model, processor), loading the model if needed"""
+        with self._lock:
+            found = self._lookup(name)
+            if found is not None:
+                return found
+            load_lock = self._loading.setdefault(name, threading.Lock())
+
+        # concurrent lookups of this model wait here, lookups of other models don't
+        with load_lock:
+            with self._lock:
+                # loaded (or failed) while we waited for the lock
+                found = self._lookup(name)
+                if found is not None:
+                    return found
+                # make room up front when we already know how big this model is
+                if name in self._sizes:
+                    self._evict_for(self._sizes[name])
+                loader = self._loaders[name]
+
+            logger.info(f"Loading model on demand: {name}")
+            try:
+                model, processor = loader()
+            except Exception as e:
+                logger.error(f"Error loading {name}: {e}")
+                with self._lock:
+                    self._failed[name] = (str(e), time.monotonic() + self.retry_cooldown)
+                raise KeyError(name) from e
+            size = model_nbytes(model)
+
+            with self._lock:
+                self._failed.pop(name, None)
+                self._models[name] = model
+                if processor is not None:
+                    self._processors[name] = processor
+                self._sizes[name] = size
+                self._evict_for(0, keep=name)
+                logger.info(f"{name} loaded ({size / 1024 ** 2:.1f} MB, "
+                            f"{self.resident_bytes() / 1024 ** 2:.1f} MB resident)")
+            return model, processor
+
+    def clear_failures(self):
+        """Forget failed loads, so the next lookup of those models tries again"""
+        with self._lock:
+            self._failed.clear()
+
+    def evict(self, name: str):
+        """Drop a model (and its processor) from memory"""
+        with self._lock:
+            if self._models.pop(name, None) is not None:
+                self._processors.pop(name, None)
+                gc.collect()
+                logger.info(f"Evicted model: {name}")
+
+    def resident_bytes(self) -> int:
+        return sum(self._sizes[name] for name in self._models)
+
+    def memory_report(self) -> Dict[str, float]:
+        """Resident MB per loaded model, least recently used first"""
+        return {name: self._sizes[name] / 1024 ** 2 for name in self._models}
+
+    def _evict_for(self, incoming: int, keep: Optional[str] = None):
+        if self.memory_budget is None:
+            return
+        for name in list(self._models):
+            if self.resident_bytes() + incoming <= self.memory_budget:
+                break
+            if name == keep:
+                continue
+            logger.info(f"Memory budget exceeded, evicting least recently used model: {name}")
+            self.evict(name)
+
+        if self.resident_bytes() + incoming > self.memory_budget:
+            logger.warning(f"Model memory budget of {self.memory_budget / 1024 ** 2:.0f} MB exceeded "
+                           f"({(self.resident_bytes() + incoming) / 1024 ** 2:.0f} MB needed)")
+
+class _RegistryView(Mapping):
+    """Read-only mapping over a registry that loads entries on access"""
+
+    def __init__(self, registry: ModelRegistry, kind: str):
+        self._registry = registry
+        self._kind = kind
+
+    def __getitem__(self, name):
+        model, processor = self._registry.get(name)
+        value = model if self._kind == "model" else processor
+        if value is None:
+            raise KeyError(name)
+        return value
+
+    def __contains__(self, name):
+        return self._registry.is_registered(name)
+
+    def __iter__(self):
+        return iter(self._registry.names())
+
+    def __len__(self):
+        return len(self._registry.names())
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+def get_registry() -> ModelRegistry:
+    """Process-wide registry"""
+    global _REGISTRY
+    with _REGISTRY_LOCK:
+        if _REGISTRY is None:
+            _REGISTRY = ModelRegistry()
+        return _REGISTRY
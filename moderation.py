@@ -0,0 +1,121 @@
+import json
+import os
+import re
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# a JSON file of {"term": weight} replacing the built-in lexicon
+LEXICON_PATH_ENV = "IMAGE2TEXT_MODERATION_LEXICON"
+
+TERM_WEIGHT = 0.15
+
+# terms that might indicate toxic content
+DEFAULT_LEXICON = {term: TERM_WEIGHT for term in (
+    'hate', 'violence', 'kill', 'attack', 'terror', 'abuse', 'hurt', 'harm',
+    'die', 'death', 'dead', 'murder', 'suicide',
+    'racist', 'sexist', 'homophobic', 'transphobic',
+    'nude', 'naked', 'porn', 'sexual', 'xxx',
+)}
+
+# extra penalty once the score goes over the threshold (several toxic terms)
+MULTI_TERM_THRESHOLD = 0.3
+MULTI_TERM_PENALTY = 0.2
+
+Lexicon = Union[Dict[str, float], Iterable[Tuple[str, float]]]
+
+class ModerationEngine:
+    """Scores text against a weighted lexicon compiled into a single regex.
+
+    Every term is a whole-word, case-insensitive match; multi-word terms match
+    across any whitespace. Scoring: the weights of all matches are summed, the
+    multi-term penalty is added once the sum goes over the threshold, and the
+    result is clamped to 1.0.
+    """
+
+    def __init__(self, lexicon: Optional[Lexicon] = None,
+                 threshold: float = MULTI_TERM_THRESHOLD, penalty: float = MULTI_TERM_PENALTY):
+        lexicon = DEFAULT_LEXICON if lexicon is None else lexicon
+        items = lexicon.items() if isinstance(lexicon, dict) else lexicon
+
+        weights = {}
+        for term, weight in items:
+            term = ' '.join(term.lower().split())
+            if term:
+                weights[term] = float(weight)
+        if not weights:
+            raise ValueError("Moderation lexicon is empty")
+
+        # longest first, so a term never loses to one of its own prefixes
+        self.terms = sorted(weights, key=lambda t: (-len(t), t))
+        self.weights = np.array([weights[t] for t in self.terms], dtype=np.float64)
+        self.threshold = threshold
+        self.penalty = penalty
+
+        # one capture group per term: match.lastindex tells which one hit without a dict lookup
+        alternation = '|'.join('(' + r'\s+'.join(map(re.escape, t.split())) + ')' for t in self.terms)
+        self._pattern = re.compile(r'\b(?:' + alternation + r')\b', re.IGNORECASE)
+
+    def _finalize(self, raw: np.ndarray) -> np.ndarray:
+        return np.minimum(np.where(raw > self.threshold, raw + self.penalty, raw), 1.0)
+
+    def matches(self, text: str) -> List[str]:
+        """Lexicon terms found in the text, in order of appearance"""
+        return [self.terms[m.lastindex - 1] for m in self._pattern.finditer(text)]
+
+    def score(self, text: str) -> float:
+        raw = sum(self.weights[m.lastindex - 1] for m in self._pattern.finditer(text))
+        return float(self._finalize(np.float64(raw)))
+
+    def score_batch(self, texts: List[str]) -> np.ndarray:
+        """Scores for many texts from one scan over their concatenation"""
+        if not texts:
+            return np.zeros(0, dtype=np.float32)
+        texts = [t if isinstance(t, str) else '' for t in texts]
+
+        # NUL is neither a word character (\b still holds at each end) nor whitespace (a
+        # multi-word term's \s+ can't cross it), so no match can straddle two texts
+        corpus = '\x00'.join(t.replace('\x00', ' ') for t in texts)
+        ends = np.cumsum([len(t) + 1 for t in texts])
+        starts, term_ids = [], []
+        for m in self._pattern.finditer(corpus):
+            starts.append(m.start())
+            term_ids.append(m.lastindex - 1)
+
+        raw = np.zeros(len(texts), dtype=np.float64)
+        if starts:
+            owners = np.searchsorted(ends, np.asarray(starts), side='right')
+            np.add.at(raw, owners, self.weights[np.asarray(term_ids)])
+        return self._finalize(raw).astype(np.float32)
+
+def load_lexicon(path: str) -> Dict[str, float]:
+    """Read a {"term": weight} JSON file"""
+    with open(path, encoding='utf-8') as f:
+        lexicon = json.load(f)
+    if not isinstance(lexicon, dict):
+        raise ValueError(f"{path}: expected a JSON object of term -> weight")
+    return {str(term): float(weight) for term, weight in lexicon.items()}
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_moderation_engine() -> ModerationEngine:
+    """Process-wide engine, compiled once from the configured lexicon"""
+    global _ENGINE
+    with _ENGINE_LOCK:
+        if _ENGINE is None:
+            path = os.environ.get(LEXICON_PATH_ENV)
+            lexicon = None
+            if path:
+                try:
+                    lexicon = load_lexicon(path)
+                    logger.info(f"Moderation lexicon: {len(lexicon)} terms from {path}")
+                except Exception as e:
+                    logger.error(f"Could not load moderation lexicon {path}, using the default: {e}")
+            _ENGINE = ModerationEngine(lexicon)
+        return _ENGINE
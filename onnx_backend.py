@@ -0,0 +1,393 @@
+"""ONNX Runtime backend for the BLIP caption models.
+
+    python onnx_backend.py export --model "BLIP Base"
+    python onnx_backend.py parity --model "BLIP Base" samples/*.jpg
+
+The vision encoder and the text decoder are exported as three graphs: `vision.onnx`,
+`decoder_init.onnx` (prompt, no cache) and `decoder_step.onnx` (one token against the
+self-attention KV cache). Greedy and beam search run here in NumPy, so captioning
+needs onnxruntime and the BlipProcessor but not PyTorch; only the export does.
+"""
+import argparse
+import glob
+import inspect
+import json
+import os
+import sys
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+BACKEND_ENV = "IMAGE2TEXT_BACKEND"
+ONNX_DIR_ENV = "IMAGE2TEXT_ONNX_DIR"
+BACKENDS = ('torch', 'onnx')
+DEFAULT_ONNX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "image2text", "onnx")
+CONFIG_FILE = 'blip_onnx.json'
+OPSET = 17
+
+def resolve_backend(backend: Optional[str] = None) -> str:
+    backend = (backend or os.environ.get(BACKEND_ENV) or 'torch').lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend '{backend}', use one of {BACKENDS}")
+    return backend
+
+def onnx_dir(model_name: str) -> str:
+    """Where the exported graphs of a model live"""
+    root = os.environ.get(ONNX_DIR_ENV) or DEFAULT_ONNX_DIR
+    return os.path.join(root, model_name.lower().replace(' ', '-'))
+
+def _self_attention_cache(past):
+    """The decoder's past_key_values from flattened key/value tensors per layer: a DynamicCache
+    (transformers 5 takes nothing else), or layer tuples where there is none"""
+    if not past:
+        return None
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return tuple((past[i], past[i + 1]) for i in range(0, len(past), 2))
+    cache = DynamicCache()
+    for i in range(0, len(past), 2):
+        cache.update(past[i], past[i + 1], i // 2)
+    return cache
+
+def _flat_self_attention(present) -> tuple:
+    """Key and value tensor of every layer of the decoder's self-attention cache, in order"""
+    # an EncoderDecoderCache around the self-attention one, in newer transformers
+    present = getattr(present, 'self_attention_cache', present)
+    if hasattr(present, 'layers'):
+        return tuple(t for layer in present.layers for t in (layer.keys, layer.values))
+    if hasattr(present, 'to_legacy_cache'):
+        present = present.to_legacy_cache()
+    return tuple(t for layer in present for t in layer[:2])
+
+def export_blip_onnx(checkpoint: str, directory: str, opset: int = OPSET) -> str:
+    """Export a BLIP captioning checkpoint to the three ONNX graphs, plus its processor"""
+    import torch
+    from transformers import BlipForConditionalGeneration, BlipProcessor
+
+    class VisionEncoder(torch.nn.Module):
+        def __init__(self, vision):
+            super().__init__()
+            self.vision = vision
+
+        def forward(self, pixel_values):
+            return self.vision(pixel_values=pixel_values)[0]
+
+    class Decoder(torch.nn.Module):
+        """Text decoder with the self-attention cache flattened to key/value tensors per layer"""
+
+        def __init__(self, decoder):
+            super().__init__()
+            self.decoder = decoder
+
+        def forward(self, input_ids, attention_mask, encoder_hidden_states, *past):
+            past_key_values = _self_attention_cache(past)
+            out = self.decoder(input_ids=input_ids, attention_mask=attention_mask,
+                               encoder_hidden_states=encoder_hidden_states,
+                               past_key_values=past_key_values, use_cache=True, return_dict=True)
+            # only the self-attention cache; cross-attention keys are recomputed from the image
+            return (out.logits[:, -1, :],) + _flat_self_attention(out.past_key_values)
+
+    # the TorchScript exporter, which dynamic_axes and the flattened cache are written for;
+    # newer torch defaults to the dynamo one (and needs onnxscript for it)
+    exporter = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+
+    os.makedirs(directory, exist_ok=True)
+    model = BlipForConditionalGeneration.from_pretrained(checkpoint).eval()
+    processor = BlipProcessor.from_pretrained(checkpoint)
+    text = model.config.text_config
+    layers, heads = text.num_hidden_layers, text.num_attention_heads
+    head_dim = text.hidden_size // heads
+
+    logger.info(f"Exporting {checkpoint} to ONNX in {directory}...")
+    with torch.no_grad():
+        size = processor.image_processor.size
+        pixels = torch.zeros(1, 3, size['height'], size['width'])
+        torch.onnx.export(VisionEncoder(model.vision_model), (pixels,), os.path.join(directory, 'vision.onnx'),
+                          input_names=['pixel_values'], output_names=['image_embeds'],
+                          dynamic_axes={'pixel_values': {0: 'batch'}, 'image_embeds': {0: 'batch'}},
+                          opset_version=opset, **exporter)
+        image_embeds = model.vision_model(pixel_values=pixels)[0]
+
+        decoder = Decoder(model.text_decoder)
+        present_names = [f'present_{kind}_{i}' for i in range(layers) for kind in ('key', 'value')]
+        past_names = [name.replace('present', 'past') for name in present_names]
+        ids = torch.tensor([[text.bos_token_id]])
+        init_axes = {'input_ids': {0: 'batch', 1: 'sequence'}, 'attention_mask': {0: 'batch', 1: 'sequence'},
+                     'encoder_hidden_states': {0: 'batch'}, 'logits': {0: 'batch'}}
+        init_axes.update({name: {0: 'batch', 2: 'sequence'} for name in present_names})
+        torch.onnx.export(decoder, (ids, torch.ones_like(ids), image_embeds), os.path.join(directory, 'decoder_init.onnx'),
+                          input_names=['input_ids', 'attention_mask', 'encoder_hidden_states'],
+                          output_names=['logits'] + present_names, dynamic_axes=init_axes, opset_version=opset,
+                          **exporter)
+
+        # a two-token cache so the past length is traced as a dynamic dimension
+        past = [torch.zeros(1, heads, 2, head_dim) for _ in past_names]
+        step_axes = {'input_ids': {0: 'batch'}, 'attention_mask': {0: 'batch', 1: 'total'},
+                     'encoder_hidden_states': {0: 'batch'}, 'logits': {0: 'batch'}}
+        step_axes.update({name: {0: 'batch', 2: 'past'} for name in past_names})
+        step_axes.update({name: {0: 'batch', 2: 'total'} for name in present_names})
+        torch.onnx.export(decoder, (ids, torch.ones(1, 3, dtype=torch.long), image_embeds, *past),
+                          os.path.join(directory, 'decoder_step.onnx'),
+                          input_names=['input_ids', 'attention_mask', 'encoder_hidden_states'] + past_names,
+                          output_names=['logits'] + present_names, dynamic_axes=step_axes, opset_version=opset,
+                          **exporter)
+
+    processor.save_pretrained(directory)
+    with open(os.path.join(directory, CONFIG_FILE), 'w') as f:
+        json.dump({'checkpoint': checkpoint, 'num_layers': layers, 'bos_token_id': text.bos_token_id,
+                   'eos_token_id': text.sep_token_id, 'pad_token_id': text.pad_token_id}, f, indent=2)
+    logger.info(f"ONNX export of {checkpoint} done")
+    return directory
+
+def _banned_ngram_tokens(sequence: Sequence[int], n: int) -> List[int]:
+    """Tokens that would repeat an n-gram already in the sequence"""
+    if n <= 0 or len(sequence) < n:
+        return []
+    prefix = tuple(sequence[len(sequence) - n + 1:])
+    return [sequence[i + n - 1] for i in range(len(sequence) - n + 1) if tuple(sequence[i:i + n - 1]) == prefix]
+
+def _log_softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    return logits - np.log(np.exp(logits).sum(axis=-1, keepdims=True))
+
+class OnnxBlipCaptioner:
+    """BLIP captioning on ONNX Runtime: encoder once per image, decoder one token at a time"""
+
+    backend = 'onnx'
+
+    def __init__(self, directory: str, threads: Optional[int] = None):
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The ONNX backend needs onnxruntime: pip install onnxruntime") from e
+
+        with open(os.path.join(directory, CONFIG_FILE)) as f:
+            config = json.load(f)
+        self.directory = directory
+        self.num_layers = config['num_layers']
+        self.bos_token_id = config['bos_token_id']
+        self.eos_token_id = config['eos_token_id']
+        self.pad_token_id = config['pad_token_id']
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+
+        def session(name):
+            return ort.InferenceSession(os.path.join(directory, name), options, providers=['CPUExecutionProvider'])
+        self.vision = session('vision.onnx')
+        self.decoder_init = session('decoder_init.onnx')
+        self.decoder_step = session('decoder_step.onnx')
+        self._past_names = [f'past_{kind}_{i}' for i in range(self.num_layers) for kind in ('key', 'value')]
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate resident size: the weights are the bulk of the graph files"""
+        return sum(os.path.getsize(os.path.join(self.directory, name))
+                   for name in ('vision.onnx', 'decoder_init.onnx', 'decoder_step.onnx'))
+
+    def encode(self, pixel_values: np.ndarray) -> np.ndarray:
+        return self.vision.run(None, {'pixel_values': np.asarray(pixel_values, dtype=np.float32)})[0]
+
+    def _decode(self, input_ids, image_embeds, past):
+        """Next-token log-probs of every row plus the updated cache"""
+        mask = np.ones((len(input_ids), input_ids.shape[1] + (past[0].shape[2] if past else 0)), dtype=np.int64)
+        feeds = {'input_ids': input_ids, 'attention_mask': mask, 'encoder_hidden_states': image_embeds}
+        if past:
+            feeds.update(zip(self._past_names, past))
+            outputs = self.decoder_step.run(None, feeds)
+        else:
+            outputs = self.decoder_init.run(None, feeds)
+        return _log_softmax(outputs[0].astype(np.float32)), outputs[1:]
+
+    def _ban(self, log_probs, sequences, no_repeat_ngram_size):
+        for row, sequence in enumerate(sequences):
+            banned = _banned_ngram_tokens(sequence, no_repeat_ngram_size)
+            if banned:
+                log_probs[row, banned] = -np.inf
+
+    def greedy(self, image_embeds, max_length, no_repeat_ngram_size=2, return_scores=False):
+        n = len(image_embeds)
+        sequences = [[self.bos_token_id] for _ in range(n)]
+        finished = np.zeros(n, dtype=bool)
+        logprob, length = np.zeros(n), np.zeros(n)
+        input_ids = np.full((n, 1), self.bos_token_id, dtype=np.int64)
+        past = None
+        while len(sequences[0]) < max_length and not finished.all():
+            log_probs, past = self._decode(input_ids, image_embeds, past)
+            self._ban(log_probs, sequences, no_repeat_ngram_size)
+            best = log_probs.argmax(axis=-1)
+            logprob += np.where(finished, 0.0, log_probs[np.arange(n), best])
+            length += ~finished
+            tokens = np.where(finished, self.pad_token_id, best)
+            for row, token in enumerate(tokens.tolist()):
+                sequences[row].append(token)
+            finished |= tokens == self.eos_token_id
+            input_ids = tokens[:, None].astype(np.int64)
+        if return_scores:
+            # mean token log-prob, comparable with the beam scores
+            return sequences, logprob / np.maximum(length, 1)
+        return sequences
+
+    def beam_search(self, image_embeds, max_length, num_beams, no_repeat_ngram_size=2,
+                    length_penalty=1.0, early_stopping=True, return_scores=False):
+        n, k = len(image_embeds), num_beams
+        # every image gets k rows; only the first beam is live until the first step has spread them out
+        embeds = np.repeat(image_embeds, k, axis=0)
+        beam_scores = np.tile(np.array([0.0] + [-1e9] * (k - 1)), n)
+        sequences = [[self.bos_token_id] for _ in range(n * k)]
+        hypotheses = [[] for _ in range(n)]    # finished (score, tokens) per image
+        done = [False] * n
+        input_ids = np.full((n * k, 1), self.bos_token_id, dtype=np.int64)
+        past = None
+
+        def final_score(logprob, length):
+            return logprob / (length ** length_penalty)
+
+        while len(sequences[0]) < max_length and not all(done):
+            log_probs, past = self._decode(input_ids, embeds, past)
+            self._ban(log_probs, sequences, no_repeat_ngram_size)
+            vocab = log_probs.shape[-1]
+            scores = (log_probs + beam_scores[:, None]).reshape(n, k * vocab)
+            # 2k candidates, so k live beams remain even if some end here
+            top = np.argpartition(-scores, 2 * k - 1, axis=1)[:, :2 * k]
+            top = np.take_along_axis(top, np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1), axis=1)
+
+            next_rows, next_tokens, next_scores = [], [], []
+            for image in range(n):
+                chosen = []
+                if not done[image]:
+                    for rank, flat in enumerate(top[image].tolist()):
+                        beam, token = divmod(flat, vocab)
+                        row, score = image * k + beam, scores[image, flat]
+                        if token == self.eos_token_id:
+                            # an ending only counts if it ranks among the k best candidates
+                            if rank < k:
+                                hypotheses[image].append((final_score(score, len(sequences[row])), sequences[row] + [token]))
+                        else:
+                            chosen.append((row, token, score))
+                        if len(chosen) == k:
+                            break
+                    hypotheses[image] = sorted(hypotheses[image], key=lambda h: -h[0])[:k]
+                    if len(hypotheses[image]) == k and (early_stopping or not chosen or
+                            final_score(chosen[0][2], len(sequences[0])) <= hypotheses[image][-1][0]):
+                        done[image] = True
+                if done[image] or not chosen:
+                    # keep the rows aligned; these beams are never read again
+                    chosen = [(image * k, self.pad_token_id, -1e9)] * k
+                for row, token, score in chosen:
+                    next_rows.append(row)
+                    next_tokens.append(token)
+                    next_scores.append(score)
+
+            sequences = [sequences[row] + [token] for row, token in zip(next_rows, next_tokens)]
+            beam_scores = np.array(next_scores)
+            past = [np.take(t, next_rows, axis=0) for t in past]
+            input_ids = np.array(next_tokens, dtype=np.int64)[:, None]
+
+        results, best_scores = [], []
+        for image in range(n):
+            if not hypotheses[image] or not done[image]:
+                # ran into max_length: the live beams compete with what finished
+                for beam in range(k):
+                    row = image * k + beam
+                    hypotheses[image].append((final_score(beam_scores[row], len(sequences[row])), sequences[row]))
+            score, best = max(hypotheses[image], key=lambda h: h[0])
+            results.append(best)
+            best_scores.append(score)
+        if return_scores:
+            return results, np.array(best_scores)
+        return results
+
+    def generate(self, pixel_values, max_length: int = 50, num_beams: int = 3,
+                 no_repeat_ngram_size: int = 2, **_) -> List[List[int]]:
+        """Token ids for each image, prompt included (temperature is ignored: no sampling)"""
+        if hasattr(pixel_values, 'numpy'):
+            pixel_values = pixel_values.detach().float().numpy()
+        return self.generate_from_embeds(self.encode(pixel_values), max_length, num_beams, no_repeat_ngram_size)
+
+    def generate_from_embeds(self, image_embeds, max_length: int = 50, num_beams: int = 3,
+                             no_repeat_ngram_size: int = 2, return_scores: bool = False):
+        """Decoder only, from vision-encoder outputs computed earlier.
+
+        With `return_scores`, also the length-normalized log-probability of each sequence.
+        """
+        image_embeds = np.asarray(image_embeds, dtype=np.float32)
+        if num_beams <= 1:
+            return self.greedy(image_embeds, max_length, no_repeat_ngram_size, return_scores=return_scores)
+        return self.beam_search(image_embeds, max_length, num_beams, no_repeat_ngram_size,
+                                return_scores=return_scores)
+
+def load_onnx_captioner(model_name: str, checkpoint: str, threads: Optional[int] = None):
+    """(captioner, processor) for a model, exporting it on first use"""
+    from transformers import BlipProcessor
+
+    directory = onnx_dir(model_name)
+    if not os.path.exists(os.path.join(directory, CONFIG_FILE)):
+        export_blip_onnx(checkpoint, directory)
+    return OnnxBlipCaptioner(directory, threads), BlipProcessor.from_pretrained(directory)
+
+def check_parity(images, model_name: str = "BLIP Base", num_beams_options=(1, 3), max_length: int = 50) -> Dict:
+    """Caption the same images with PyTorch and ONNX Runtime; reports how many captions match"""
+    from transformers import BlipForConditionalGeneration
+    from utils import BLIP_CHECKPOINTS, generate_captions_batch
+
+    checkpoint = BLIP_CHECKPOINTS[model_name]
+    onnx_model, processor = load_onnx_captioner(model_name, checkpoint)
+    torch_model = BlipForConditionalGeneration.from_pretrained(checkpoint).eval()
+    pixel_values = processor(images=images, return_tensors="pt")["pixel_values"]
+
+    # the image embeddings should agree to float tolerance before any decoding happens
+    embeds_torch = torch_model.vision_model(pixel_values=pixel_values)[0].detach().numpy()
+    embeds_onnx = onnx_model.encode(pixel_values.numpy())
+    report = {'max_embed_diff': float(np.abs(embeds_torch - embeds_onnx).max())}
+
+    for num_beams in num_beams_options:
+        captions = {}
+        for backend, model in (('torch', torch_model), ('onnx', onnx_model)):
+            captions[backend] = generate_captions_batch(None, model_name, {model_name: model}, {model_name: processor},
+                                                        pixel_values=pixel_values, max_length=max_length,
+                                                        num_beams=num_beams)
+        matches = sum(a == b for a, b in zip(captions['torch'], captions['onnx']))
+        report[f'beams_{num_beams}_match'] = matches / len(images)
+        for a, b in zip(captions['torch'], captions['onnx']):
+            if a != b:
+                logger.warning(f"Parity mismatch (beams={num_beams}): torch '{a}' vs onnx '{b}'")
+    logger.info(f"ONNX parity for {model_name}: {report}")
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export BLIP to ONNX and check it against PyTorch")
+    parser.add_argument('command', choices=['export', 'parity'])
+    parser.add_argument('images', nargs='*', help="Sample images for the parity check")
+    parser.add_argument('--model', default='BLIP Base', choices=['BLIP Base', 'BLIP Large'])
+    parser.add_argument('--tolerance', type=float, default=1e-3, help="Max allowed image embedding difference")
+    args = parser.parse_args(argv)
+
+    from utils import BLIP_CHECKPOINTS
+    if args.command == 'export':
+        export_blip_onnx(BLIP_CHECKPOINTS[args.model], onnx_dir(args.model))
+        return 0
+
+    from image_sources import decode_image
+    paths = sorted({p for pattern in args.images for p in (glob.glob(pattern) or [pattern])})
+    if not paths:
+        parser.error("parity needs sample images")
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(decode_image(f.read()))
+    report = check_parity(images, args.model)
+    print(json.dumps(report, indent=2))
+    # greedy decoding has no search heuristics to disagree on, it has to match exactly
+    ok = report['max_embed_diff'] <= args.tolerance and report.get('beams_1_match', 1.0) == 1.0
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""Inference precision for the BLIP caption models: fp32, bf16, or dynamic int8.
+
+    python precision.py --model "BLIP Large" samples/*.jpg
+
+compares every mode against fp32 on the sample images: seconds per image, speedup,
+weight size and how far the captions drift.
+"""
+from __future__ import annotations
+
+import argparse
+import difflib
+import glob
+import os
+import sys
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# only needed once a model is converted; utils imports this module at startup
+if TYPE_CHECKING:
+    import torch
+
+PRECISION_ENV = "IMAGE2TEXT_PRECISION"
+PRECISIONS = ('fp32', 'bf16', 'int8')
+DEFAULT_PRECISION = 'fp32'
+
+def resolve_precision(precision: Optional[str] = None) -> str:
+    """The requested precision, else the environment's, else fp32"""
+    precision = (precision or os.environ.get(PRECISION_ENV) or DEFAULT_PRECISION).lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision '{precision}', use one of {PRECISIONS}")
+    return precision
+
+def apply_precision(model, precision: str):
+    """Convert a freshly loaded BLIP model to the given precision, in place"""
+    import torch
+    precision = resolve_precision(precision)
+    model.eval()
+    if precision == 'bf16':
+        model.to(torch.bfloat16)
+    elif precision == 'int8':
+        # weights stored as int8, activations quantized on the fly; only the Linear layers
+        # of the vision encoder and text decoder, which is where the time goes on CPU
+        for part in ('vision_model', 'text_decoder'):
+            module = getattr(model, part, None)
+            if module is not None:
+                torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    model.precision = precision
+    return model
+
+def input_dtype(model) -> torch.dtype:
+    """dtype the model's pixel inputs have to be cast to"""
+    import torch
+    for param in model.parameters():
+        if param.is_floating_point():
+            return param.dtype
+    return torch.float32
+
+def _caption_drift(reference: str, caption: str) -> float:
+    """0 for identical captions, 1 for nothing in common (word-level)"""
+    return 1.0 - difflib.SequenceMatcher(None, reference.split(), caption.split()).ratio()
+
+def compare_precisions(images, model_name: str = "BLIP Large", precisions: Sequence[str] = PRECISIONS,
+                       batch_size: int = 8, **generation) -> List[Dict]:
+    """Load the model at each precision and caption the same images; fp32 is the reference"""
+    from transformers import BlipForConditionalGeneration, BlipProcessor
+    from model_registry import model_nbytes
+    from utils import BLIP_CHECKPOINTS, generate_captions_batch
+
+    checkpoint = BLIP_CHECKPOINTS[model_name]
+    processor = BlipProcessor.from_pretrained(checkpoint)
+    pixel_values = processor(images=images, return_tensors="pt")["pixel_values"]
+    precisions = ['fp32'] + [p for p in precisions if p != 'fp32']
+
+    report, reference, baseline = [], None, None
+    for precision in precisions:
+        model = apply_precision(BlipForConditionalGeneration.from_pretrained(checkpoint), precision)
+        models, processors = {model_name: model}, {model_name: processor}
+
+        # one warm-up batch so lazy init and allocator growth are not timed
+        generate_captions_batch(None, model_name, models, processors, pixel_values=pixel_values[:1], **generation)
+        started = time.perf_counter()
+        captions = generate_captions_batch(None, model_name, models, processors, batch_size=batch_size,
+                                           pixel_values=pixel_values, **generation)
+        per_image = (time.perf_counter() - started) / len(images)
+
+        if reference is None:
+            reference, baseline = captions, per_image
+        drift = [_caption_drift(ref, cap) for ref, cap in zip(reference, captions)]
+        report.append({
+            'precision': precision,
+            'seconds_per_image': round(per_image, 4),
+            'speedup': round(baseline / per_image, 2),
+            'weights_mb': round(model_nbytes(model) / 1024 ** 2, 1),
+            'identical_captions': round(sum(d == 0 for d in drift) / len(drift), 3),
+            'mean_drift': round(sum(drift) / len(drift), 3),
+        })
+        logger.info(f"{precision}: {report[-1]}")
+        del model, models
+
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Latency and caption drift of each precision mode against fp32")
+    parser.add_argument('images', nargs='+', help="Sample images (paths or glob patterns)")
+    parser.add_argument('--model', default='BLIP Large', choices=['BLIP Base', 'BLIP Large'])
+    parser.add_argument('--precisions', nargs='+', default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=None, help="torch intra-op threads")
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    from image_sources import decode_image
+    paths = sorted({p for pattern in args.images for p in (glob.glob(pattern) or [pattern])})
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(decode_image(f.read()))
+
+    report = compare_precisions(images, args.model, args.precisions, batch_size=args.batch_size)
+    print(f"{'precision':<10}{'s/image':>10}{'speedup':>9}{'weights MB':>12}{'identical':>11}{'drift':>8}")
+    for row in report:
+        print(f"{row['precision']:<10}{row['seconds_per_image']:>10.3f}{row['speedup']:>8.2f}x"
+              f"{row['weights_mb']:>12.1f}{row['identical_captions']:>11.1%}{row['mean_drift']:>8.3f}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+from __future__ import annotations
+
+from collections import namedtuple
+from typing import TYPE_CHECKING, Dict, Sequence
+
+import numpy as np
+from PIL import Image
+
+from metrics import span, timed
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# decode and resize threads only need numpy; torch is imported once a tensor is built
+if TYPE_CHECKING:
+    import torch
+
+# what a model's image processor does to a PIL image: resize to height x width with
+# `resample`, multiply by `rescale`, then normalize with mean/std per channel
+InputSpec = namedtuple('InputSpec', ['height', 'width', 'resample', 'rescale', 'mean', 'std'])
+
+def input_spec(image_processor) -> InputSpec:
+    """Read the resize/normalize settings of a HF image processor (BLIP, ViT, ...)"""
+    size = image_processor.size
+    height = size.get('height') or size.get('shortest_edge')
+    width = size.get('width') or size.get('shortest_edge')
+    resample = Image.Resampling(int(getattr(image_processor, 'resample', Image.Resampling.BICUBIC)))
+    rescale = image_processor.rescale_factor if getattr(image_processor, 'do_rescale', True) else 1.0
+    if getattr(image_processor, 'do_normalize', True):
+        mean, std = image_processor.image_mean, image_processor.image_std
+    else:
+        mean, std = (0.0, 0.0, 0.0), (1.0, 1.0, 1.0)
+    return InputSpec(height, width, resample, float(rescale),
+                     np.asarray(mean, dtype=np.float32), np.asarray(std, dtype=np.float32))
+
+def to_tensor(image, spec: InputSpec) -> torch.Tensor:
+    """(1, 3, H, W) normalized tensor of an image (PIL or HWC uint8 array) already at the spec's size"""
+    import torch
+    pixels = np.asarray(image, dtype=np.float32)
+    # rescale and normalize folded into one multiply-add
+    scale = spec.rescale / spec.std
+    pixels = pixels * scale - spec.mean / spec.std
+    return torch.from_numpy(np.ascontiguousarray(pixels.transpose(2, 0, 1)))[None]
+
+@timed('preprocess')
+def resize_pyramid(image: Image.Image, specs: Dict[str, InputSpec]) -> Dict[str, np.ndarray]:
+    """Every model's resized (H, W, 3) uint8 pixels from one decode.
+
+    The sizes form a pyramid: the largest input is resized from the decoded image and
+    each smaller one from the level above, so the full-resolution image is resampled
+    once however many models look at it.
+    """
+    levels = {}
+    level = image
+    for name, spec in sorted(specs.items(), key=lambda kv: -kv[1].height * kv[1].width):
+        if level.size != (spec.width, spec.height):
+            level = level.resize((spec.width, spec.height), spec.resample)
+        # a writable copy, torch won't wrap PIL's read-only buffer
+        levels[name] = np.array(level)
+    return levels
+
+def prepare_inputs(image: Image.Image, specs: Dict[str, InputSpec]) -> Dict[str, torch.Tensor]:
+    """Every model's (1, 3, H, W) input tensor from one decode, see resize_pyramid"""
+    return {name: to_tensor(pixels, specs[name]) for name, pixels in resize_pyramid(image, specs).items()}
+
+class BatchPreprocessor:
+    """Builds (N, 3, H, W) model inputs in a preallocated buffer that is reused batch after batch.
+
+    Each image is copied once (uint8, channels-last) into its slot; rescale and normalize
+    then run in place over the whole batch. The returned tensor is a view of the buffer
+    and is only valid until the next call, so one instance serves one consumer thread.
+    `return_tensors='np'` builds numpy arrays instead, for ONNX Runtime without torch.
+    """
+
+    def __init__(self, spec: InputSpec, capacity: int = 8, return_tensors: str = 'pt'):
+        if return_tensors not in ('pt', 'np'):
+            raise ValueError(f"return_tensors must be 'pt' or 'np', got {return_tensors!r}")
+        self.spec = spec
+        self.return_tensors = return_tensors
+        scale = (spec.rescale / spec.std).astype(np.float32).reshape(3, 1, 1)
+        offset = (spec.mean / spec.std).astype(np.float32).reshape(3, 1, 1)
+        if return_tensors == 'pt':
+            import torch
+            scale, offset = torch.from_numpy(scale), torch.from_numpy(offset)
+        self._scale, self._offset = scale, offset
+        self._buffer = self._empty(max(1, capacity))
+
+    def _empty(self, n: int):
+        shape = (n, 3, self.spec.height, self.spec.width)
+        if self.return_tensors == 'np':
+            return np.empty(shape, dtype=np.float32)
+        import torch
+        return torch.empty(shape, dtype=torch.float32)
+
+    @property
+    def capacity(self) -> int:
+        return self._buffer.shape[0]
+
+    def fill(self, arrays: Sequence[np.ndarray]) -> torch.Tensor:
+        """Normalized batch from (H, W, 3) uint8 arrays already at the spec's size"""
+        n = len(arrays)
+        if n > self.capacity:
+            logger.debug("Growing preprocessing buffer to %d images", n)
+            self._buffer = self._empty(n)
+        with span('normalize', n):
+            out = self._buffer[:n]
+            if self.return_tensors == 'np':
+                for slot, pixels in zip(out, arrays):
+                    slot[...] = pixels.transpose(2, 0, 1)
+                out *= self._scale
+                out -= self._offset
+                return out
+            import torch
+            for slot, pixels in zip(out, arrays):
+                # HWC uint8 -> CHW float32 in one strided copy, no temporaries
+                slot.copy_(torch.from_numpy(pixels).permute(2, 0, 1))
+            out.mul_(self._scale).sub_(self._offset)
+        return out
+
+    def __call__(self, images: Sequence[Image.Image]) -> torch.Tensor:
+        """Normalized batch from PIL images of any size and mode (grayscale and RGBA become RGB,
+        alpha dropped, as the HF processors do)"""
+        size = (self.spec.width, self.spec.height)
+        arrays = []
+        for image in images:
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            arrays.append(np.array(image if image.size == size else image.resize(size, self.spec.resample)))
+        return self.fill(arrays)
+
+def max_processor_difference(image_processor, images: Sequence[Image.Image]) -> float:
+    """Largest absolute difference between BatchPreprocessor and the HF processor on some images"""
+    reference = image_processor(images=list(images), return_tensors="pt")["pixel_values"]
+    ours = BatchPreprocessor(input_spec(image_processor), len(images))(images)
+    return float((reference - ours).abs().max())
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# where the cache lives and how big it may grow (0 MB disables it)
+CACHE_PATH_ENV = "IMAGE2TEXT_CACHE_PATH"
+CACHE_MAX_MB_ENV = "IMAGE2TEXT_CACHE_MAX_MB"
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "image2text", "results.sqlite")
+DEFAULT_CACHE_MAX_MB = 256
+
+_FIELDS = ("caption", "nsfw_score", "nsfw_label", "keywords", "meta_description",
+           "caption_model", "caption_confidence")
+# columns added after the first release, with their types, for caches created before them
+_ADDED_COLUMNS = {"caption_model": "TEXT", "caption_confidence": "REAL"}
+_COLUMNS = ", ".join(_FIELDS)
+
+def content_hash(data: bytes) -> str:
+    """Content address of an image: sha256 of its raw bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+class ResultCache:
+    """On-disk (SQLite) cache of captions (with the cascade stage that wrote them), NSFW scores
+    and SEO output keyed by image content"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # shared between the batch worker threads, every access goes through the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                caption TEXT,
+                nsfw_score REAL,
+                nsfw_label TEXT,
+                keywords TEXT,
+                meta_description TEXT,
+                caption_model TEXT,
+                caption_confidence REAL,
+                size INTEGER NOT NULL DEFAULT 0,
+                last_access REAL NOT NULL
+            )
+        """)
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(results)")}
+        for column, kind in _ADDED_COLUMNS.items():
+            if column not in existing:
+                try:
+                    self._conn.execute(f"ALTER TABLE results ADD COLUMN {column} {kind}")
+                except sqlite3.OperationalError as e:
+                    # another process sharing the file added it first
+                    if "duplicate column" not in str(e):
+                        raise
+        self._conn.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        # the total size lives in the file, so every process sharing it (batch_cli workers)
+        # enforces the budget against the same number; caches from before it start from the sum
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), "
+                           "total INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM results")
+
+    @staticmethod
+    def key(digest: str, model_name: str, **params) -> str:
+        """Cache key for an image digest, a model and its generation parameters"""
+        parts = [digest, model_name] + [f"{name}={params[name]}" for name in sorted(params)]
+        return "|".join(parts)
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Cached fields for a key (missing fields are None), or None on a miss"""
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT {_COLUMNS} FROM results WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key))
+
+        entry = dict(zip(_FIELDS, row))
+        if entry["keywords"] is not None:
+            entry["keywords"] = json.loads(entry["keywords"])
+        return entry
+
+    def put(self, key: str, **fields):
+        """Insert or update the given fields of an entry, leaving the others untouched"""
+        unknown = set(fields) - set(_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown cache fields: {sorted(unknown)}")
+        fields = {name: value for name, value in fields.items() if value is not None}
+        if not fields:
+            return
+        if "keywords" in fields:
+            fields["keywords"] = json.dumps(list(fields["keywords"]))
+
+        with self._lock, self._write():
+            existing = self._conn.execute(
+                f"SELECT {_COLUMNS}, size FROM results WHERE key = ?",
+                (key,)
+            ).fetchone()
+            merged = dict(zip(_FIELDS, existing[:-1])) if existing else dict.fromkeys(_FIELDS)
+            merged.update(fields)
+            size = len(key) + sum(len(str(value)) for value in merged.values() if value is not None)
+
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO results (key, {_COLUMNS}, size, last_access) "
+                f"VALUES ({', '.join('?' * (len(_FIELDS) + 3))})",
+                (key, *(merged[name] for name in _FIELDS), size, time.time())
+            )
+            self._conn.execute("UPDATE cache_size SET total = total + ? WHERE id = 0",
+                               (size - (existing[-1] if existing else 0),))
+            self._evict()
+
+    @contextmanager
+    def _write(self):
+        """One write transaction; IMMEDIATE takes the file's write lock up front, so the size
+        read and the eviction see every other process's writes"""
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def _size(self) -> int:
+        return self._conn.execute("SELECT total FROM cache_size WHERE id = 0").fetchone()[0]
+
+    def _evict(self):
+        # least recently used entries go first, down to 90% of the budget
+        total = self._size()
+        if total <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        evicted, freed = 0, 0
+        while total - freed > target:
+            oldest = self._conn.execute("SELECT key, size FROM results ORDER BY last_access LIMIT 256").fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                if total - freed <= target:
+                    break
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                freed += size
+                evicted += 1
+        self._conn.execute("UPDATE cache_size SET total = total - ? WHERE id = 0", (freed,))
+        logger.debug("Result cache over %d bytes, evicted %d entries", self.max_bytes, evicted)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": entries,
+                "size_bytes": self._size(),
+            }
+
+    def clear(self):
+        with self._lock, self._write():
+            self._conn.execute("DELETE FROM results")
+            self._conn.execute("UPDATE cache_size SET total = 0 WHERE id = 0")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+def get_result_cache() -> Optional[ResultCache]:
+    """Process-wide cache configured from the environment, or None when disabled"""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            max_mb = float(os.environ.get(CACHE_MAX_MB_ENV, DEFAULT_CACHE_MAX_MB))
+            if max_mb <= 0:
+                return None
+            path = os.environ.get(CACHE_PATH_ENV) or DEFAULT_CACHE_PATH
+            try:
+                _CACHE = ResultCache(path, int(max_mb * 1024 ** 2))
+                logger.info(f"Result cache at {path} ({max_mb:.0f} MB)")
+            except Exception as e:
+                logger.error(f"Result cache unavailable: {e}")
+                return None
+        return _CACHE
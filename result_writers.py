@@ -0,0 +1,242 @@
+import csv
+import importlib.util
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Sequence
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+# columns written as numbers rather than text in typed formats (Parquet)
+NUMERIC_COLUMNS = {'Toxicity Score'}
+
+class ResultSink(ABC):
+    """Receives result rows as they finish; subclasses persist them incrementally in _write"""
+
+    def __init__(self, columns: Optional[Sequence[str]] = None):
+        self.columns = list(columns) if columns else None
+        self.rows_written = 0
+        self.closed = False
+
+    def write_rows(self, rows: List[Dict]):
+        if not rows:
+            return
+        if self.columns is None:
+            self.columns = list(rows[0])
+        self._write([{column: row.get(column) for column in self.columns} for row in rows])
+        self.rows_written += len(rows)
+
+    @abstractmethod
+    def _write(self, rows: List[Dict]):
+        """Persist rows already projected onto self.columns"""
+
+    def close(self):
+        self.closed = True
+
+    def result(self):
+        """What process_batch_images returns once the sink is closed"""
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if not self.closed:
+            self.close()
+
+class MemorySink(ResultSink):
+    """Keeps every row and returns a DataFrame, the classic in-memory behaviour"""
+
+    def __init__(self, columns=None):
+        super().__init__(columns)
+        self._rows = []
+
+    def write_rows(self, rows):
+        # columns are applied once, when the frame is built
+        self._write(rows)
+        self.rows_written += len(rows)
+
+    def _write(self, rows):
+        self._rows.extend(rows)
+
+    @property
+    def rows(self) -> List[Dict]:
+        """The rows written so far, for a last pass over them before result()"""
+        return self._rows
+
+    def result(self):
+        import pandas as pd
+        return pd.DataFrame(self._rows, columns=self.columns)
+
+class NullSink(ResultSink):
+    """Discards rows, for callers that consume them through on_rows instead"""
+
+    def _write(self, rows):
+        pass
+
+class _FileSink(ResultSink):
+    def __init__(self, path: str, columns=None):
+        super().__init__(columns)
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def result(self):
+        return self.path
+
+class JSONLSink(_FileSink):
+    """One JSON object per line, flushed per micro-batch so partial output stays readable"""
+
+    def __init__(self, path, columns=None):
+        super().__init__(path, columns)
+        self._f = open(path, 'w', encoding='utf-8')
+
+    def _write(self, rows):
+        self._f.writelines(json.dumps(row, default=str) + '\n' for row in rows)
+        self._f.flush()
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+class JSONSink(_FileSink):
+    """A JSON array of records, written incrementally"""
+
+    def __init__(self, path, columns=None, indent=2):
+        super().__init__(path, columns)
+        self.indent = indent
+        self._f = open(path, 'w', encoding='utf-8')
+        self._f.write('[')
+
+    def _write(self, rows):
+        for row in rows:
+            self._f.write(',' if self.rows_written or row is not rows[0] else '')
+            self._f.write('\n' + json.dumps(row, indent=self.indent, default=str))
+        self._f.flush()
+
+    def close(self):
+        self._f.write('\n]\n')
+        self._f.close()
+        super().close()
+
+class CSVSink(_FileSink):
+    """CSV with a header, flushed per micro-batch"""
+
+    def __init__(self, path, columns=None):
+        super().__init__(path, columns)
+        self._f = open(path, 'w', encoding='utf-8', newline='')
+        self._writer = None
+
+    def _write(self, rows):
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._f, fieldnames=self.columns, restval='')
+            self._writer.writeheader()
+        self._writer.writerows(rows)
+        self._f.flush()
+
+    def close(self):
+        if self._writer is None and self.columns:
+            csv.DictWriter(self._f, fieldnames=self.columns).writeheader()
+        self._f.close()
+        super().close()
+
+class ParquetSink(_FileSink):
+    """Parquet via Arrow, buffering rows into row groups of `row_group_size`"""
+
+    def __init__(self, path, columns=None, row_group_size=10000):
+        # only checked here, pyarrow itself is imported once rows are written
+        if importlib.util.find_spec('pyarrow') is None:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+        super().__init__(path, columns)
+        self.row_group_size = row_group_size
+        self._buffer = []
+        self._writer = None
+
+    def _schema(self):
+        import pyarrow as pa
+        return pa.schema([(column, pa.float64() if column in NUMERIC_COLUMNS else pa.string())
+                          for column in self.columns])
+
+    def _convert(self, value, column):
+        if value is None or value == '':
+            return None
+        return float(value) if column in NUMERIC_COLUMNS else str(value)
+
+    def _flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self._buffer:
+            return
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.path, self._schema())
+        arrays = {column: [self._convert(row[column], column) for row in self._buffer] for column in self.columns}
+        self._writer.write_table(pa.Table.from_pydict(arrays, schema=self._schema()))
+        self._buffer = []
+
+    def _write(self, rows):
+        self._buffer.extend(rows)
+        if len(self._buffer) >= self.row_group_size:
+            self._flush()
+
+    def close(self):
+        # the footer is only written here; JSONL/CSV are the formats to use if partial reads matter
+        self._flush()
+        if self._writer is None and self.columns:
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.path, self._schema())
+        if self._writer is not None:
+            self._writer.close()
+        super().close()
+
+class TeeSink(ResultSink):
+    """Writes the same rows to several sinks"""
+
+    def __init__(self, *sinks: ResultSink):
+        self.sinks = sinks
+        super().__init__()
+
+    @property
+    def columns(self):
+        return self._columns
+
+    @columns.setter
+    def columns(self, columns):
+        # every child that has no columns of its own follows ours
+        self._columns = columns
+        for sink in self.sinks:
+            if sink.columns is None:
+                sink.columns = columns
+
+    def write_rows(self, rows):
+        # each child projects onto its own columns
+        self._write(rows)
+        self.rows_written += len(rows)
+
+    def _write(self, rows):
+        for sink in self.sinks:
+            sink.write_rows(rows)
+
+    def close(self):
+        for sink in self.sinks:
+            if not sink.closed:
+                sink.close()
+        super().close()
+
+    def result(self):
+        return [sink.result() for sink in self.sinks]
+
+SINKS_BY_EXTENSION = {
+    '.jsonl': JSONLSink,
+    '.json': JSONSink,
+    '.csv': CSVSink,
+    '.parquet': ParquetSink,
+}
+
+def open_sink(path: str, columns=None) -> ResultSink:
+    """File sink picked from the path's extension"""
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in SINKS_BY_EXTENSION:
+        raise ValueError(f"Unsupported output format '{extension}', use one of {sorted(SINKS_BY_EXTENSION)}")
+    return SINKS_BY_EXTENSION[extension](path, columns=columns)
@@ -0,0 +1,135 @@
+import re
+import threading
+from typing import Iterable, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+WORD_PATTERN = re.compile(r'\b[a-zA-Z]{4,}\b')
+
+# Common words to ignore
+STOP_WORDS = frozenset({
+    'with', 'this', 'that', 'there', 'their', 'about', 'would', 'could',
+    'should', 'which', 'what', 'when', 'where', 'who', 'whom', 'have',
+    'has', 'had', 'been', 'being', 'will', 'shall', 'may', 'might',
+    'must', 'can', 'the', 'a', 'an', 'and', 'or', 'but', 'in',
+    'on', 'at', 'to', 'for', 'of', 'by', 'as', 'is', 'are', 'was'
+})
+
+# good for SEO
+SEO_BOOST_WORDS = frozenset({
+    'professional', 'quality', 'high', 'best', 'premium', 'luxury',
+    'modern', 'contemporary', 'beautiful', 'stunning', 'amazing',
+    'excellent', 'perfect', 'ideal', 'ultimate', 'complete'
+})
+BOOST_FACTOR = 1.5
+
+def tokenize(caption: str) -> List[str]:
+    return [word for word in WORD_PATTERN.findall(caption.lower()) if word not in STOP_WORDS]
+
+def meta_description(caption: str) -> str:
+    """Meta description from a caption: at most 20 words and 160 characters"""
+    words_list = caption.split()
+    if len(words_list) > 20:
+        meta_desc = ' '.join(words_list[:20])
+        # try to end at a sentence boundary
+        if '.' in meta_desc:
+            meta_desc = meta_desc[:meta_desc.rfind('.') + 1]
+        else:
+            meta_desc += '...'
+    else:
+        meta_desc = caption
+
+    # make sure it's not too long for search engines
+    if len(meta_desc) > 160:
+        meta_desc = meta_desc[:157] + '...'
+    return meta_desc
+
+class KeywordExtractor:
+    """TF-IDF keyword scoring over a corpus of captions that grows as batches come in.
+
+    Each caption's keywords are its terms ranked by count x idf x boost, so words
+    every caption shares ("photo", "white") sink below the ones that tell images
+    apart. With a corpus of one caption the idf is flat and the ranking is plain
+    boosted term frequency.
+    """
+
+    def __init__(self, boost_words: Iterable[str] = SEO_BOOST_WORDS, boost: float = BOOST_FACTOR):
+        self.boost_words = frozenset(boost_words)
+        self.boost = boost
+        self.vocabulary = {}            # term -> column
+        self._terms = []
+        self._boosts = []
+        self._df = np.zeros(0, dtype=np.int64)
+        self.documents = 0
+        self._lock = threading.Lock()
+
+    def _term_matrix(self, captions: List[str]) -> sparse.csr_matrix:
+        """(captions x vocabulary) term counts; unseen terms are added to the vocabulary"""
+        rows, cols = [], []
+        for row, caption in enumerate(captions):
+            for term in tokenize(caption):
+                col = self.vocabulary.get(term)
+                if col is None:
+                    col = self.vocabulary[term] = len(self._terms)
+                    self._terms.append(term)
+                    self._boosts.append(self.boost if term in self.boost_words else 1.0)
+                rows.append(row)
+                cols.append(col)
+        counts = sparse.csr_matrix((np.ones(len(rows), dtype=np.float64), (rows, cols)),
+                                   shape=(len(captions), len(self._terms)))
+        counts.sum_duplicates()
+        return counts
+
+    def add(self, captions: List[str]) -> sparse.csr_matrix:
+        """Count the captions into the document frequencies, returns their term matrix"""
+        with self._lock:
+            counts = self._term_matrix(captions)
+            self._df = np.concatenate([self._df, np.zeros(len(self._terms) - len(self._df), dtype=np.int64)])
+            self._df += np.bincount(counts.indices, minlength=len(self._terms))
+            self.documents += len(captions)
+            return counts
+
+    def keywords(self, captions: List[str], max_keywords: int = 5,
+                 counts: Optional[sparse.csr_matrix] = None) -> List[List[str]]:
+        """Top keywords of each caption against the corpus seen so far.
+
+        Scores depend on what has been added before: the first captions of a job are
+        weighed against a small corpus, so keywords can change with input order.
+        """
+        with self._lock:
+            if counts is None:
+                counts = self._term_matrix(captions)
+            n_terms = counts.shape[1]
+            df = np.zeros(n_terms, dtype=np.float64)
+            df[:len(self._df)] = self._df[:n_terms]
+            # smoothed idf, always >= 1 so a term in every caption still counts
+            idf = np.log((1.0 + self.documents) / (1.0 + df)) + 1.0
+            weights = idf * np.asarray(self._boosts[:n_terms])
+            terms = np.asarray(self._terms[:n_terms], dtype=object)
+
+        scores = counts.copy()
+        scores.data *= weights[scores.indices]
+        row_of = np.repeat(np.arange(scores.shape[0]), np.diff(scores.indptr))
+        # by caption, then score descending, then first seen in the corpus
+        order = np.lexsort((scores.indices, -scores.data, row_of))
+        rank = np.arange(len(order)) - scores.indptr[row_of[order]]
+        keep = order[rank < max_keywords]
+
+        keywords = [[] for _ in range(scores.shape[0])]
+        for row, term in zip(row_of[keep].tolist(), terms[scores.indices[keep]].tolist()):
+            keywords[row].append(term)
+        return keywords
+
+def extract_seo_batch(captions: List[str], max_keywords: int = 5,
+                      extractor: Optional[KeywordExtractor] = None) -> List[Tuple[List[str], str]]:
+    """(keywords, meta description) for every caption, scored against the batch itself
+    or against the running corpus of `extractor`"""
+    extractor = extractor or KeywordExtractor()
+    counts = extractor.add(captions)
+    keywords = extractor.keywords(captions, max_keywords, counts=counts)
+    return [(kw, meta_description(caption)) for kw, caption in zip(keywords, captions)]
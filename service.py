@@ -0,0 +1,274 @@
+"""Headless captioning service: one model set per process, shared by every request.
+
+    python service.py --port 8080 --max-batch-size 8 --max-wait-ms 10
+
+    curl --data-binary @photo.jpg "http://localhost:8080/caption?model=large&num_beams=3&timeout_ms=5000"
+
+Concurrent requests are coalesced into micro-batches (see caption_engine.CaptionEngine),
+so throughput grows with the batch size instead of serializing on the model. With
+--workers N the models are loaded once and N forked processes, sharing the weights
+copy-on-write, accept connections on the same port; each reports its own /metrics.
+
+    GET  /healthz   200 while the process is up
+    GET  /readyz    200 once the models are loaded and warmed up, 503 before; includes the
+                    worker's pid and shared/private memory (see memory_report.py)
+    GET  /metrics   stage latencies, batch sizes and request counts in the Prometheus text format
+    POST /caption   image bytes as the body (or JSON {"image": "<base64>", ...options});
+                    options as query parameters: model (base, large, cascade), max_length,
+                    num_beams, temperature, nsfw (0/1), seo (0/1), cascade_threshold, timeout_ms.
+                    504 when the request's deadline passes first.
+"""
+import argparse
+import base64
+import binascii
+import json
+import os
+import signal
+import sys
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from caption_engine import CASCADE_MODEL, CaptionEngine, add_seo, resolve_model
+from memory_report import memory_usage
+from metrics import get_metrics
+from onnx_backend import resolve_backend
+from startup import Warmup, startup_timings
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+MAX_BODY_BYTES = 32 * 1024 ** 2
+DEFAULT_TIMEOUT_S = 30.0
+
+REQUESTS_TOTAL = "image2text_http_requests_total"
+REQUEST_SECONDS = "image2text_http_request_seconds"
+get_metrics().describe(REQUESTS_TOTAL, 'counter', "HTTP requests by path and status code")
+get_metrics().describe(REQUEST_SECONDS, 'histogram', "Seconds from receiving a /caption request to the response")
+
+def _flag(value) -> bool:
+    return str(value).lower() not in ('0', 'false', 'no', 'off')
+
+def parse_options(params: dict):
+    """(generation options, seo, timeout seconds) from query/JSON parameters; ValueError on bad input"""
+    options = {}
+    if params.get('model'):
+        options['model'] = str(params['model'])
+    for name, cast in (('max_length', int), ('num_beams', int), ('temperature', float),
+                       ('cascade_threshold', float)):
+        if params.get(name) not in (None, ''):
+            options[name] = cast(params[name])
+    if 'max_length' in options and not 5 <= options['max_length'] <= 200:
+        raise ValueError("max_length must be between 5 and 200")
+    if 'num_beams' in options and not 1 <= options['num_beams'] <= 8:
+        raise ValueError("num_beams must be between 1 and 8")
+    if 'nsfw' in params:
+        options['nsfw_check'] = _flag(params['nsfw'])
+    timeout = float(params['timeout_ms']) / 1000.0 if params.get('timeout_ms') not in (None, '') else None
+    return options, _flag(params.get('seo', True)), timeout
+
+class CaptionHandler(BaseHTTPRequestHandler):
+    engine = None                   # set by make_server
+    warmup = None                   # the engine's Warmup, set by _serve
+    default_timeout = DEFAULT_TIMEOUT_S
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.address_string(), format % args)
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        get_metrics().inc(REQUESTS_TOTAL, path=urlparse(self.path).path, code=status)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, status: int, payload: dict):
+        self._send(status, json.dumps(payload).encode('utf-8'), 'application/json')
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/healthz':
+            self._send_json(200, {'status': 'ok'})
+        elif path == '/readyz':
+            ready = self.engine.ready.is_set()
+            warm_up = self.warmup.status() if self.warmup is not None else None
+            self._send_json(200 if ready else 503, {'ready': ready, 'warm_up': warm_up,
+                                                    'batcher': self.engine.batcher.stats(),
+                                                    'pid': os.getpid(), 'memory_mb': memory_usage(),
+                                                    'startup_s': startup_timings()})
+        elif path == '/metrics':
+            self._send(200, get_metrics().render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/caption':
+            self._send_json(404, {'error': 'not found'})
+            return
+        started = time.monotonic()
+        length = int(self.headers.get('Content-Length') or 0)
+        if length <= 0:
+            self._send_json(400, {'error': 'empty body, send the image bytes'})
+            return
+        if length > MAX_BODY_BYTES:
+            self._send_json(413, {'error': f'image larger than {MAX_BODY_BYTES} bytes'})
+            self.close_connection = True
+            return
+        body = self.rfile.read(length)
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                payload = json.loads(body)
+                if not isinstance(payload, dict):
+                    raise ValueError('the JSON body must be an object with an "image" field')
+                params.update({k: v for k, v in payload.items() if k != 'image'})
+                body = base64.b64decode(payload['image'], validate=True)
+            options, seo, timeout = parse_options(params)
+            options = self.engine.options(**options)
+        except (ValueError, KeyError, TypeError, binascii.Error) as e:
+            self._send_json(400, {'error': f'bad request: {e}'})
+            return
+
+        deadline = started + (timeout if timeout is not None else self.default_timeout)
+        try:
+            # decode and resize here, on the request's own thread
+            prepared = self.engine.prepare(body, options.model)
+        except Exception as e:
+            self._send_json(400, {'error': f'could not decode image: {e}'})
+            return
+
+        future = self.engine.submit(prepared, options, deadline)
+        try:
+            result = future.result(timeout=max(0.0, deadline - time.monotonic()))
+        except FutureTimeoutError:
+            future.cancel()
+            self._send_json(504, {'error': 'deadline exceeded'})
+            return
+        except Exception as e:
+            logger.error(f"Caption request failed: {e}")
+            self._send_json(500, {'error': str(e)})
+            return
+
+        if seo:
+            result = add_seo(result)
+        elapsed = time.monotonic() - started
+        get_metrics().observe(REQUEST_SECONDS, elapsed)
+        result['elapsed_ms'] = round(1000 * elapsed, 1)
+        self._send_json(200 if result['status'] != 'error' else 500, result)
+
+class CaptionServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # bursts of concurrent uploads are the point, the default backlog of 5 resets them
+    request_queue_size = 256
+
+def make_server(engine, host: str = '127.0.0.1', port: int = 8080, timeout: float = DEFAULT_TIMEOUT_S):
+    """Server bound to the port; `engine` may be None and set later (RequestHandlerClass.engine)"""
+    handler = type('BoundCaptionHandler', (CaptionHandler,), {'engine': engine, 'default_timeout': timeout})
+    return CaptionServer((host, port), handler)
+
+def _serve(server, args):
+    """Run one worker: build the engine, warm it up in the background and serve until interrupted"""
+    engine = CaptionEngine(args.model, args.max_batch_size, args.max_wait_ms,
+                           precision=args.precision, backend=args.backend, weights=args.weights)
+    server.RequestHandlerClass.engine = engine
+    # serve /healthz right away, /readyz flips once the models are in (and stays 503, saying why, if warm-up fails)
+    server.RequestHandlerClass.warmup = Warmup([('caption engine warm-up', engine.warm_up)]).start()
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.close()
+    return 0
+
+def _preload(args):
+    """Load the default model and the NSFW detector before forking workers that share them"""
+    import torch
+    # one thread, so no OpenMP pool exists when we fork; every worker sets its own count
+    torch.set_num_threads(1)
+    from shared_weights import preload_models
+    from utils import CASCADE_STAGES, load_models
+
+    load_models(precision=args.precision, backend=args.backend, weights=args.weights)
+    model = resolve_model(args.model)
+    preload_models((list(CASCADE_STAGES) if model == CASCADE_MODEL else [model]) + ['nsfw_detector'])
+
+def _serve_forked(server, args) -> int:
+    """Fork args.workers processes that all accept on the parent's listening socket"""
+    children = []
+    for worker in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                import torch
+                torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // args.workers))
+                code = _serve(server, args)
+            finally:
+                os._exit(code)
+        children.append(pid)
+    logger.info(f"Forked {args.workers} workers: {children}")
+
+    failed = 0
+    try:
+        for pid in children:
+            _, status = os.waitpid(pid, 0)
+            failed += os.waitstatus_to_exitcode(status) != 0
+    except KeyboardInterrupt:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    finally:
+        server.server_close()
+    return 1 if failed else 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HTTP captioning service with dynamic request batching")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--model', default='BLIP Large', help="Default model: BLIP Base, BLIP Large or BLIP Cascade")
+    parser.add_argument('--max-batch-size', type=int, default=8, help="Most requests run in one generate call")
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help="How long the first request of a batch waits for others to join it")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT_S,
+                        help="Default per-request deadline in seconds (timeout_ms overrides it)")
+    parser.add_argument('--backend', default=None, choices=['torch', 'onnx'])
+    parser.add_argument('--precision', default=None, choices=['fp32', 'bf16', 'int8'])
+    parser.add_argument('--weights', default=None, choices=['copy', 'mmap'],
+                        help="Read weights into memory, or memory-map them shared (default: IMAGE2TEXT_WEIGHTS or copy)")
+    parser.add_argument('--threads', type=int, default=None,
+                        help="torch intra-op threads per worker (default with --workers: cores / workers)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Forked worker processes sharing the preloaded weights and the port")
+    args = parser.parse_args(argv)
+    if args.workers > 1 and (args.backend or os.environ.get('IMAGE2TEXT_BACKEND', 'torch')) == 'onnx':
+        # ONNX Runtime sessions aren't safe to fork
+        parser.error("--workers needs the torch backend")
+
+    server = make_server(None, args.host, args.port, args.timeout)
+    logger.info(f"Serving on http://{args.host}:{args.port} (batch {args.max_batch_size}, wait {args.max_wait_ms} ms, "
+                f"{args.workers} workers)")
+    if args.workers > 1:
+        _preload(args)
+        return _serve_forked(server, args)
+
+    if args.threads and resolve_backend(args.backend) == 'onnx':
+        # read by utils.onnx_threads, so the ONNX path doesn't need torch
+        os.environ['OMP_NUM_THREADS'] = str(args.threads)
+    elif args.threads:
+        import torch
+        torch.set_num_threads(args.threads)
+    return _serve(server, args)
+
+if __name__ == '__main__':
+    sys.exit(main())
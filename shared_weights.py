@@ -0,0 +1,162 @@
+"""Model weights that several worker processes on one host can share.
+
+Two ways to stop every process holding its own copy of the weights:
+
+- IMAGE2TEXT_WEIGHTS=mmap maps the checkpoint's safetensors files read-only (copy-on-write)
+  instead of reading them into private memory, so every process on the host shares the
+  same page-cache pages. Works for separately started processes, e.g. Streamlit replicas.
+- preload_models() loads the models once in a parent process that then forks its workers
+  (`batch_cli.py --preload`, `service.py --workers N`); the workers inherit the weights
+  copy-on-write. Combined with mmap, the parent's pages are the page cache's too.
+
+Weights are only shared while nobody writes to them: bf16 and int8 convert the fp32
+checkpoint into new private tensors, so they get no benefit from either mode.
+See memory_report.py for how much of each worker's memory is actually shared.
+"""
+from __future__ import annotations
+
+import gc
+import json
+import os
+import struct
+from contextlib import nullcontext
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional
+
+# Setup logging
+from logging_config import get_logger
+logger = get_logger(__name__)
+
+if TYPE_CHECKING:
+    import torch
+
+WEIGHTS_ENV = "IMAGE2TEXT_WEIGHTS"
+WEIGHTS_MODES = ('copy', 'mmap')
+DEFAULT_WEIGHTS = 'copy'
+
+# safetensors dtype -> torch dtype name
+_SAFETENSORS_DTYPES = {
+    'F64': 'float64', 'F32': 'float32', 'F16': 'float16', 'BF16': 'bfloat16',
+    'I64': 'int64', 'I32': 'int32', 'I16': 'int16', 'I8': 'int8', 'U8': 'uint8', 'BOOL': 'bool',
+}
+
+def resolve_weights_mode(mode: Optional[str] = None) -> str:
+    """The requested weights mode, else the environment's, else 'copy'"""
+    mode = (mode or os.environ.get(WEIGHTS_ENV) or DEFAULT_WEIGHTS).lower()
+    if mode not in WEIGHTS_MODES:
+        raise ValueError(f"Unknown weights mode '{mode}', use one of {WEIGHTS_MODES}")
+    return mode
+
+def checkpoint_files(checkpoint: str) -> List[str]:
+    """Local paths of a checkpoint's safetensors files (downloaded if needed); [] if it has none"""
+    from transformers.utils import cached_file
+
+    options = {'_raise_exceptions_for_missing_entries': False}
+    single = cached_file(checkpoint, 'model.safetensors', **options)
+    if single:
+        return [single]
+    index = cached_file(checkpoint, 'model.safetensors.index.json', **options)
+    if not index:
+        return []
+    with open(index, encoding='utf-8') as f:
+        shards = sorted(set(json.load(f)['weight_map'].values()))
+    return [cached_file(checkpoint, shard) for shard in shards]
+
+def mmap_state_dict(path: str) -> Dict[str, torch.Tensor]:
+    """Tensors of a safetensors file backed by a private, read-only-in-practice mapping of it.
+
+    Pages are read from the page cache on first touch and stay shared with every other
+    process mapping the same file until someone writes to them.
+    """
+    import torch
+    with open(path, 'rb') as f:
+        header_size, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop('__metadata__', None)
+    data_start = 8 + header_size
+
+    # shared=False maps the file MAP_PRIVATE: writes would go to private copies, never to the file
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=os.path.getsize(path))
+    state = {}
+    for name, info in header.items():
+        dtype = getattr(torch, _SAFETENSORS_DTYPES[info['dtype']])
+        begin, end = info['data_offsets']
+        start = data_start + begin
+        itemsize = torch.empty(0, dtype=dtype).element_size()
+        if start % itemsize:
+            # misaligned for its dtype (the format doesn't promise alignment), this one gets copied
+            raw = torch.empty(0, dtype=torch.uint8).set_(storage, start, (end - begin,))
+            state[name] = raw.clone().view(dtype).reshape(info['shape'])
+        else:
+            state[name] = torch.empty(0, dtype=dtype).set_(storage, start // itemsize, info['shape'])
+    return state
+
+def _no_init():
+    # skip the random init of weights that are about to be replaced anyway
+    try:
+        from transformers.modeling_utils import no_init_weights
+        return no_init_weights()
+    except ImportError:
+        return nullcontext()
+
+def load_mmap_model(checkpoint: str, model_cls=None):
+    """A transformers model whose weights are memory-mapped from the checkpoint's safetensors.
+
+    `model_cls` defaults to the architecture named in the checkpoint's config. Falls back to
+    a normal from_pretrained when the checkpoint has no safetensors or they don't cover the model.
+    """
+    import transformers
+
+    config = transformers.AutoConfig.from_pretrained(checkpoint)
+    if model_cls is None:
+        model_cls = getattr(transformers, config.architectures[0])
+    files = checkpoint_files(checkpoint)
+    if not files:
+        logger.warning(f"{checkpoint} has no safetensors weights, loading a private copy")
+        return model_cls.from_pretrained(checkpoint)
+
+    state = {}
+    for path in files:
+        state.update(mmap_state_dict(path))
+    with _no_init():
+        model = model_cls(config)
+    # from_pretrained would cast e.g. fp16 checkpoints to the model's dtype; those tensors become private copies
+    expected = model.state_dict()
+    for name, tensor in state.items():
+        if name in expected and tensor.dtype != expected[name].dtype:
+            state[name] = tensor.to(expected[name].dtype)
+    missing, unexpected = model.load_state_dict(state, strict=False, assign=True)
+    model.tie_weights()
+
+    # tied weights are left out of the file and point at a mapped tensor once tied
+    mapped = {t.data_ptr() for t in state.values()}
+    params = dict(model.named_parameters(remove_duplicate=False))
+    untied = [name for name in missing if name in params and params[name].data_ptr() not in mapped]
+    if untied or unexpected:
+        logger.warning(f"{checkpoint}: safetensors keys don't match {model_cls.__name__} "
+                       f"({len(untied)} missing, {len(unexpected)} unexpected), loading a private copy")
+        return model_cls.from_pretrained(checkpoint)
+
+    model.eval()
+    logger.info(f"Memory-mapped {checkpoint} from {len(files)} safetensors file(s)")
+    return model
+
+def preload_models(names: Iterable[str]):
+    """Load registered models now, ahead of forking workers that should share them.
+
+    Call with torch limited to one thread (torch.set_num_threads(1)) so the parent starts
+    no OpenMP pool, which isn't safe to fork; workers set their own thread count.
+    """
+    from model_registry import get_registry
+
+    registry = get_registry()
+    for name in names:
+        try:
+            registry.get(name)
+        except KeyError as e:
+            logger.error(f"Could not preload {name}: {e}")
+    # forked workers would inherit the failures; forgotten, each worker tries again (and reports it) on first use
+    registry.clear_failures()
+    # keep the collector from touching (and so copying) the parent's objects in every worker
+    gc.collect()
+    gc.freeze()
+    logger.info(f"Preloaded for fork: {registry.memory_report()}")
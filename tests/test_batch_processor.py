@@ -0,0 +1,56 @@
+"""process_batch_images end to end on stub models: no torch, transformers or downloads"""
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+import utils
+from batch_processor import process_batch_images
+from result_writers import NullSink
+
+class StubCaptioner:
+    """Looks like an OnnxBlipCaptioner to utils, remembers every batch it was given"""
+    backend = 'onnx'
+
+    def __init__(self):
+        self.batches = []
+
+    def generate(self, pixel_values, **_):
+        self.batches.append(pixel_values)
+        return [[1, 2]] * len(pixel_values)
+
+class StubProcessor:
+    image_processor = SimpleNamespace(size={'height': 32, 'width': 32}, resample=3, do_rescale=True,
+                                      rescale_factor=1 / 255, do_normalize=True,
+                                      image_mean=[0.5] * 3, image_std=[0.5] * 3)
+
+    def batch_decode(self, ids, skip_special_tokens=True):
+        return ["a red car parked on a city street"] * len(ids)
+
+@pytest.fixture
+def image_dir(tmp_path):
+    rng = np.random.default_rng(0)
+    for i, size in enumerate([(40, 30), (64, 64), (33, 50), (80, 20), (32, 32)]):
+        pixels = rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+        Image.fromarray(pixels).save(tmp_path / f'img_{i}.png')
+    return tmp_path
+
+@pytest.mark.parametrize('pipeline_mode', [False, True])
+def test_process_batch_images_with_stub_models(image_dir, monkeypatch, pipeline_mode):
+    # numpy caption inputs, as for ONNX, so the test needs no torch
+    monkeypatch.setattr(utils, '_CAPTION_BACKEND', 'onnx')
+    captioner = StubCaptioner()
+    rows = []
+
+    process_batch_images(str(image_dir), "BLIP Base", {"BLIP Base": captioner}, {"BLIP Base": StubProcessor()},
+                         sink=NullSink(), on_rows=lambda names, batch: rows.extend(batch),
+                         batch_size=2, use_cache=False, enable_nsfw_check=False, pipeline_mode=pipeline_mode)
+
+    assert len(rows) == 5
+    assert all(row['Status'] == 'Success' for row in rows), rows
+    assert all(row['Caption'] == "a red car parked on a city street" for row in rows)
+    assert [len(batch) for batch in captioner.batches] == [2, 2, 1]
+    assert all(batch.shape[1:] == (3, 32, 32) for batch in captioner.batches)
+    # every micro-batch is normalized into the same job-wide buffer
+    assert all(np.shares_memory(batch, captioner.batches[0]) for batch in captioner.batches[1:])
@@ -0,0 +1,19 @@
+"""Smoke run of the benchmark suite on its tiny random models"""
+import json
+
+import pytest
+
+pytest.importorskip('torch')
+pytest.importorskip('transformers')
+
+import benchmark
+
+def test_tiny_run_end_to_end(tmp_path):
+    output = tmp_path / 'bench.json'
+    code = benchmark.main(['--images', '2', '--size', '96x64', '--batch-size', '2', '--repeat', '1',
+                           '--max-length', '8', '--num-beams', '1', '--no-cold-start', '--output', str(output)])
+    assert code == 0
+    results = json.loads(output.read_text())
+    assert {'decode', 'preprocess', 'nsfw', 'generate', 'seo'} <= set(results['stages'])
+    assert set(results['end_to_end']) == {'sequential', 'pipelined'}
+    assert all(run['errors'] == 0 and run['images_per_s'] > 0 for run in results['end_to_end'].values())
@@ -0,0 +1,69 @@
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import pytest
+
+from micro_batcher import MicroBatcher
+
+def _doubler(calls):
+    def process(key, items):
+        calls.append((key, list(items)))
+        return [item * 2 for item in items]
+    return process
+
+def test_full_batch_runs_without_waiting():
+    calls = []
+    batcher = MicroBatcher(_doubler(calls), max_batch_size=4, max_wait_ms=10_000)
+    try:
+        started = time.monotonic()
+        futures = [batcher.submit(i) for i in range(4)]
+        assert [f.result(timeout=5) for f in futures] == [0, 2, 4, 6]
+        assert time.monotonic() - started < 5
+        assert calls == [(None, [0, 1, 2, 3])]
+    finally:
+        batcher.close()
+
+def test_keys_are_batched_apart():
+    calls = []
+    batcher = MicroBatcher(_doubler(calls), max_batch_size=8, max_wait_ms=50)
+    try:
+        futures = [batcher.submit(i, key=i % 2) for i in range(4)]
+        assert [f.result(timeout=5) for f in futures] == [0, 2, 4, 6]
+        assert sorted(calls) == [(0, [0, 2]), (1, [1, 3])]
+    finally:
+        batcher.close()
+
+def test_deadline_shorter_than_max_wait_is_met_when_idle():
+    calls = []
+    batcher = MicroBatcher(_doubler(calls), max_batch_size=8, max_wait_ms=1_000)
+    try:
+        future = batcher.submit(21, deadline=time.monotonic() + 0.2)
+        # flushed at once instead of waiting max_wait for company and expiring
+        assert future.result(timeout=5) == 42
+        assert batcher.stats()['expired'] == 0
+    finally:
+        batcher.close()
+
+def test_expired_while_queued_is_dropped():
+    release = threading.Event()
+    calls = []
+
+    def slow(key, items):
+        release.wait(5)
+        return _doubler(calls)(key, items)
+
+    batcher = MicroBatcher(slow, max_batch_size=1, max_wait_ms=0)
+    try:
+        busy = batcher.submit(1)
+        # queued behind the running batch until after its deadline
+        late = batcher.submit(2, deadline=time.monotonic() + 0.05)
+        time.sleep(0.2)
+        release.set()
+        assert busy.result(timeout=5) == 2
+        with pytest.raises(FutureTimeoutError):
+            late.result(timeout=5)
+        assert batcher.stats()['expired'] == 1
+        assert calls == [(None, [1])]
+    finally:
+        batcher.close()
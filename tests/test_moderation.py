@@ -0,0 +1,15 @@
+import numpy as np
+
+from moderation import ModerationEngine
+
+def test_multi_word_term_does_not_match_across_captions():
+    engine = ModerationEngine({'hate speech': 0.5})
+    captions = ["a protester shouting hate", "speech bubbles on a comic page"]
+    np.testing.assert_array_equal(engine.score_batch(captions), [0.0, 0.0])
+    # within one caption any whitespace, newlines included, still joins the words
+    np.testing.assert_allclose(engine.score_batch(["a sign against hate\nspeech", "a dog"]), [0.7, 0.0])
+
+def test_batch_scores_match_single_scores():
+    engine = ModerationEngine()
+    captions = ["a dead tree", "", "violence and hate on a poster", "two kittens", "kill", "naked mole rat"]
+    np.testing.assert_allclose(engine.score_batch(captions), [engine.score(c) for c in captions], rtol=1e-6)
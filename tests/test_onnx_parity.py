@@ -0,0 +1,54 @@
+"""ONNX Runtime against PyTorch on a tiny random BLIP (the benchmark's), nothing downloaded"""
+import numpy as np
+import pytest
+
+torch = pytest.importorskip('torch')
+pytest.importorskip('onnxruntime')
+pytest.importorskip('transformers')
+
+from benchmark import _tiny_blip, _tokenizer
+from onnx_backend import OnnxBlipCaptioner, export_blip_onnx
+from preprocessing import BatchPreprocessor, input_spec
+from utils import encode_image, generate_captions_batch
+
+MODEL = "BLIP Base"
+
+@pytest.fixture(scope='module')
+def blip(tmp_path_factory):
+    """(torch model, ONNX captioner, processor) of the same random weights"""
+    directory = tmp_path_factory.mktemp('blip')
+    model, processor = _tiny_blip(_tokenizer(str(directory), vocab_size=256), seed=0, hidden=32, layers=2,
+                                  image_size=64)
+    checkpoint = directory / 'checkpoint'
+    model.save_pretrained(checkpoint)
+    processor.save_pretrained(checkpoint)
+    onnx_dir = export_blip_onnx(str(checkpoint), str(directory / 'onnx'))
+    return model, OnnxBlipCaptioner(onnx_dir, threads=1), processor
+
+@pytest.fixture(scope='module')
+def images():
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 256, (64, 64, 3), dtype=np.uint8) for _ in range(3)]
+
+def test_image_embeddings_match(blip, images):
+    model, captioner, processor = blip
+    pixels = BatchPreprocessor(input_spec(processor.image_processor), len(images)).fill(images)
+    embeds_torch = encode_image(model, pixels)
+    embeds_onnx = encode_image(captioner, pixels.numpy())
+    assert np.abs(embeds_torch - embeds_onnx).max() <= 1e-3
+
+def test_greedy_captions_match_without_torch_inputs(blip, images):
+    model, captioner, processor = blip
+    spec = input_spec(processor.image_processor)
+    # the ONNX side gets numpy input throughout, the way it runs when torch isn't installed
+    pixels_pt = BatchPreprocessor(spec, len(images)).fill(images)
+    pixels_np = BatchPreprocessor(spec, len(images), return_tensors='np').fill(images)
+    assert isinstance(pixels_np, np.ndarray)
+
+    captions = {}
+    for backend, captioner_or_model, pixels in (('torch', model, pixels_pt), ('onnx', captioner, pixels_np)):
+        captions[backend] = generate_captions_batch(None, MODEL, {MODEL: captioner_or_model}, {MODEL: processor},
+                                                    pixel_values=pixels, max_length=12, num_beams=1)
+    # greedy decoding has no search heuristics to disagree on
+    assert captions['onnx'] == captions['torch']
+    assert not any(caption.startswith("Generation error") for caption in captions['onnx'])
@@ -0,0 +1,44 @@
+"""BatchPreprocessor against the HF BlipProcessor it stands in for"""
+import numpy as np
+import pytest
+from PIL import Image
+
+transformers = pytest.importorskip('transformers')
+
+from benchmark import _tokenizer
+from preprocessing import BatchPreprocessor, input_spec
+
+# the same uint8 pixels in, so only float rounding may differ
+TOLERANCE = 1e-4
+
+@pytest.fixture
+def processor(tmp_path):
+    image_processor = transformers.BlipImageProcessor(size={'height': 384, 'width': 384})
+    return transformers.BlipProcessor(image_processor, _tokenizer(str(tmp_path), vocab_size=128))
+
+def _images():
+    rng = np.random.default_rng(0)
+    return [
+        Image.fromarray(rng.integers(0, 256, (301, 517, 3), dtype=np.uint8), 'RGB'),
+        Image.fromarray(rng.integers(0, 256, (97, 1023, 3), dtype=np.uint8), 'RGB'),
+        Image.fromarray(rng.integers(0, 256, (640, 383), dtype=np.uint8), 'L'),
+        Image.fromarray(rng.integers(0, 256, (385, 211, 4), dtype=np.uint8), 'RGBA'),
+    ]
+
+def test_fill_matches_blip_processor(processor):
+    images = _images()
+    reference = processor(images=images, return_tensors='np')['pixel_values']
+    spec = input_spec(processor.image_processor)
+    size = (spec.width, spec.height)
+    # fill takes arrays already at the model's size, the way the decode stage hands them over
+    arrays = [np.array(image.convert('RGB').resize(size, spec.resample)) for image in images]
+    ours = BatchPreprocessor(spec, len(images), return_tensors='np').fill(arrays)
+    assert ours.shape == reference.shape
+    assert np.abs(ours - reference).max() <= TOLERANCE
+
+def test_call_converts_modes_like_blip_processor(processor):
+    images = _images()
+    reference = processor(images=images, return_tensors='np')['pixel_values']
+    # a buffer smaller than the batch has to grow
+    ours = BatchPreprocessor(input_spec(processor.image_processor), 1, return_tensors='np')(images)
+    assert np.abs(ours - reference).max() <= TOLERANCE
@@ -1,133 +1,382 @@
-import torch
+from __future__ import annotations
+
 import numpy as np
 from PIL import Image
-import nltk
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
-from transformers import BlipProcessor, BlipForConditionalGeneration, pipeline
+import os
 import re
-from typing import List, Tuple, Dict
+import threading
+from typing import TYPE_CHECKING, List, Optional, Tuple, Dict
+
+from model_registry import get_registry
+from moderation import get_moderation_engine
+from seo import KeywordExtractor, extract_seo_batch
+from precision import DEFAULT_PRECISION, apply_precision, input_dtype, resolve_precision
+from onnx_backend import load_onnx_captioner, resolve_backend
+from embedding_cache import get_embedding_cache
+from preprocessing import BatchPreprocessor, InputSpec, input_spec
+from metrics import span
+from shared_weights import load_mmap_model, resolve_weights_mode
 
 #logging
 from logging_config import get_logger
 logger = get_logger(__name__)
 
-# NLTK data we need
-try:
-    nltk.data.find('tokenizers/punkt')
-except LookupError:
-    nltk.download('punkt')
+# torch, transformers and sentence_transformers take seconds to import, so they are imported
+# where they are first needed (model loading, inference) rather than when this module is
+if TYPE_CHECKING:
+    import torch
 
-# wnot using the POS tagger anymore, so no need to download it
+# where each model comes from
+BLIP_CHECKPOINTS = {
+    "BLIP Base": "Salesforce/blip-image-captioning-base",
+    "BLIP Large": "Salesforce/blip-image-captioning-large",
+}
+SENTENCE_MODEL = 'all-MiniLM-L6-v2'
 
-# cache for loaded models
-_MODELS_LOADED = False
-_MODELS_DICT = {}
-_PROCESSOR_DICT = {}
+# cascade: BLIP Base answers, BLIP Large re-captions whatever Base is unsure about
+CASCADE_MODEL = "BLIP Cascade"
+CASCADE_STAGES = ("BLIP Base", "BLIP Large")
+CASCADE_THRESHOLD_ENV = "IMAGE2TEXT_CASCADE_THRESHOLD"
+DEFAULT_CASCADE_THRESHOLD = 0.5
+NSFW_MODEL = "Falconsai/nsfw_image_detection"
 
-def load_models():
-    global _MODELS_LOADED, _MODELS_DICT, _PROCESSOR_DICT
-    
-    if _MODELS_LOADED:
-        logger.info("Models already loaded. Returning cached versions.")
-        return _MODELS_DICT, _PROCESSOR_DICT
-        
-    logger.info("Loading models: BLIP Base, BLIP Large, similarity model, NSFW detector...")
+def _blip_loader(checkpoint: str, precision: str = DEFAULT_PRECISION, weights: str = 'copy'):
+    def load():
+        from transformers import BlipForConditionalGeneration, BlipProcessor
+        if weights == 'mmap':
+            model = load_mmap_model(checkpoint, BlipForConditionalGeneration)
+        else:
+            model = BlipForConditionalGeneration.from_pretrained(checkpoint)
+        model = apply_precision(model, precision)
+        processor = BlipProcessor.from_pretrained(checkpoint)
+        logger.info(f"Loaded {checkpoint} ({precision}, {weights} weights)")
+        return model, processor
+    return load
 
-    # load BLIP Base
-    try:
-        _MODELS_DICT["BLIP Base"] = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-        _PROCESSOR_DICT["BLIP Base"] = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
-        logger.info("BLIP Base loaded successfully.")
-    except Exception as e:
-        logger.error(f"Error loading BLIP Base: {e}")
-    
-    # Load BLIP Large
-    try:
-        _MODELS_DICT["BLIP Large"] = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-large")
-        _PROCESSOR_DICT["BLIP Large"] = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-large")
-        logger.info("BLIP Large loaded successfully.")
-    except Exception as e:
-        logger.error(f"Error loading BLIP Large: {e}")
-    
-    # lload sentence similarity model
-    try:
-        _MODELS_DICT["sentence_similarity"] = SentenceTransformer('all-MiniLM-L6-v2')
-        logger.info("SentenceTransformer similarity model loaded.")
-    except Exception as e:
-        logger.error(f"Error loading similarity model: {e}")
-    
-    # load NSFW model
-    try:
-        _MODELS_DICT["nsfw_detector"] = pipeline(
-            "image-classification", 
-            model="Falconsai/nsfw_image_detection"
-        )
-        logger.info("NSFW detector model loaded.")
-    except Exception as e:
-        logger.error(f"Error loading NSFW model: {e}")
-    
-    _MODELS_LOADED = True
-    logger.info("All models loaded successfully.")
-    return _MODELS_DICT, _PROCESSOR_DICT
+def onnx_threads() -> int:
+    """Intra-op threads for ONNX Runtime: OMP_NUM_THREADS (which torch honours too) if set,
+    else the cores this process may run on, so sharded workers don't oversubscribe them"""
+    threads = os.environ.get('OMP_NUM_THREADS')
+    if threads:
+        return max(1, int(threads))
+    return len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
+def _onnx_loader(model_name: str, checkpoint: str):
+    def load():
+        return load_onnx_captioner(model_name, checkpoint, threads=onnx_threads())
+    return load
+
+def _sentence_loader():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(SENTENCE_MODEL), None
+
+def _nsfw_loader(weights: str = 'copy'):
+    from transformers import pipeline
+    if weights == 'mmap':
+        from transformers import AutoImageProcessor
+        return pipeline("image-classification", model=load_mmap_model(NSFW_MODEL),
+                        image_processor=AutoImageProcessor.from_pretrained(NSFW_MODEL)), None
+    return pipeline("image-classification", model=NSFW_MODEL), None
+
+# how the BLIP models were registered
+_CAPTION_PRECISION = DEFAULT_PRECISION
+_CAPTION_BACKEND = 'torch'
+_CAPTION_WEIGHTS = 'copy'
+
+def resolve_cascade_threshold(threshold: float = None) -> float:
+    """The requested escalation threshold, else the environment's, else the default"""
+    threshold = float(threshold if threshold is not None
+                      else os.environ.get(CASCADE_THRESHOLD_ENV, DEFAULT_CASCADE_THRESHOLD))
+    if not 0.0 <= threshold <= 1.0:
+        raise ValueError(f"Cascade threshold must be between 0 and 1, got {threshold}")
+    return threshold
+
+def input_tensor_type(input_name: str) -> str:
+    """'np' for the caption input of ONNX models, so they run without torch; 'pt' otherwise"""
+    return 'np' if input_name == 'caption' and _CAPTION_BACKEND == 'onnx' else 'pt'
+
+def processor_model(model_name: str) -> str:
+    """The model whose processor prepares the inputs; the cascade's stages share BLIP Base's"""
+    return CASCADE_STAGES[0] if model_name == CASCADE_MODEL else model_name
 
-def check_nsfw_image(image: Image.Image) -> Tuple[float, str]:
+def caption_model_id(model_name: str, cascade_threshold: float = None) -> str:
+    """Model name plus backend/precision, for keying cached captions (torch fp32 keeps the plain name)"""
+    if model_name == CASCADE_MODEL:
+        # a different threshold gives different captions
+        model_name = f"{CASCADE_MODEL} <{resolve_cascade_threshold(cascade_threshold):g}"
+    if _CAPTION_BACKEND == 'onnx':
+        return f"{model_name} (onnx)"
+    if _CAPTION_PRECISION == DEFAULT_PRECISION:
+        return model_name
+    return f"{model_name} ({_CAPTION_PRECISION})"
+
+def load_models(precision: str = None, backend: str = None, weights: str = None):
+    """Register every model with the on-demand registry.
+
+    Nothing is loaded here: each model is loaded the first time it is looked up in the
+    returned dicts, and evicted again (least recently used first) when the registry's
+    memory budget is exceeded. `precision` ('fp32', 'bf16' or 'int8', default from
+    IMAGE2TEXT_PRECISION) applies to the BLIP models; `backend` ('torch' or 'onnx',
+    default from IMAGE2TEXT_BACKEND) picks what runs them. `weights` ('copy' or 'mmap',
+    default from IMAGE2TEXT_WEIGHTS) picks whether torch weights are read into private
+    memory or memory-mapped and shared between processes (see shared_weights).
+    """
+    global _CAPTION_PRECISION, _CAPTION_BACKEND, _CAPTION_WEIGHTS
+    registry = get_registry()
+    if registry.is_registered("nsfw_detector"):
+        # registered once per process; settings asked for later can't change it any more
+        requested = {'precision': (precision and resolve_precision(precision), _CAPTION_PRECISION),
+                     'backend': (backend and resolve_backend(backend), _CAPTION_BACKEND),
+                     'weights': (weights and resolve_weights_mode(weights), _CAPTION_WEIGHTS)}
+        for setting, (wanted, registered) in requested.items():
+            if wanted and wanted != registered:
+                logger.warning(f"Models are already registered with {setting} '{registered}', "
+                               f"ignoring {setting} '{wanted}'")
+        logger.debug("Models already registered. Returning cached registry views.")
+        return registry.models, registry.processors
+
+    precision = _CAPTION_PRECISION = resolve_precision(precision)
+    backend = _CAPTION_BACKEND = resolve_backend(backend)
+    weights = _CAPTION_WEIGHTS = resolve_weights_mode(weights)
+    if backend == 'onnx' and precision != DEFAULT_PRECISION:
+        logger.warning(f"The ONNX backend runs fp32 graphs, ignoring precision {precision}")
+    if weights == 'mmap' and backend == 'torch' and precision != DEFAULT_PRECISION:
+        logger.warning(f"{precision} converts the mapped fp32 weights, the BLIP models won't be shared")
+    mode = 'ONNX Runtime' if backend == 'onnx' else precision
+    logger.info(f"Registering models: BLIP Base, BLIP Large ({mode}), similarity model, NSFW detector (loaded on first use)")
+    for name, checkpoint in BLIP_CHECKPOINTS.items():
+        loader = _onnx_loader(name, checkpoint) if backend == 'onnx' else _blip_loader(checkpoint, precision, weights)
+        registry.register(name, loader)
+    registry.register("sentence_similarity", _sentence_loader)
+    registry.register("nsfw_detector", lambda: _nsfw_loader(weights))
+
+    return registry.models, registry.processors
+
+# labels reported by the NSFW classifier
+NSFW_LABELS = ('nsfw', 'porn', 'adult', 'explicit')
+SAFE_LABELS = ('safe', 'sfw', 'normal')
+
+def check_nsfw_image(image: Image.Image, pixel_values: torch.Tensor = None) -> Tuple[float, str]:
     """Check if an image contains NSFW content"""
-    logger.info("Running NSFW detection...")
+    scores, labels = check_nsfw_batch([image], pixel_values=pixel_values)
+    return float(scores[0]), str(labels[0])
+
+def _classify_pixels(nsfw_detector, pixel_values: torch.Tensor, batch_size: int):
+    """Run the classifier on prepared pixel tensors, skipping the pipeline's own preprocessing"""
+    import torch
+    model = nsfw_detector.model
+    id2label = model.config.id2label
+    probs = []
+    with torch.no_grad():
+        for start in range(0, len(pixel_values), batch_size):
+            chunk = pixel_values[start:start + batch_size].to(model.dtype)
+            probs.append(model(pixel_values=chunk).logits.float().softmax(dim=-1).numpy())
+    return np.concatenate(probs), [id2label[j] for j in range(len(id2label))]
+
+def check_nsfw_batch(images: List[Image.Image], batch_size: int = 8,
+                     pixel_values: torch.Tensor = None) -> Tuple[np.ndarray, np.ndarray]:
+    """Screen a list of images for NSFW content in one pipeline call.
+
+    Returns a float array of NSFW scores and an array of labels, aligned with `images`.
+    With `pixel_values` (the detector's input tensor, see model_input_specs) the
+    classifier runs on them directly and `images` is only used for its length.
+    """
+    n = len(pixel_values) if pixel_values is not None else len(images)
+    logger.debug("Running NSFW detection on %d images", n)
     try:
         models_dict, _ = load_models()
         nsfw_detector = models_dict.get("nsfw_detector")
         if not nsfw_detector:
             logger.warning("NSFW detector unavailable.")
-            return 0.0, "Model not available"
-        
-        results = nsfw_detector(image)
-        logger.debug(f"NSFW raw results: {results}")
-        
-        #we look for explicit content labels first
-        for result in results:
-            if result['label'] in ['nsfw', 'porn', 'adult', 'explicit']:
-                logger.warning(f"NSFW content detected: {result['label']} ({result['score']:.2f})")
-                return result['score'], result['label']
-        
-        # If no explicit content, check for safe labels
-        for result in results:
-            if result['label'] in ['safe', 'sfw', 'normal']:
-                logger.info("Image classified as safe.")
-                return 1 - result['score'], "safe"
-        
-        logger.warning("Unknown NSFW classification.")
-        return 0.0, "unknown"
-        
+            return np.zeros(n, dtype=np.float32), np.full(n, "Model not available", dtype=object)
+        if n == 0:
+            return np.zeros(0, dtype=np.float32), np.empty(0, dtype=object)
+
+        if pixel_values is not None:
+            with span('nsfw', n):
+                score_matrix, vocab = _classify_pixels(nsfw_detector, pixel_values, max(1, int(batch_size)))
+        else:
+            # top_k=None so every label comes back for every image
+            with span('nsfw', n):
+                results = nsfw_detector(images, batch_size=max(1, int(batch_size)), top_k=None)
+            logger.debug("NSFW raw results: %s", results)
+
+            # (N, L) score matrix over the label vocabulary, NaN where a label is missing
+            vocab = sorted({r['label'] for per_image in results for r in per_image})
+            column = {label: j for j, label in enumerate(vocab)}
+            score_matrix = np.full((n, len(vocab)), np.nan, dtype=np.float32)
+            for i, per_image in enumerate(results):
+                for r in per_image:
+                    score_matrix[i, column[r['label']]] = r['score']
+
+        vocab = np.array(vocab, dtype=object)
+        nsfw_cols = np.isin(vocab, NSFW_LABELS)
+        safe_cols = np.isin(vocab, SAFE_LABELS)
+
+        scores = np.zeros(n, dtype=np.float32)
+        labels = np.full(n, "unknown", dtype=object)
+
+        # explicit content labels win, then fall back to the safe labels
+        if safe_cols.any():
+            safe = score_matrix[:, safe_cols]
+            has_safe = ~np.isnan(safe).all(axis=1)
+            scores[has_safe] = 1 - np.nanmax(safe[has_safe], axis=1)
+            labels[has_safe] = "safe"
+        if nsfw_cols.any():
+            nsfw = score_matrix[:, nsfw_cols]
+            has_nsfw = ~np.isnan(nsfw).all(axis=1)
+            filled = np.where(np.isnan(nsfw), -1.0, nsfw)
+            scores[has_nsfw] = filled[has_nsfw].max(axis=1)
+            labels[has_nsfw] = vocab[nsfw_cols][filled[has_nsfw].argmax(axis=1)]
+
+        if (labels == "unknown").any():
+            logger.warning(f"Unknown NSFW classification for {int((labels == 'unknown').sum())} images.")
+        return scores, labels
+
     except Exception as e:
         logger.error(f"NSFW detection error: {e}")
-        return 0.0, "error"
+        return np.zeros(n, dtype=np.float32), np.full(n, "error", dtype=object)
 
-def generate_caption(image, model_name, models_dict, processor_dict, max_length=50, num_beams=3, temperature=0.7):
-    """Generate a caption for an image using the specified model"""
-    logger.info(f"Generating caption with model: {model_name}")
+def model_input_specs(model_name, processor_dict, include_nsfw: bool = True) -> Dict[str, InputSpec]:
+    """Input specs for prepare_inputs: 'caption' for the BLIP model, 'nsfw' for the detector"""
+    specs = {'caption': input_spec(processor_dict[processor_model(model_name)].image_processor)}
+    if include_nsfw:
+        models_dict, _ = load_models()
+        nsfw_detector = models_dict.get("nsfw_detector")
+        if nsfw_detector is not None and getattr(nsfw_detector, "image_processor", None) is not None:
+            specs['nsfw'] = input_spec(nsfw_detector.image_processor)
+    return specs
+
+def _generate_ids(model, pixel_values, max_length, num_beams, temperature):
+    """Token ids from either backend: a PyTorch BLIP model or an OnnxBlipCaptioner"""
+    with span('generate', len(pixel_values)):
+        if getattr(model, "backend", "torch") == "onnx":
+            return model.generate(pixel_values, max_length=max_length, num_beams=num_beams, no_repeat_ngram_size=2)
+        import torch
+        with torch.no_grad():
+            return model.generate(
+                pixel_values=pixel_values.to(input_dtype(model)),
+                max_length=max_length,
+                num_beams=num_beams,
+                temperature=temperature,
+                early_stopping=True,
+                no_repeat_ngram_size=2
+            )
+
+def encode_image(model, pixel_values) -> np.ndarray:
+    """Vision-encoder output (N, tokens, hidden) of either backend, as float32"""
+    with span('encode', len(pixel_values)):
+        if getattr(model, "backend", "torch") == "onnx":
+            return model.encode(pixel_values.numpy() if hasattr(pixel_values, "numpy") else pixel_values)
+        import torch
+        with torch.no_grad():
+            embeds = model.vision_model(pixel_values=pixel_values.to(input_dtype(model)))[0]
+        return embeds.float().numpy()
+
+def _sequence_confidence(text_decoder, out, num_beams, eos_token_id) -> np.ndarray:
+    """exp of each generated sequence's length-normalized log-prob: its geometric-mean token probability"""
+    if num_beams > 1:
+        # the beam score already is the summed log-prob over the length
+        logprob = out.sequences_scores
+    else:
+        import torch
+        steps = text_decoder.compute_transition_scores(out.sequences, out.scores, normalize_logits=True)
+        tokens = out.sequences[:, -steps.shape[1]:]
+        is_eos = (tokens == eos_token_id).int()
+        # the eos itself counts, the padding after it doesn't
+        valid = (is_eos.cumsum(dim=1) - is_eos) == 0
+        logprob = torch.where(valid, steps, torch.zeros_like(steps)).sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+    return logprob.float().exp().numpy()
+
+def _generate_ids_from_embeds(model, image_embeds: np.ndarray, max_length, num_beams, temperature,
+                              with_confidence: bool = False):
+    """Run only the text decoder, on vision-encoder outputs from encode_image.
+
+    With `with_confidence`, returns (ids, confidence) with a 0-1 confidence per sequence.
+    """
+    with span('generate', len(image_embeds)):
+        if getattr(model, "backend", "torch") == "onnx":
+            out = model.generate_from_embeds(image_embeds, max_length=max_length, num_beams=num_beams,
+                                             no_repeat_ngram_size=2, return_scores=with_confidence)
+            if with_confidence:
+                return out[0], np.exp(out[1]).astype(np.float32)
+            return out
+
+        # what BlipForConditionalGeneration.generate does after its vision encoder
+        import torch
+        text_config = model.config.text_config
+        embeds = torch.from_numpy(np.array(image_embeds, dtype=np.float32)).to(input_dtype(model))
+        input_ids = torch.full((embeds.shape[0], 1), text_config.bos_token_id, dtype=torch.long)
+        with torch.no_grad():
+            out = model.text_decoder.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                encoder_hidden_states=embeds,
+                encoder_attention_mask=torch.ones(embeds.shape[:-1], dtype=torch.long),
+                eos_token_id=text_config.sep_token_id,
+                pad_token_id=text_config.pad_token_id,
+                max_length=max_length,
+                num_beams=num_beams,
+                temperature=temperature,
+                early_stopping=True,
+                no_repeat_ngram_size=2,
+                output_scores=with_confidence,
+                return_dict_in_generate=with_confidence
+            )
+            if not with_confidence:
+                return out
+            confidence = _sequence_confidence(model.text_decoder, out, num_beams, text_config.sep_token_id)
+        return out.sequences, confidence
+
+def decode_tokens(processor, ids) -> List[str]:
+    """Caption strings from generated token ids"""
+    with span('decode_tokens', len(ids)):
+        return [caption.strip() for caption in processor.batch_decode(ids, skip_special_tokens=True)]
+
+def _image_embeds(model, model_name, image, processor, image_key=None, embedding_cache=None, pixel_values=None):
+    """Vision-encoder output for one image, from the embedding cache when it has it"""
+    if embedding_cache is None and image_key is not None:
+        embedding_cache = get_embedding_cache()
+    cache_key = embedding_cache.key(image_key, caption_model_id(model_name)) \
+        if embedding_cache is not None and image_key is not None else None
+    image_embeds = embedding_cache.get(cache_key) if cache_key else None
+
+    if image_embeds is None:
+        # prepare the image
+        if pixel_values is None:
+            pixel_values = processor(images=image, return_tensors=input_tensor_type('caption'))["pixel_values"]
+            logger.debug("Input tensor prepared for caption generation.")
+        image_embeds = encode_image(model, pixel_values)
+        if cache_key:
+            embedding_cache.put(cache_key, image_embeds)
+    else:
+        logger.debug("Reusing cached vision-encoder output.")
+    return image_embeds
+
+def generate_caption(image, model_name, models_dict, processor_dict, max_length=50, num_beams=3, temperature=0.7,
+                     image_key: str = None, embedding_cache=None, pixel_values: torch.Tensor = None):
+    """Generate a caption for an image using the specified model.
+
+    With `image_key` (e.g. the image's content hash) the vision-encoder output is looked
+    up in / stored to the embedding cache, so only the text decoder reruns when just the
+    decoding settings change. `pixel_values` (from prepare_inputs) skips the processor.
+    """
+    logger.debug("Generating caption with model: %s", model_name)
+    if model_name == CASCADE_MODEL:
+        caption, _, _ = generate_caption_cascade(image, models_dict, processor_dict, max_length, num_beams, temperature,
+                                                 image_key=image_key, embedding_cache=embedding_cache,
+                                                 pixel_values=pixel_values)
+        return caption
     try:
         if model_name in ["BLIP Base", "BLIP Large"]:
             processor = processor_dict[model_name]
             model = models_dict[model_name]
-            
-            # prepare the image
-            inputs = processor(images=image, return_tensors="pt")
-            logger.debug("Input tensor prepared for caption generation.")
-            
+            image_embeds = _image_embeds(model, model_name, image, processor, image_key, embedding_cache, pixel_values)
+
             #  Generate the caption
-            with torch.no_grad():
-                out = model.generate(
-                    **inputs,
-                    max_length=max_length,
-                    num_beams=num_beams,
-                    temperature=temperature,
-                    early_stopping=True,
-                    no_repeat_ngram_size=2
-                )
-            
-            caption = processor.decode(out[0], skip_special_tokens=True)
-            logger.info(f"Caption generated: {caption}")
+            out = _generate_ids_from_embeds(model, image_embeds, max_length, num_beams, temperature)
+            caption = decode_tokens(processor, out[:1])[0]
+            logger.debug("Caption generated: %s", caption)
         else:
             logger.error(f"Unsupported model: {model_name}")
             caption = "Model not supported"
@@ -138,68 +387,178 @@ def generate_caption(image, model_name, models_dict, processor_dict, max_length=
         logger.error(f"Caption generation error: {e}")
         return f"Generation error: {str(e)}"
 
-def generate_seo_metadata(caption: str, max_keywords: int = 5) -> Tuple[List[str], str, float]:
-    """Generate SEO keywords and meta description from a caption"""
-    logger.info("Generating SEO metadata...")
-    logger.debug(f"Caption received: {caption}")
+def generate_caption_cascade(image, models_dict, processor_dict, max_length=50, num_beams=3, temperature=0.7,
+                             image_key: str = None, embedding_cache=None, pixel_values: torch.Tensor = None,
+                             threshold: float = None) -> Tuple[str, str, float]:
+    """Caption with BLIP Base, and again with BLIP Large if Base's confidence is below `threshold`.
 
+    Returns (caption, model that answered, Base's confidence). Confidence is the
+    geometric-mean token probability of Base's caption (the beam score, exponentiated);
+    `threshold` defaults to IMAGE2TEXT_CASCADE_THRESHOLD. Both stages take the same
+    input, so `pixel_values` feeds either.
+    """
+    base_name, large_name = CASCADE_STAGES
     try:
-        # simple method (without pos tagging)
-        words = re.findall(r'\b[a-zA-Z]{4,}\b', caption.lower())
-        
-        # Common words to ignore
-        stop_words = {
-            'with', 'this', 'that', 'there', 'their', 'about', 'would', 'could',
-            'should', 'which', 'what', 'when', 'where', 'who', 'whom', 'have',
-            'has', 'had', 'been', 'being', 'will', 'shall', 'may', 'might',
-            'must', 'can', 'could', 'the', 'a', 'an', 'and', 'or', 'but', 'in',
-            'on', 'at', 'to', 'for', 'of', 'with', 'by', 'as', 'is', 'are', 'was'
-        }
-        
-        # filter out the  words
-        filtered_words = [word for word in words if word not in stop_words]
-        
-        # Count how often each word appears
-        word_freq = {}
-        for word in filtered_words:
-            word_freq[word] = word_freq.get(word, 0) + 1
-        
-        #good for SEO
-        seo_boost_words = {
-            'professional', 'quality', 'high', 'best', 'premium', 'luxury',
-            'modern', 'contemporary', 'beautiful', 'stunning', 'amazing',
-            'excellent', 'perfect', 'ideal', 'ultimate', 'complete'
-        }
-        
-        # Give SEO friendly words a boost
-        for word in word_freq:
-            if word in seo_boost_words:
-                word_freq[word] *= 1.5
-        
-        # pickin top keywords
-        keywords = sorted(word_freq.items(), key=lambda x: x[1], reverse=True)[:max_keywords]
-        keywords = [kw[0] for kw in keywords]
+        threshold = resolve_cascade_threshold(threshold)
+        processor = processor_dict[base_name]
+        model = models_dict[base_name]
+        image_embeds = _image_embeds(model, base_name, image, processor, image_key, embedding_cache, pixel_values)
+        out, confidence = _generate_ids_from_embeds(model, image_embeds, max_length, num_beams, temperature,
+                                                    with_confidence=True)
+        caption, confidence = decode_tokens(processor, out[:1])[0], float(confidence[0])
+    except Exception as e:
+        logger.error(f"Caption generation error: {e}")
+        return f"Generation error: {str(e)}", base_name, 0.0
+    if confidence >= threshold:
+        logger.debug("Caption generated by %s (confidence %.2f): %s", base_name, confidence, caption)
+        return caption, base_name, confidence
 
-        logger.info(f"SEO keywords: {keywords}")
-        
-        #create a meta description from the caption
-        words_list = caption.split()
-        if len(words_list) > 20:
-            meta_desc = ' '.join(words_list[:20])
-            # t ry to end at a sentence boundary
-            if '.' in meta_desc:
-                last_period = meta_desc.rfind('.')
-                meta_desc = meta_desc[:last_period + 1]
+    logger.debug("%s confidence %.2f below %g, re-captioning with %s", base_name, confidence, threshold, large_name)
+    try:
+        # only now does BLIP Large get loaded
+        processor = processor_dict[large_name]
+        model = models_dict[large_name]
+        image_embeds = _image_embeds(model, large_name, image, processor, image_key, embedding_cache, pixel_values)
+        out = _generate_ids_from_embeds(model, image_embeds, max_length, num_beams, temperature)
+        caption = decode_tokens(processor, out[:1])[0]
+        logger.debug("Caption generated by %s: %s", large_name, caption)
+        return caption, large_name, confidence
+    except Exception as e:
+        logger.error(f"{large_name} unavailable, keeping the {base_name} caption: {e}")
+        return caption, base_name, confidence
+
+_BATCH_PREPROCESSORS = threading.local()
+
+def batch_preprocessor(model_name, processor_dict) -> BatchPreprocessor:
+    """This thread's BatchPreprocessor for a caption model; its output is reused on the next call"""
+    preprocessors = getattr(_BATCH_PREPROCESSORS, "by_model", None)
+    if preprocessors is None:
+        preprocessors = _BATCH_PREPROCESSORS.by_model = {}
+    image_processor = processor_dict[model_name].image_processor
+    owner, preprocessor = preprocessors.get(model_name, (None, None))
+    # a reloaded model comes with a new processor
+    if owner is not image_processor:
+        preprocessor = BatchPreprocessor(input_spec(image_processor), return_tensors=input_tensor_type('caption'))
+        preprocessors[model_name] = (image_processor, preprocessor)
+    return preprocessor
+
+def preprocess_images(images: List[Image.Image], model_name, processor_dict) -> torch.Tensor:
+    """Turn PIL images into the (N, 3, H, W) pixel tensor expected by a caption model (a fresh
+    tensor from the HF processor, the reference the batch preprocessors are checked against)"""
+    processor = processor_dict[model_name]
+    return processor(images=images, return_tensors="pt")["pixel_values"]
+
+def generate_captions_batch(images: List[Image.Image], model_name, models_dict, processor_dict,
+                            max_length=50, num_beams=3, temperature=0.7, batch_size=8,
+                            pixel_values: torch.Tensor = None) -> List[str]:
+    """Generate captions for a list of images, one generate call per micro-batch.
+
+    Pass `pixel_values` (from `preprocess_images`) to skip preprocessing; `images` is then ignored.
+    """
+    if model_name == CASCADE_MODEL:
+        captions, _, _ = generate_captions_cascade(images, models_dict, processor_dict, max_length, num_beams,
+                                                   temperature, batch_size, pixel_values)
+        return captions
+    n = len(pixel_values) if pixel_values is not None else len(images)
+    logger.debug("Generating %d captions with model: %s (batch size %s)", n, model_name, batch_size)
+    if model_name not in ["BLIP Base", "BLIP Large"]:
+        logger.error(f"Unsupported model: {model_name}")
+        return ["Model not supported"] * n
+
+    try:
+        processor = processor_dict[model_name]
+        model = models_dict[model_name]
+    except KeyError as e:
+        logger.error(f"Caption model unavailable: {e}")
+        return [f"Generation error: model {model_name} not available"] * n
+    batch_size = max(1, int(batch_size))
+
+    captions = []
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        try:
+            if pixel_values is not None:
+                chunk_pixels = pixel_values[start:stop]
             else:
-                meta_desc += '...'
-        else:
-            meta_desc = caption
-        
-        # mke sure it's not too long for search engines
-        if len(meta_desc) > 160:
-            meta_desc = meta_desc[:157] + '...'
-        
-        logger.info("SEO metadata generated successfully.")
+                # resized and normalized straight into this thread's reusable (N, 3, H, W) buffer
+                chunk_pixels = batch_preprocessor(model_name, processor_dict)(images[start:stop])
+            logger.debug("Input batch prepared: %s", tuple(chunk_pixels.shape))
+
+            out = _generate_ids(model, chunk_pixels, max_length, num_beams, temperature)
+            captions.extend(decode_tokens(processor, out))
+
+        except Exception as e:
+            logger.error(f"Batch caption generation error: {e}")
+            captions.extend([f"Generation error: {str(e)}"] * (stop - start))
+
+    return captions
+
+def generate_captions_cascade(images: List[Image.Image], models_dict, processor_dict,
+                              max_length=50, num_beams=3, temperature=0.7, batch_size=8,
+                              pixel_values: torch.Tensor = None,
+                              threshold: float = None) -> Tuple[List[str], List[str], np.ndarray]:
+    """Batch version of generate_caption_cascade: BLIP Large only sees the images Base was unsure about.
+
+    Returns the captions, the model that answered each one and Base's confidence for each
+    image (float32). `pixel_values` are the shared input of both stages.
+    """
+    n = len(pixel_values) if pixel_values is not None else len(images)
+    base_name, large_name = CASCADE_STAGES
+    captions, answered_by = [""] * n, [base_name] * n
+    confidence = np.zeros(n, dtype=np.float32)
+    try:
+        threshold = resolve_cascade_threshold(threshold)
+        processor = processor_dict[base_name]
+        model = models_dict[base_name]
+    except (KeyError, ValueError) as e:
+        logger.error(f"Caption cascade unavailable: {e}")
+        return [f"Generation error: {e}"] * n, answered_by, confidence
+    logger.debug("Generating %d captions with %s, escalating below confidence %g", n, base_name, threshold)
+    batch_size = max(1, int(batch_size))
+
+    for start in range(0, n, batch_size):
+        stop = min(start + batch_size, n)
+        try:
+            if pixel_values is not None:
+                chunk_pixels = pixel_values[start:stop]
+            else:
+                chunk_pixels = batch_preprocessor(base_name, processor_dict)(images[start:stop])
+            out, chunk_confidence = _generate_ids_from_embeds(model, encode_image(model, chunk_pixels), max_length,
+                                                              num_beams, temperature, with_confidence=True)
+            captions[start:stop] = decode_tokens(processor, out)
+            confidence[start:stop] = chunk_confidence
+        except Exception as e:
+            logger.error(f"Batch caption generation error: {e}")
+            captions[start:stop] = [f"Generation error: {str(e)}"] * (stop - start)
+            continue
+
+        unsure = np.flatnonzero(chunk_confidence < threshold)
+        if len(unsure) == 0:
+            continue
+        try:
+            large_processor = processor_dict[large_name]
+            large_model = models_dict[large_name]
+            # a copy out of the reusable buffer; BLIP Large takes the same 384x384 input
+            out = _generate_ids(large_model, chunk_pixels[unsure.tolist()], max_length, num_beams, temperature)
+            for j, caption in zip(unsure.tolist(), decode_tokens(large_processor, out)):
+                captions[start + j] = caption
+                answered_by[start + j] = large_name
+        except Exception as e:
+            logger.error(f"{large_name} unavailable, keeping {len(unsure)} {base_name} captions: {e}")
+
+    escalated = answered_by.count(large_name)
+    logger.debug("Cascade: %d captions from %s, %d from %s", n - escalated, base_name, escalated, large_name)
+    return captions, answered_by, confidence
+
+def generate_seo_metadata(caption: str, max_keywords: int = 5) -> Tuple[List[str], str, float]:
+    """Generate SEO keywords and meta description from a caption"""
+    logger.debug("Generating SEO metadata for caption: %s", caption)
+
+    try:
+        # a corpus of one: keywords are the boosted term frequencies
+        with span('seo'):
+            (keywords, meta_desc), = extract_seo_batch([caption], max_keywords)
+        logger.debug("SEO keywords: %s", keywords)
         return keywords, meta_desc, 0.0
         
     except Exception as e:
@@ -222,33 +581,45 @@ def generate_seo_metadata(caption: str, max_keywords: int = 5) -> Tuple[List[str
         
         return keywords, meta_description, 0.0
 
+def generate_seo_batch(captions: List[str], max_keywords: int = 5,
+                       extractor: Optional[KeywordExtractor] = None) -> List[Tuple[List[str], str]]:
+    """SEO keywords and meta descriptions for a whole batch of captions.
+
+    Keywords are TF-IDF weighted against the batch (or the running corpus of
+    `extractor`), so words shared by every caption rank below distinctive ones.
+    """
+    try:
+        with span('seo', len(captions)):
+            return extract_seo_batch(captions, max_keywords, extractor)
+    except Exception as e:
+        logger.error(f"Batch SEO metadata generation error: {e}")
+        return [generate_seo_metadata(caption, max_keywords)[:2] for caption in captions]
+
+def encode_captions(captions: List[str], models_dict, batch_size: int = 64) -> np.ndarray:
+    """Sentence embeddings of captions as unit-length float32 rows"""
+    model = models_dict.get("sentence_similarity")
+    if model is None:
+        raise RuntimeError("Sentence similarity model not available")
+    embeddings = model.encode(captions, batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True)
+    return np.asarray(embeddings, dtype=np.float32)
+
 def moderate_content(text: str) -> float:
     """Check text for potentially toxic content"""
-    logger.info("Running toxicity moderation...")
     try:
-        #patterns that might indicate toxic content
-        toxic_patterns = [
-            r'\b(hate|violence|kill|attack|terror|abuse|hurt|harm)\b',
-            r'\b(die|death|dead|murder|suicide)\b',
-            r'\b(racist|sexist|homophobic|transphobic)\b',
-            r'\b(nude|naked|porn|sexual|xxx)\b'
-        ]
-        
-        text_lower = text.lower()
-        toxicity_score = 0.0
-        
-        # Check for each toxic pattern
-        for pattern in toxic_patterns:
-            matches = re.findall(pattern, text_lower)
-            toxicity_score += len(matches) * 0.15
-        
-        # penalty for having multiple toxic terms
-        if toxicity_score > 0.3:
-            toxicity_score += 0.2
+        with span('moderation'):
+            toxicity_score = get_moderation_engine().score(text)
+        logger.debug("Toxicity score: %s", toxicity_score)
+        return toxicity_score
 
-        logger.info(f"Toxicity score: {toxicity_score}")
-        return min(toxicity_score, 1.0)
-    
     except Exception as e:
         logger.error(f"Toxicity moderation error: {e}")
-        return 0.0
\ No newline at end of file
+        return 0.0
+
+def moderate_batch(captions: List[str]) -> np.ndarray:
+    """Toxicity scores for many captions in one pass, as a float32 array"""
+    try:
+        with span('moderation', len(captions)):
+            return get_moderation_engine().score_batch(captions)
+    except Exception as e:
+        logger.error(f"Toxicity moderation error: {e}")
+        return np.zeros(len(captions), dtype=np.float32)